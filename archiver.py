@@ -0,0 +1,50 @@
+import asyncio
+
+from eventlog import log
+
+
+class Archiver:
+    # Moves reviewed task proofs and completions of finished tasks into the
+    # monthly archive tables in the background.  Batches are small and the
+    # loop yields between them, so a large backlog never holds the database
+    # (or the event loop) for long; once caught up, freed pages are returned
+    # to the file system with an incremental vacuum.
+    def __init__(self, db, interval=3600, batch_size=500, pause=0.05, vacuum_pages=1000):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                moved = await self.archive()
+                if moved:
+                    free_pages = self.db.incremental_vacuum(self.vacuum_pages)
+                    log.info("archive_pass", moved=moved, free_pages=free_pages)
+            except Exception as e:
+                log.error("archiver_error", error=str(e))
+            await asyncio.sleep(self.interval)
+
+    async def archive(self):
+        moved = 0
+        while True:
+            batch = self.db.archive_batch(self.batch_size)
+            moved += batch
+            if batch < self.batch_size:
+                return moved
+            await asyncio.sleep(self.pause)
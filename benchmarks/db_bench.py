@@ -0,0 +1,343 @@
+# Times every Database method against synthetic data at production scale.
+#
+#   python -m benchmarks.db_bench                          # 10k and 100k users
+#   python -m benchmarks.db_bench --scales 10000,100000,1000000
+#   python -m benchmarks.db_bench --save-baseline          # store results as the baseline
+#   python -m benchmarks.db_bench --threshold 0.25         # exit 1 on >25% regressions
+#   python -m benchmarks.db_bench --rounds 9               # more rounds, steadier medians
+#   python -m benchmarks.db_bench --shards 4               # users split over 4 files
+#
+# Generated databases are cached in the temp directory (one per scale and
+# schema) and copied before each run, so the committed bot_database.db is
+# never touched.
+#
+# Every case runs in one untimed warmup round and then --rounds timed rounds;
+# each round goes over all cases in turn, so a slow spell on the machine hits
+# one round of every case rather than every round of a few.  Right before each
+# timed case a fixed raw SQLite workload (a few commits and point reads) is
+# timed too, and the regression gate compares each case's time relative to
+# it: the machine's own drift, which moves both, largely cancels out.  The
+# median is reported with its spread (half the range of the rounds, relative
+# to the median), and a case only counts as a regression when it slows down
+# by more than --threshold plus the spread of both the baseline and this run.
+import argparse
+import contextlib
+import gc
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from database import Database  # noqa: E402
+
+BASELINE_PATH = os.path.join(REPO_DIR, 'benchmarks', 'db_baseline.json')
+FIRST_USER_ID = 1000000
+
+
+def generate(path, users, seed=1):
+    rng = random.Random(seed)
+    Database(path).conn.close()  # let the real schema code create every table
+    conn = sqlite3.connect(path)
+    now = datetime.now()
+    ids = range(FIRST_USER_ID, FIRST_USER_ID + users)
+
+    def user_rows():
+        for index, user_id in enumerate(ids):
+            referrer_id = FIRST_USER_ID + rng.randrange(index) if index and rng.random() < 0.5 else None
+            last_claim = (now - timedelta(minutes=rng.randrange(60 * 48))).strftime('%Y-%m-%d %H:%M:%S.%f')
+            wallet = '0x%040x' % rng.getrandbits(160)
+            yield (user_id, f'user{user_id}', f'First{user_id}', 'Last', f'https://t.me/matic_airdbot?start={user_id}',
+                   referrer_id, int(rng.random() < 0.7), rng.randrange(300), wallet, last_claim)
+
+    with conn:
+        conn.executemany("""
+        INSERT INTO users (id, username, first_name, last_name, referral_link, referrer_id, verified,
+                           matic_balance, matic_wallet, last_claim)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", user_rows())
+        # Bulk inserts bypass add_user, so index the names the way the first
+        # start after upgrading does
+        conn.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+        conn.execute("""
+        INSERT INTO referrals (referrer_id, referred_id)
+        SELECT referrer_id, id FROM users WHERE referrer_id IS NOT NULL""")
+        # Same for the referral trees: dropped here and rebuilt from
+        # referrals when Database opens the file below
+        for table in ('referral_closure', 'referral_levels', 'referral_subtrees'):
+            conn.execute(f"DROP TABLE {table}")
+        conn.executemany(
+            "INSERT INTO task_proofs (user_id, photo_file_id, timestamp) VALUES (?, ?, ?)",
+            ((user_id, f'proof{user_id}', now) for user_id in ids if rng.random() < 0.1))
+        conn.execute("INSERT INTO tasks (photo_file_id, description) VALUES ('task', 'Do the task')")
+        conn.executemany(
+            "INSERT INTO task_completions (user_id, task_id, completed_at) VALUES (?, 1, ?)",
+            ((user_id, now) for user_id in ids if rng.random() < 0.1))
+        conn.executemany(
+            "INSERT INTO outbox (chat_id, text) VALUES (?, 'Notification')",
+            ((user_id,) for user_id in ids if rng.random() < 0.01))
+        conn.execute("INSERT INTO outbox_broadcasts (text) VALUES ('Broadcast')")
+        conn.executemany(
+            "INSERT INTO withdrawals (user_id, amount) VALUES (?, ?)",
+            ((user_id, 60 + rng.randrange(200)) for user_id in ids if rng.random() < 0.1))
+        # Boosters bought over the last two weeks, about half of them expired
+        conn.executemany(
+            "INSERT INTO boosters (user_id, effect, value, expires_at) VALUES (?, ?, ?, ?)",
+            ((user_id, effect, value, now.timestamp() + rng.uniform(-7, 7) * 86400)
+             for user_id in ids for effect, value in (('double_mine', 2), ('time_speed', 18)) if rng.random() < 0.05))
+    conn.close()
+    Database(path).conn.close()
+
+
+def cached_database(users):
+    # Keyed on the schema code too, so a schema change regenerates the data
+    stamp = int(os.path.getmtime(os.path.join(REPO_DIR, 'database.py')))
+    path = os.path.join(tempfile.gettempdir(), f'matic-db-bench-{users}-{stamp}.db')
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        generate(path + '.tmp', users)
+        os.replace(path + '.tmp', path)
+        print(f'  generated {users} users in {time.perf_counter() - started:.1f}s')
+    return path
+
+
+def cases(users):
+    # name -> (repetitions, argument factory).  Reads first, then writes, then
+    # the calls that delete data.
+    def existing(rng):
+        return FIRST_USER_ID + rng.randrange(users)
+
+    new_ids = iter(range(FIRST_USER_ID + users, FIRST_USER_ID + 10 * users))
+    now = datetime.now()
+    return {
+        'is_user_verified': (200, lambda rng: (existing(rng),)),
+        'user_has_joined_channels': (200, lambda rng: (existing(rng),)),
+        'get_user_data': (200, lambda rng: (existing(rng),)),
+        'get_user_matic_balance': (200, lambda rng: (existing(rng),)),
+        'get_referral_count': (200, lambda rng: (existing(rng),)),
+        'get_referrer_id': (200, lambda rng: (existing(rng),)),
+        'get_downstream_count': (200, lambda rng: (existing(rng), rng.choice((3, None)))),
+        'get_downstream_levels': (200, lambda rng: (existing(rng),)),
+        'get_referral_chain': (200, lambda rng: (existing(rng),)),
+        'get_last_claim_time': (200, lambda rng: (existing(rng),)),
+        'get_active_boosters': (200, lambda rng: (existing(rng),)),
+        'has_user_completed_task': (200, lambda rng: (existing(rng), 1)),
+        'get_task_proof_date': (200, lambda rng: (existing(rng),)),
+        'get_user_proofs': (200, lambda rng: (existing(rng),)),
+        'get_user_completions': (200, lambda rng: (existing(rng),)),
+        'get_tasks': (50, lambda rng: ()),
+        'get_task_proofs': (50, lambda rng: ()),
+        'get_unhashed_proofs': (50, lambda rng: (50,)),
+        'iter_task_proofs': (3, lambda rng: ((now - timedelta(days=1)).strftime('%Y-%m-%d'), '9999-12-31')),
+        'get_latest_instruction': (50, lambda rng: ()),
+        'get_due_notifications': (20, lambda rng: (100,)),
+        'get_pending_notification_count': (5, lambda rng: ()),
+        'get_pending_withdrawal_count': (5, lambda rng: ()),
+        'iter_pending_withdrawals': (3, lambda rng: ()),
+        'get_total_users': (5, lambda rng: ()),
+        'get_stat_total': (200, lambda rng: ('new_users',)),
+        'get_stats': (50, lambda rng: ()),
+        'load_persistence': (3, lambda rng: ('user',)),
+        'load_persistence_entry': (200, lambda rng: ('user', str(existing(rng)))),
+        'get_all_users': (3, lambda rng: ()),
+        'get_user_with_most_referrals': (3, lambda rng: ()),
+        'get_largest_subtrees': (50, lambda rng: ()),
+        'get_wallet_clusters': (3, lambda rng: ()),
+        'search_users': (200, lambda rng: (rng.choice((f'@user{existing(rng)}', 'first', 'last user10', str(existing(rng)))),)),
+        'get_referrer_clusters': (3, lambda rng: ()),
+        'add_user': (200, lambda rng: (next(new_ids), 'new', 'New', 'User', 'link', existing(rng))),
+        'add_referral': (200, lambda rng: (existing(rng), next(new_ids))),
+        'verify_user': (200, lambda rng: (existing(rng),)),
+        'update_wallet_address': (200, lambda rng: (existing(rng), '0x%040x' % rng.getrandbits(160))),
+        'update_user_info': (200, lambda rng: (existing(rng), 'First', 'Last', 'username')),
+        'update_matic_balance': (200, lambda rng: (existing(rng), 1)),
+        'reward_referrer': (200, lambda rng: (existing(rng), 5)),
+        'deduct_matic_balance': (200, lambda rng: (existing(rng), 1)),
+        'withdraw_matic_balance': (200, lambda rng: (existing(rng), 1)),
+        'complete_withdrawals': (3, lambda rng: (rng.randrange(users // 20),)),
+        'add_stat': (200, lambda rng: ('broadcast_deliveries', 10)),
+        'save_persistence': (50, lambda rng: ([('user', str(existing(rng)), b'data') for _ in range(100)],)),
+        'update_last_claim_time': (200, lambda rng: (existing(rng),)),
+        'update_claim_time': (200, lambda rng: (existing(rng), timedelta(hours=-6))),
+        'claim_matic': (200, lambda rng: (existing(rng),)),
+        'activate_booster': (200, lambda rng: (existing(rng), rng.choice(('double_mine', 'time_speed')), 1, 86400)),
+        'save_task_proof': (200, lambda rng: (existing(rng), 'proof')),
+        'save_task_completion': (200, lambda rng: (existing(rng), 1)),
+        'save_proof_hash': (200, lambda rng: (rng.randrange(1, users), existing(rng), rng.getrandbits(64))),
+        'enqueue_notification': (200, lambda rng: (existing(rng), 'Notification')),
+        'retry_notification': (100, lambda rng: (rng.randrange(1, users // 100 + 2), 5, 'error')),
+        'defer_notification': (100, lambda rng: (rng.randrange(1, users // 100 + 2), 5, 'flood')),
+        'fail_notification': (100, lambda rng: (rng.randrange(1, users // 100 + 2), 'error')),
+        'expand_broadcast': (10, lambda rng: (100,)),
+        'mark_notification_sent': (100, lambda rng: (rng.randrange(1, users // 100 + 2),)),
+        'update_instruction': (50, lambda rng: ('New instruction',)),
+        'clear_task_proofs': (50, lambda rng: ()),
+        'mark_proofs_reviewed': (200, lambda rng: (existing(rng),)),
+        'expire_boosters': (10, lambda rng: ({'double_mine': 'Ended', 'time_speed': 'Ended'},)),
+        'archive_batch': (10, lambda rng: (500,)),
+        'incremental_vacuum': (3, lambda rng: (1000,)),
+        'save_task': (3, lambda rng: ('task', 'Do the task')),
+        'end_task': (3, lambda rng: (rng.randrange(2, 5),)),
+        'create_tables': (3, lambda rng: ()),
+    }
+
+
+# Not timed: add_task_proof writes columns the tasks table does not have,
+# close ends the run
+SKIPPED = {'add_task_proof', 'close'}
+
+
+def calibrate(conn):
+    # A fixed workload that only depends on the machine: 10 commits and 1000
+    # point reads on a scratch file next to the benchmark database
+    started = time.perf_counter()
+    for _ in range(10):
+        with conn:
+            conn.execute("UPDATE calibration SET value = value + 1 WHERE id = 1")
+    for _ in range(1000):
+        conn.execute("SELECT value FROM calibration WHERE id = 1").fetchone()
+    return time.perf_counter() - started
+
+
+def run_calls(method, calls):
+    for args in calls:
+        result = method(*args)
+        if isinstance(result, types.GeneratorType):
+            for _ in result:
+                pass
+
+
+def summarize(times, references):
+    relative = sorted(seconds / reference for seconds, reference in zip(times, references))
+    relative_median = statistics.median(relative)
+    return {
+        'median': statistics.median(times),
+        'relative': relative_median,
+        'spread': (relative[-1] - relative[0]) / 2 / relative_median if relative_median else 0.0,
+    }
+
+
+def run_scale(users, seed=1, shards=1, rounds=5):
+    path = os.path.join(tempfile.gettempdir(), f'matic-db-bench-run-{os.getpid()}.db')
+    shutil.copy(cached_database(users), path)
+    calibration = sqlite3.connect(os.path.join(tempfile.gettempdir(), f'matic-db-bench-calibration-{os.getpid()}.db'))
+    calibration.execute("CREATE TABLE IF NOT EXISTS calibration (id INTEGER PRIMARY KEY, value INTEGER)")
+    with calibration:
+        calibration.execute("INSERT OR REPLACE INTO calibration (id, value) VALUES (1, 0)")
+    results = {}
+    try:
+        if shards > 1:
+            # The split runs on the first sharded open, before timing starts
+            Database(path, shards).close()
+        rng = random.Random(seed)
+        table = cases(users)
+        missing = [name for name in dir(Database)
+                   if not name.startswith('_') and name not in table and name not in SKIPPED]
+        if missing:
+            print(f"  no benchmark case for: {', '.join(missing)}")
+
+        times = {name: [] for name in ('__init__', *table)}
+        references = {name: [] for name in times}
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # Round 0 is the warmup: caches, and one-off work such as the
+            # first expire_boosters sweep
+            for timed in [False] + [True] * rounds:
+                gc.collect()
+                reference = calibrate(calibration)
+                started = time.perf_counter()
+                db = Database(path, shards)
+                if timed:
+                    times['__init__'].append(time.perf_counter() - started)
+                    references['__init__'].append(reference)
+                for name, (repetitions, make_args) in table.items():
+                    # Arguments are built outside the timed part
+                    calls = [make_args(rng) for _ in range(repetitions)]
+                    gc.collect()
+                    reference = calibrate(calibration)
+                    started = time.perf_counter()
+                    run_calls(getattr(db, name), calls)
+                    if timed:
+                        times[name].append((time.perf_counter() - started) / repetitions)
+                        references[name].append(reference)
+                db.close()
+        results = {name: summarize(times[name], references[name]) for name in times}
+    finally:
+        calibration.close()
+        os.remove(os.path.join(tempfile.gettempdir(), f'matic-db-bench-calibration-{os.getpid()}.db'))
+        root, ext = os.path.splitext(path)
+        for shard in range(shards if shards > 1 else 0):
+            os.remove(f'{root}.shard{shard}{ext}')
+        os.remove(path)
+    return results
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:8.1f} us'
+    if seconds < 1:
+        return f'{seconds * 1e3:8.2f} ms'
+    return f'{seconds:8.2f} s '
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Database methods at scale')
+    parser.add_argument('--scales', default='10000,100000', help='comma separated user counts')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown vs baseline, on top of the measured spread')
+    parser.add_argument('--rounds', type=int, default=5, help='timed rounds per case after one warmup round')
+    parser.add_argument('--shards', type=int, default=1, help='compare with --baseline of an unsharded run')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    current = {}
+    regressions = []
+    for users in (int(scale) for scale in args.scales.split(',')):
+        print(f'{users} users')
+        results = current[str(users)] = run_scale(users, shards=args.shards, rounds=args.rounds)
+        reference = baseline.get(str(users), {})
+        for name, result in results.items():
+            line = f'  {name:<32}{format_seconds(result["median"])} ±{result["spread"]:5.1%}'
+            if name in reference:
+                expected = reference[name]
+                if isinstance(expected, dict) and 'relative' in expected:
+                    change = result['relative'] / expected['relative'] - 1 if expected['relative'] else 0.0
+                    allowed = args.threshold + expected['spread'] + result['spread']
+                else:
+                    # Baselines saved before calibration hold a bare time
+                    change = result['median'] / expected - 1 if expected else 0.0
+                    allowed = args.threshold + result['spread']
+                line += f'   {change:+7.1%}'
+                if change > allowed:
+                    line += '   REGRESSION'
+                    regressions.append((users, name, change, allowed))
+            print(line)
+
+    if args.save_baseline:
+        baseline.update(current)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'baseline written to {args.baseline}')
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) above {args.threshold:.0%} plus spread:')
+        for users, name, change, allowed in regressions:
+            print(f'  {users} users  {name}  {change:+.1%} (allowed {allowed:+.1%})')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
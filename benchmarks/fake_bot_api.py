@@ -0,0 +1,213 @@
+# Local stand-in for the Telegram Bot API, used by the load test and benchmarks.
+#
+# Implements the calls main.py makes on the hot path (getMe, getUpdates,
+# sendMessage, sendPhoto, getChatMember, deleteMessage, answerCallbackQuery,
+# editMessageText) and can inject per-call latency, 429 flood errors with
+# retry_after and "bot was blocked by the user" errors.  Files registered with
+# add_file are served through getFile and the /file/bot<token>/ download path.
+# Point the bot at it with
+# main.build_application(base_url=server.url, base_file_url=server.file_url).
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+SEND_METHODS = {'sendMessage', 'sendPhoto', 'editMessageText', 'deleteMessage'}
+
+
+class FakeBotAPI:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 flood_probability=0.0, retry_after=1, blocked_users=(), seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_probability = flood_probability
+        self.retry_after = retry_after
+        self.blocked_users = set(blocked_users)
+        self.calls = Counter()
+        self.injected = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._updates = deque()
+        self._updates_ready = threading.Condition(self._lock)
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self.files = {}
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    @property
+    def file_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/file/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._updates_ready:
+            self._updates_ready.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_updates(self, updates):
+        with self._updates_ready:
+            for update in updates:
+                update['update_id'] = self._next_update_id
+                self._next_update_id += 1
+                self._updates.append(update)
+            self._updates_ready.notify_all()
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = bytes(data)
+
+    # Bot API methods ---------------------------------------------------
+
+    def call(self, method, params):
+        with self._lock:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if method == 'getMe':
+            return 200, _ok({'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'})
+
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if self.flood_probability and self._random.random() < self.flood_probability:
+            with self._lock:
+                self.injected['429'] += 1
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+        chat_id = params.get('chat_id')
+        if method in SEND_METHODS and chat_id in self.blocked_users:
+            with self._lock:
+                self.injected['403'] += 1
+            return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+
+        if method in ('sendMessage', 'editMessageText'):
+            return 200, _ok(self._message(chat_id, text=params.get('text', '')))
+        if method == 'sendPhoto':
+            photo = [{'file_id': 'fake-photo', 'file_unique_id': 'fake-photo', 'width': 90, 'height': 90}]
+            return 200, _ok(self._message(chat_id, photo=photo, caption=params.get('caption')))
+        if method == 'getFile':
+            file_id = params.get('file_id')
+            if file_id not in self.files:
+                return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: invalid file_id'}
+            return 200, _ok({'file_id': file_id, 'file_unique_id': file_id,
+                             'file_size': len(self.files[file_id]), 'file_path': f'photos/{file_id}.jpg'})
+        if method == 'getChatMember':
+            user = {'id': params.get('user_id'), 'is_bot': False, 'first_name': 'Member'}
+            return 200, _ok({'status': 'member', 'user': user})
+        # deleteMessage, answerCallbackQuery and anything else just succeed
+        return 200, _ok(True)
+
+    def download(self, file_path):
+        with self._lock:
+            self.calls['download'] += 1
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        file_id = file_path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        return self.files.get(file_id)
+
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._updates_ready:
+            while True:
+                # Anything below offset has been confirmed by the client
+                while self._updates and self._updates[0]['update_id'] < offset:
+                    self._updates.popleft()
+                if self._updates:
+                    return 200, _ok([self._updates[i] for i in range(min(limit, len(self._updates)))])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return 200, _ok([])
+                self._updates_ready.wait(remaining)
+
+    def _message(self, chat_id, **fields):
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        chat = {'id': chat_id, 'type': 'private'}
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': chat}
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+
+def _ok(result):
+    return {'ok': True, 'result': result}
+
+
+def _parse_params(content_type, body):
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body
+        )
+        raw = {}
+        for part in message.iter_parts():
+            if part.get_filename():
+                continue
+            raw[part.get_param('name', header='content-disposition')] = part.get_content()
+    else:
+        raw = dict(parse_qsl(body.decode()))
+
+    params = {}
+    for key, value in raw.items():
+        # PTB JSON-encodes every non-string parameter
+        try:
+            params[key] = json.loads(value)
+        except (TypeError, ValueError):
+            params[key] = value
+    return params
+
+
+def _make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            method = self.path.rsplit('/', 1)[-1]
+            params = _parse_params(self.headers.get('Content-Type', ''), body)
+            status, payload = api.call(method, params)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if not self.path.startswith('/file/'):
+                return self.do_POST()
+            # /file/bot<token>/<file_path>
+            data = api.download(self.path.split('/', 3)[-1])
+            self.send_response(200 if data is not None else 404)
+            self.send_header('Content-Length', str(len(data or b'')))
+            self.end_headers()
+            self.wfile.write(data or b'')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,167 @@
+# Drives the real Application from main.build_application() through the fake
+# Bot API server with synthetic users and reports throughput and handler latency.
+#
+#   python -m benchmarks.load_test --users 2000 --latency 0.02 --flood 0.01 --blocked 0.05
+#
+# Runs in a throwaway working directory so it never touches bot_database.db.
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_bot_api import FakeBotAPI
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_USER_ID = 100000
+MENU_TAPS = ["Mine Matic 🔨", "Wallet 💰", "Invite 👥", "Profile 👤", "Tasks 🪙"]
+
+
+def user_session(user_id, referrer_id=None):
+    # One new user going through onboarding and then tapping around the menu
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+
+    def message(text):
+        message = {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'from': user, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'message': message}
+
+    start = '/start' if referrer_id is None else f'/start {referrer_id}'
+    subscribed = {'callback_query': {
+        'id': str(user_id), 'from': user, 'chat_instance': str(user_id), 'data': 'subscribed',
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': 'Welcome'},
+    }}
+    wallet = '0x' + ''.join(random.choice('0123456789abcdef') for _ in range(40))
+    return [message(start), subscribed, message(wallet)] + [message(text) for text in MENU_TAPS]
+
+
+def generate_updates(users, first_user_id=FIRST_USER_ID):
+    sessions = []
+    for index in range(users):
+        user_id = first_user_id + index
+        referrer_id = first_user_id + random.randrange(index) if index and random.random() < 0.5 else None
+        sessions.append(user_session(user_id, referrer_id))
+    # Interleave the sessions the way concurrent users would arrive
+    updates = []
+    for step in range(max(len(session) for session in sessions)):
+        updates.extend(session[step] for session in sessions if step < len(session))
+    return updates
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    server = FakeBotAPI(
+        latency=args.latency, jitter=args.jitter, flood_probability=args.flood,
+        retry_after=args.retry_after, seed=args.seed,
+    ).start()
+
+    updates = generate_updates(args.users)
+    server.blocked_users = {
+        FIRST_USER_ID + index for index in range(args.users) if random.random() < args.blocked
+    }
+
+    import main
+    from sequencer import SequencedApplication
+
+    latencies = []
+
+    # Latency is measured per update from the moment it is fetched, including
+    # time queued behind the same user's earlier updates, which is what that
+    # user actually waits
+    class TimedApplication(SequencedApplication):
+        fetched = {}
+
+        def schedule_update(self, update):
+            self.fetched[update.update_id] = time.perf_counter()
+            super().schedule_update(update)
+
+        async def process_update(self, update):
+            try:
+                await super().process_update(update)
+            finally:
+                latencies.append(time.perf_counter() - self.fetched.pop(update.update_id))
+
+    application = main.build_application(token='123:fake', base_url=server.url, base_file_url=server.file_url,
+                                         application_class=TimedApplication)
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    await application.start()
+
+    started = time.perf_counter()
+    server.push_updates(updates)
+    deadline = started + args.max_seconds
+    while len(latencies) < len(updates) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+    server.stop()
+
+    latencies.sort()
+    return {
+        'updates': len(updates),
+        'processed': len(latencies),
+        'elapsed': elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'calls': dict(server.calls),
+        'injected': dict(server.injected),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Load test main.py against a fake Bot API')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help='Bot API latency per call in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--flood', type=float, default=0.0, help='probability of a 429 per call')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--blocked', type=float, default=0.0, help='fraction of users that blocked the bot')
+    parser.add_argument('--max-seconds', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # Fresh database and the assets handlers open by relative path
+    workdir = tempfile.mkdtemp(prefix='matic-load-')
+    shutil.copy(os.path.join(REPO_DIR, 'airdrop.png'), workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    os.environ.setdefault('FLOOD_BURST', '1000')
+    os.environ['KEEPALIVE_URL'] = ''
+
+    logging.getLogger('telegram').setLevel(logging.CRITICAL)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{result['processed']}/{result['updates']} updates from {args.users} users in {result['elapsed']:.2f}s")
+    print(f"throughput: {result['processed'] / result['elapsed']:.1f} updates/sec")
+    print(f"handler latency p50 {result['p50'] * 1000:.1f} ms  p95 {result['p95'] * 1000:.1f} ms  "
+          f"p99 {result['p99'] * 1000:.1f} ms")
+    print('api calls: ' + ', '.join(f'{method}={count}' for method, count in sorted(result['calls'].items())))
+    if result['injected']:
+        print('injected errors: ' + ', '.join(f'{code}={count}' for code, count in sorted(result['injected'].items())))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,147 @@
+# Runs proofhash.ProofHasher against the fake Bot API's file server with
+# synthetic task-proof screenshots, some of them resubmitted after being
+# re-encoded, resized or cropped, and reports detection accuracy, throughput
+# and how long the event loop was blocked.
+#
+#   python -m benchmarks.proof_dedup --proofs 500 --duplicates 0.3 --latency 0.05
+#
+# Uses a throwaway database, never bot_database.db.
+import argparse
+import asyncio
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+from benchmarks.fake_bot_api import FakeBotAPI
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from database import Database  # noqa: E402
+from proofhash import ProofHasher  # noqa: E402
+
+
+def screenshot(rng, width=360, height=640):
+    # Blocks of colour and text lines, roughly the layout of a phone screenshot
+    image = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randrange(4, 12)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        box = (x, y, x + rng.randrange(40, width), y + rng.randrange(20, height // 3))
+        draw.rectangle(box, fill=tuple(rng.randrange(256) for _ in range(3)))
+    for line in range(rng.randrange(5, 20)):
+        draw.text((10, 30 * line + 5), f'proof {rng.getrandbits(32):x}', fill=(0, 0, 0))
+    return image
+
+
+def resubmitted(rng, image):
+    # What a screenshot looks like after going through Telegram again
+    width, height = image.size
+    edit = rng.choice(('reencode', 'resize', 'crop'))
+    if edit == 'resize':
+        scale = rng.uniform(0.6, 0.9)
+        image = image.resize((int(width * scale), int(height * scale)))
+    elif edit == 'crop':
+        dx, dy = rng.randrange(1, width // 50 + 2), rng.randrange(1, height // 50 + 2)
+        image = image.crop((dx, dy, width - dx, height - dy))
+    return image
+
+
+def jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def generate(server, db, proofs, duplicates, seed):
+    # Returns {proof id: proof id of the original} for every resubmission
+    rng = random.Random(seed)
+    originals = []
+    expected = {}
+    for index in range(proofs):
+        user_id = 1000 + rng.randrange(proofs)
+        if originals and rng.random() < duplicates:
+            original_id, image = rng.choice(originals)
+            image = resubmitted(rng, image)
+        else:
+            original_id, image = None, screenshot(rng)
+        file_id = f'proof{index}'
+        server.add_file(file_id, jpeg(image, rng.randrange(60, 95)))
+        db.save_task_proof(user_id, file_id)
+        proof_id = db.conn.execute("SELECT MAX(id) FROM task_proofs").fetchone()[0]
+        if original_id is None:
+            originals.append((proof_id, image))
+        else:
+            expected[proof_id] = original_id
+    return expected
+
+
+async def run(args, db, server):
+    from telegram import Bot
+    from metrics import InstrumentedRequest
+
+    hasher = ProofHasher(db, concurrency=args.concurrency, workers=args.workers, batch_size=args.batch_size)
+    worst_lag = 0.0
+
+    async def heartbeat(interval=0.01):
+        nonlocal worst_lag
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            worst_lag = max(worst_lag, time.perf_counter() - started - interval)
+
+    bot = Bot('123:fake', base_url=server.url, base_file_url=server.file_url,
+              request=InstrumentedRequest(connection_pool_size=args.concurrency * 2))
+    async with bot:
+        monitor = asyncio.create_task(heartbeat())
+        started = time.perf_counter()
+        # Includes process pool start-up
+        hasher.start(bot)
+        while db.get_unhashed_proofs(1):
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        await hasher.stop()
+        monitor.cancel()
+    return elapsed, worst_lag
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark task-proof duplicate detection against a fake file server')
+    parser.add_argument('--proofs', type=int, default=300)
+    parser.add_argument('--duplicates', type=float, default=0.3, help='fraction of proofs that are resubmissions')
+    parser.add_argument('--latency', type=float, default=0.05, help='getFile and download latency in seconds')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='matic-proofs-')
+    server = FakeBotAPI(latency=args.latency, seed=args.seed).start()
+    try:
+        db = Database(os.path.join(workdir, 'proofs.db'))
+        expected = generate(server, db, args.proofs, args.duplicates, args.seed)
+        elapsed, worst_lag = asyncio.run(run(args, db, server))
+        flagged = dict(db.conn.execute("SELECT proof_id, duplicate_of FROM proof_hashes WHERE duplicate_of IS NOT NULL"))
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # A resubmission counts as caught when it is flagged at all: matching an
+    # earlier resubmission of the same original is just as useful to a reviewer
+    caught = sum(1 for proof_id in expected if proof_id in flagged)
+    false_flags = sum(1 for proof_id in flagged if proof_id not in expected)
+    print(f"{args.proofs} proofs hashed in {elapsed:.2f}s ({args.proofs / elapsed:.1f} proofs/sec), "
+          f"downloads={server.calls['download']}")
+    print(f"resubmissions caught: {caught}/{len(expected)}  false flags: {false_flags}")
+    print(f"worst event loop lag: {worst_lag * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main_cli()
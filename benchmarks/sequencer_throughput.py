@@ -0,0 +1,162 @@
+# Throughput of update processing under synthetic load.
+#
+#   python -m benchmarks.sequencer_throughput [users] [updates_per_user] [latency_ms]
+#
+# Every simulated update does a read / await / write on the user's balance, the
+# same shape as the Withdraw and booster flows in handle_message.  Each user's
+# updates arrive in bursts, randomly interleaved with other users', and each
+# update awaits a random 0-2x latency, so without per-user ordering a later
+# update can overtake an earlier one and overwrite its balance.  The run is
+# repeated with the default serial Application, a plain concurrent Application
+# and the SequencedApplication used by main(), and reports updates/sec together
+# with lost balance writes and updates whose write landed out of order.
+#
+# A second run checks head-of-line blocking: one user queues a backlog of slow
+# updates, then another user sends a single instant one, with only a few
+# concurrency slots.  The second user should be served right away instead of
+# waiting behind the first user's backlog.
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+
+from sequencer import SequencedApplication
+
+BOT_INFO = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+class OfflineRequest(BaseRequest):
+    # Only answers getMe so Application.initialize() works without the network
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        return 200, json.dumps({"ok": True, "result": BOT_INFO}).encode()
+
+
+def make_update(update_id, user_id, text):
+    user = User(id=user_id, first_name=f"user{user_id}", is_bot=False)
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=user_id, type=Chat.PRIVATE),
+        from_user=user,
+        text=text,
+    )
+    return Update(update_id=update_id, message=message)
+
+
+def make_updates(users, per_user, rng):
+    arrivals = [user_id for user_id in range(1, users + 1) for _ in range(per_user)]
+    rng.shuffle(arrivals)
+    next_seq = {}
+    updates = []
+    for update_id, user_id in enumerate(arrivals, 1):
+        seq = next_seq[user_id] = next_seq.get(user_id, -1) + 1
+        updates.append(make_update(update_id, user_id, str(seq)))
+    return updates
+
+
+def build(application_class, concurrent_updates):
+    return (
+        Application.builder()
+        .token("1:bench")
+        .request(OfflineRequest())
+        .get_updates_request(OfflineRequest())
+        .updater(None)
+        .application_class(application_class)
+        .concurrent_updates(concurrent_updates)
+        .build()
+    )
+
+
+async def run(name, application_class, concurrent_updates, updates, latencies):
+    balances = {}
+    last_seq = {}
+    out_of_order = 0
+
+    async def handler(update, context):
+        nonlocal out_of_order
+        user_id = update.effective_user.id
+        balance = balances.get(user_id, 0)
+        await asyncio.sleep(latencies[update.update_id])
+        balances[user_id] = balance + 1
+
+        seq = int(update.message.text)
+        if seq < last_seq.get(user_id, -1):
+            out_of_order += 1
+        last_seq[user_id] = max(seq, last_seq.get(user_id, -1))
+
+    application = build(application_class, concurrent_updates)
+    application.add_handler(TypeHandler(Update, handler))
+
+    await application.initialize()
+    await application.start()
+    started = time.perf_counter()
+    for update in updates:
+        await application.update_queue.put(update)
+    await application.update_queue.join()
+    elapsed = time.perf_counter() - started
+    await application.stop()
+    await application.shutdown()
+
+    lost = len(updates) - sum(balances.values())
+    print(f"{name:<12} {len(updates) / elapsed:>10.1f} updates/sec  "
+          f"lost writes: {lost:<6} out of order: {out_of_order}")
+
+
+async def run_busy_user(name, application_class, slots, backlog, latency):
+    served = {}
+
+    async def handler(update, context):
+        if update.effective_user.id == 1:
+            await asyncio.sleep(latency)
+        served.setdefault(update.effective_user.id, time.perf_counter())
+
+    application = build(application_class, slots)
+    application.add_handler(TypeHandler(Update, handler))
+
+    await application.initialize()
+    await application.start()
+    started = time.perf_counter()
+    for update_id in range(1, backlog + 1):
+        await application.update_queue.put(make_update(update_id, 1, str(update_id)))
+    await application.update_queue.put(make_update(backlog + 1, 2, "0"))
+    await application.update_queue.join()
+    await application.stop()
+    await application.shutdown()
+
+    print(f"{name:<12} other user served after {served[2] - started:.3f}s")
+
+
+async def bench(users, per_user, latency, seed=1):
+    rng = random.Random(seed)
+    updates = make_updates(users, per_user, rng)
+    # Same latencies in every mode
+    latencies = {update.update_id: rng.uniform(0, 2 * latency) for update in updates}
+    print(f"{users} users x {per_user} updates, 0-{latency * 2000:.0f} ms handler latency")
+    await run("serial", Application, False, updates, latencies)
+    await run("concurrent", Application, 64, updates, latencies)
+    await run("sequenced", SequencedApplication, 64, updates, latencies)
+
+    slots, backlog, busy_latency = 4, 10, 0.2
+    print(f"\n{slots} slots, one user with {backlog} queued updates of {busy_latency * 1000:.0f} ms")
+    await run_busy_user("concurrent", Application, slots, backlog, busy_latency)
+    await run_busy_user("sequenced", SequencedApplication, slots, backlog, busy_latency)
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    asyncio.run(bench(users, per_user, latency))
@@ -0,0 +1,83 @@
+# Write throughput of several writers against one database file and against
+# the same data split into shards.
+#
+#   python -m benchmarks.shard_bench --users 100000 --writers 4 --shards 1,4
+#
+# Each writer is a process with its own Database, crediting random users one
+# transaction at a time, the way update_matic_balance runs for a claim.  With
+# one file every commit waits for the file's lock; with shards, writers to
+# different shards commit side by side.
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.db_bench import FIRST_USER_ID, cached_database
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from database import Database  # noqa: E402
+
+
+def writer(path, shards, users, writes, seed, ready, start, results):
+    db = Database(path, shards)
+    rng = random.Random(seed)
+    user_ids = [FIRST_USER_ID + rng.randrange(users) for _ in range(writes)]
+    ready.wait()
+    start.wait()
+    started = time.perf_counter()
+    for user_id in user_ids:
+        db.update_matic_balance(user_id, 1)
+    results.put(time.perf_counter() - started)
+    db.close()
+
+
+def run(users, shards, writers, writes):
+    path = os.path.join(tempfile.gettempdir(), f'matic-shard-bench-{os.getpid()}.db')
+    shutil.copy(cached_database(users), path)
+    try:
+        # Split before the writers open it
+        Database(path, shards).close()
+        ready = multiprocessing.Barrier(writers + 1)
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=writer, args=(path, shards, users, writes, seed, ready, start, results))
+                     for seed in range(writers)]
+        for process in processes:
+            process.start()
+        ready.wait()
+        started = time.perf_counter()
+        start.set()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+        slowest = max(results.get() for _ in processes)
+    finally:
+        root, ext = os.path.splitext(path)
+        for shard in range(shards if shards > 1 else 0):
+            os.remove(f'{root}.shard{shard}{ext}')
+        os.remove(path)
+    return writers * writes / elapsed, slowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare write throughput with and without shards')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--writers', type=int, default=4, help='writer processes')
+    parser.add_argument('--writes', type=int, default=500, help='transactions per writer')
+    parser.add_argument('--shards', default='1,4', help='comma separated shard counts')
+    args = parser.parse_args()
+
+    print(f'{args.users} users, {args.writers} writers x {args.writes} transactions')
+    for shards in (int(count) for count in args.shards.split(',')):
+        throughput, slowest = run(args.users, shards, args.writers, args.writes)
+        print(f'  {shards:3} shard(s)  {throughput:9.1f} writes/sec  slowest writer {slowest:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Compares Bot API transport settings for a burst of concurrent sends while
+# getUpdates long polling runs, against the fake Bot API server.
+#
+#   python -m benchmarks.transport_bench --sends 2000 --concurrency 128 --latency 0.02
+#
+# Each scenario builds its own requests with transport.TunedRequest.  "shared"
+# scenarios route getUpdates through the same pool as the sends, the way a
+# single default request object does.  The fake server speaks HTTP/1.1 only,
+# so HTTP/2 cannot be compared here.
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import Counter
+
+from benchmarks.fake_bot_api import FakeBotAPI
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from transport import TunedRequest  # noqa: E402
+
+# label, send pool size, keep-alive connections (None = pool size), shared with getUpdates
+SCENARIOS = [
+    ('shared pool of 1 (PTB default)', 1, None, True),
+    ('shared pool of 8', 8, None, True),
+    ('separate pools, 8 for sends', 8, None, False),
+    ('separate pools, 64 for sends', 64, None, False),
+    ('separate pools, 64, no keep-alive', 64, 0, False),
+    ('separate pools, 256 for sends (main.py)', 256, None, False),
+]
+
+
+async def poll_updates(bot, stop):
+    offset = 0
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=1)
+        except Exception:
+            await asyncio.sleep(0.1)
+            continue
+        if updates:
+            offset = updates[-1].update_id + 1
+
+
+async def run_scenario(server, args, pool_size, keepalive, shared):
+    from telegram import Bot
+
+    send_request = TunedRequest(connection_pool_size=pool_size, keepalive_connections=keepalive)
+    updates_request = send_request if shared else TunedRequest(connection_pool_size=1)
+    bot = Bot('123:fake', base_url=server.url, request=send_request, get_updates_request=updates_request)
+    errors = Counter()
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def send(chat_id):
+        async with limit:
+            try:
+                await bot.send_message(chat_id=chat_id, text='Broadcast')
+            except Exception as e:
+                errors[type(e).__name__] += 1
+
+    async with bot:
+        stop = asyncio.Event()
+        poller = asyncio.create_task(poll_updates(bot, stop))
+        # Let the first long poll take its connection
+        await asyncio.sleep(0.2)
+        started = time.perf_counter()
+        await asyncio.gather(*(send(1000 + index) for index in range(args.sends)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await poller
+    return elapsed, errors
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark Bot API connection pool settings against a fake server')
+    parser.add_argument('--sends', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=128, help='sends in flight at once')
+    parser.add_argument('--latency', type=float, default=0.02, help='Bot API latency per call in seconds')
+    args = parser.parse_args()
+
+    server = FakeBotAPI(latency=args.latency).start()
+    try:
+        print(f"{args.sends} sendMessage calls, {args.concurrency} in flight, {args.latency * 1000:.0f} ms latency")
+        for label, pool_size, keepalive, shared in SCENARIOS:
+            elapsed, errors = asyncio.run(run_scenario(server, args, pool_size, keepalive, shared))
+            failed = sum(errors.values())
+            details = ', '.join(f'{name}={count}' for name, count in errors.most_common())
+            print(f"  {label:42} {(args.sends - failed) / elapsed:8.1f} sends/sec  "
+                  f"failed {failed}{f' ({details})' if details else ''}")
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main_cli()
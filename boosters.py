@@ -0,0 +1,41 @@
+import asyncio
+
+from eventlog import log
+
+
+class BoosterSweeper:
+    # Ends expired boosters for every user in one pass on a fixed interval,
+    # instead of scheduling a job per purchase.  Claims already ignore a
+    # booster once its expiry has passed, so the interval only decides how
+    # soon the row is removed and the owner is told.
+    def __init__(self, db, interval=60, notify=None, on_expired=None):
+        self.db = db
+        self.interval = interval
+        # effect -> message queued in the outbox for owners of expired boosters
+        self.notify = notify
+        self.on_expired = on_expired
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                expired = self.db.expire_boosters(self.notify)
+                if expired:
+                    log.info("boosters_expired", count=expired)
+                    if self.on_expired:
+                        self.on_expired()
+            except Exception as e:
+                log.error("booster_sweeper_error", error=str(e))
+            await asyncio.sleep(self.interval)
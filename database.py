@@ -1,30 +1,215 @@
+import heapq
+import os
+import re
 import sqlite3
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import groupby, islice
+from operator import itemgetter
+
+from eventlog import log
+
+
+WALLET_RE = re.compile(r'(?:0x)?([0-9a-fA-F]{40})')
+
+
+def normalize_wallet(text):
+    # Polygon addresses are EVM addresses: 0x followed by 40 hex digits.  Stored
+    # lower-case with the prefix, so equal addresses compare equal in SQL;
+    # returns None for anything else.
+    match = WALLET_RE.fullmatch(text.strip())
+    return '0x' + match.group(1).lower() if match else None
+
+
+# Task proofs whose 64-bit perceptual hashes differ in at most this many bits
+# are flagged as likely duplicates.  Hashes are indexed as eight 8-bit bands:
+# hashes fewer than eight bits apart agree on at least one whole band, so the
+# candidates for a match are found with index lookups.
+DUPLICATE_DISTANCE = 6
+HASH_BANDS = 8
+
+
+def hash_bands(value):
+    return [(band, value >> (8 * band) & 0xFF) for band in range(HASH_BANDS)]
+
+
+# Reviewed proofs and completions of finished tasks are moved out of the hot
+# tables into one archive table per month, e.g. task_proofs_archive_202405
+ARCHIVE_SCHEMAS = {
+    'task_proofs': """
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        photo_file_id TEXT,
+        timestamp TIMESTAMP,
+        reviewed_at TIMESTAMP,
+        task_id INTEGER""",
+    'task_completions': """
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        task_id INTEGER,
+        completed_at TIMESTAMP""",
+}
+ARCHIVE_INDEXES = {
+    'task_proofs': ('user_id', 'timestamp'),
+    'task_completions': ('user_id',),
+}
+ARCHIVE_NAME_RE = re.compile(r'(task_proofs|task_completions)_archive_(\d{6})')
+
+# A claim pays CLAIM_REWARD once every CLAIM_COOLDOWN.  Active boosters
+# change that: each row in the boosters table carries the value of its effect
+# until expires_at.
+CLAIM_REWARD = 1
+CLAIM_COOLDOWN = timedelta(hours=24)
+BOOSTERS = {
+    'double_mine': 2,   # reward multiplier
+    'time_speed': 18,   # cooldown in hours
+}
+# Legacy users columns kept in step with the boosters table
+BOOSTER_FLAGS = {
+    'double_mine': ('double_mine_active', 'double_mine_enabled'),
+    'time_speed': ('time_speed_enabled',),
+}
+
+
+def parse_timestamp(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def search_terms(text):
+    # FTS5 query matching rows that have every word as a prefix; words are
+    # quoted, so user input never reaches the query syntax
+    words = text.replace('@', ' ').split()
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+
+
+class KnownUsers:
+    # Exact membership test for user ids.  Ids that existed at startup are kept
+    # in a sorted array (8 bytes each), ids added since then in a small set.
+    def __init__(self, ids=()):
+        self._loaded = array('q', ids)
+        self._added = set()
+
+    def __contains__(self, user_id):
+        if user_id in self._added:
+            return True
+        index = bisect_left(self._loaded, user_id)
+        return index < len(self._loaded) and self._loaded[index] == user_id
+
+    def __len__(self):
+        return len(self._loaded) + len(self._added)
+
+    def add(self, user_id):
+        self._added.add(user_id)
+
+
+# Tables split across shard files by user, with the column that picks the
+# shard.  Their monthly archives follow the hot table.
+SHARDED_TABLES = {
+    'users': 'id',
+    'task_proofs': 'user_id',
+    'task_completions': 'user_id',
+    'boosters': 'user_id',
+}
+# Each shard numbers new proofs and completions from index << 40, so ids stay
+# unique across shards (proof_hashes and exports refer to them)
+SHARD_ID_SPACE = 1 << 40
+
+
+class Shard:
+    # One file of user-scoped tables and its connection.  Shard connections
+    # have the main file attached as 'shared', so statements that also touch
+    # referrals, outbox or withdrawals run unchanged, in one transaction.
+    def __init__(self, index, path, conn):
+        self.index = index
+        self.path = path
+        self.conn = conn
+        self.archive_months = {table: [] for table in ARCHIVE_SCHEMAS}
+
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('bot_database.db')
+    # With shards > 1, the tables in SHARDED_TABLES live in that many files
+    # next to path (bot_database.shard0.db, ...), picked by user id modulo
+    # the count.  Single-user calls touch one shard; calls over all users
+    # read the shards in parallel threads and merge.  Everything else stays
+    # in the main file.  The count is fixed once the database has been split.
+    def __init__(self, path='bot_database.db', shards=1):
+        self.path = path
+        # Read from pool threads too when sharded, see _open_shard
+        self.conn = sqlite3.connect(path, check_same_thread=shards == 1)
+        self._enable_incremental_vacuum(self.conn)
+        self._main = Shard(0, path, self.conn)
+        self.shards = [self._main]
+        self._pool = None
+        if shards > 1:
+            root, ext = os.path.splitext(path)
+            self.shards = [self._open_shard(index, f'{root}.shard{index}{ext}') for index in range(shards)]
+            self._pool = ThreadPoolExecutor(shards, thread_name_prefix='db-shard')
         self.create_tables()
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'shards'").fetchone()
+        split = row[0] if row else 1
+        if split != shards:
+            if split != 1:
+                raise ValueError(f"{path} is split into {split} shards, open it with shards={split}")
+            self._split_into_shards()
+        # Returning users are answered from memory and never open a write transaction
+        self.known_users = KnownUsers(heapq.merge(*self._fan_out(
+            lambda shard: array('q', (row[0] for row in shard.conn.execute("SELECT id FROM users ORDER BY id"))))))
+        self._load_tasks()
+
+    def _open_shard(self, index, path):
+        # Fan-out reads use the connection from a pool thread while the
+        # calling thread waits, never two threads at once
+        conn = sqlite3.connect(path, check_same_thread=False)
+        self._enable_incremental_vacuum(conn)
+        conn.execute("ATTACH DATABASE ? AS shared", (self.path,))
+        return Shard(index, path, conn)
+
+    def close(self):
+        for shard in self._stores():
+            shard.conn.close()
+        if self._pool:
+            self._pool.shutdown()
+
+    def _stores(self):
+        # Every file: the main one, then the shards
+        return [self._main] + [shard for shard in self.shards if shard is not self._main]
+
+    def _shard(self, user_id):
+        # Ids that are not numbers (a bad /start payload) all live in the first shard
+        try:
+            return self.shards[int(user_id) % len(self.shards)]
+        except (TypeError, ValueError):
+            return self.shards[0]
+
+    def _conn(self, user_id):
+        return self._shard(user_id).conn
+
+    def _fan_out(self, read, shards=None, parallel=True):
+        # [read(shard)] for every shard, in order.  Index lookups that take
+        # microseconds pass parallel=False: handing them to the pool costs
+        # more than running them one after the other.
+        shards = self.shards if shards is None else shards
+        if len(shards) == 1 or not parallel:
+            return [read(shard) for shard in shards]
+        return list(self._pool.map(read, shards))
+
+    def _enable_incremental_vacuum(self, conn):
+        # Lets the archiver hand pages freed by moved rows back to the file
+        # system a few at a time.  Switching an existing database over needs
+        # one full VACUUM, which runs once on the first start after upgrading.
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            log.info("incremental_vacuum_enabled")
 
     def create_tables(self):  
         with self.conn:  
-            self.conn.execute("""  
-            CREATE TABLE IF NOT EXISTS users (  
-                id INTEGER PRIMARY KEY,  
-                username TEXT,  
-                first_name TEXT,  
-                last_name TEXT,  
-                referral_link TEXT,  
-                referrer_id INTEGER,  
-                verified INTEGER DEFAULT 0,  
-                matic_balance INTEGER DEFAULT 0,  
-                matic_wallet TEXT,  
-                last_claim TIMESTAMP,  
-                double_mine_active INTEGER DEFAULT 0,  
-                double_mine_enabled INTEGER DEFAULT 0,  
-                time_speed_enabled INTEGER DEFAULT 0          
-            )""")  
-            
             self.conn.execute("""  
             CREATE TABLE IF NOT EXISTS referrals (  
                 id INTEGER PRIMARY KEY AUTOINCREMENT,  
@@ -32,34 +217,75 @@ class Database:
                 referred_id INTEGER  
             )""")  
 
-            # Add 'timestamp' column to make sure it's included correctly  
-            self.conn.execute('''  
-            CREATE TABLE IF NOT EXISTS new_referrals (  
-                referral_id INTEGER PRIMARY KEY AUTOINCREMENT,  
-                referrer_id INTEGER,  
-                referred_id INTEGER,  
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,  
-                FOREIGN KEY (referrer_id) REFERENCES users(id),  
-                FOREIGN KEY (referred_id) REFERENCES users(id)  
-            )''')  
-
-            # We need to check if the old referrals table has a 'timestamp' column   
-            # before copying data from it.  
+            # Add 'timestamp' column to make sure it's included correctly.
+            # Only needed once: rebuilding on every start would reset the timestamps
+            # and drop the unique index below.
+            referral_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(referrals)")]
+            if 'timestamp' not in referral_columns:
+                self.conn.execute('''  
+                CREATE TABLE IF NOT EXISTS new_referrals (  
+                    referral_id INTEGER PRIMARY KEY AUTOINCREMENT,  
+                    referrer_id INTEGER,  
+                    referred_id INTEGER,  
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,  
+                    FOREIGN KEY (referrer_id) REFERENCES users(id),  
+                    FOREIGN KEY (referred_id) REFERENCES users(id)  
+                )''')  
 
-            try:  
                 # Copy data from old referrals table to new referrals table  
                 self.conn.execute('''  
                 INSERT INTO new_referrals (referrer_id, referred_id, timestamp)  
                 SELECT referrer_id, referred_id, CURRENT_TIMESTAMP FROM referrals  
                 ''')  
-            except sqlite3.OperationalError:  
-                print("The column 'timestamp' does not exist in the 'referrals' table.")  
-            
-            # Drop the old referrals table  
-            self.conn.execute('DROP TABLE IF EXISTS referrals')  
 
-            # Rename the new referrals table to the old table name  
-            self.conn.execute('ALTER TABLE new_referrals RENAME TO referrals')  
+                # Drop the old referrals table  
+                self.conn.execute('DROP TABLE IF EXISTS referrals')  
+
+                # Rename the new referrals table to the old table name  
+                self.conn.execute('ALTER TABLE new_referrals RENAME TO referrals')  
+
+            # A user can only be referred once; keep the oldest row of any duplicates
+            # left over from repeated /start taps before adding the constraint
+            self.conn.execute('''
+            DELETE FROM referrals WHERE referral_id NOT IN (
+                SELECT MIN(referral_id) FROM referrals GROUP BY referred_id
+            )''')
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred_id ON referrals (referred_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer_id ON referrals (referrer_id)")
+
+            # Whole referral trees, kept in step with referrals by
+            # _link_referral: referral_closure has a row for every ancestor of
+            # every referred user, referral_levels counts each user's
+            # downstream per depth and referral_subtrees in total.  Chains,
+            # downstream counts and the largest trees are index lookups.
+            # Built from referrals on first run.
+            closure_table = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'referral_closure'").fetchone()
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS referral_closure (
+                ancestor_id INTEGER,
+                descendant_id INTEGER,
+                depth INTEGER,
+                PRIMARY KEY (ancestor_id, depth, descendant_id)
+            ) WITHOUT ROWID""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant ON referral_closure (descendant_id, depth)")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS referral_levels (
+                ancestor_id INTEGER,
+                depth INTEGER,
+                users INTEGER,
+                PRIMARY KEY (ancestor_id, depth)
+            ) WITHOUT ROWID""")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS referral_subtrees (
+                user_id INTEGER PRIMARY KEY,
+                downstream INTEGER
+            )""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_referral_subtrees_downstream ON referral_subtrees (downstream)")
+            if not closure_table:
+                self._build_referral_tree()
 
             self.conn.execute("""  
             CREATE TABLE IF NOT EXISTS tasks (  
@@ -67,55 +293,379 @@ class Database:
                 photo_file_id TEXT,  
                 description TEXT  
             )""")  
+            # Several tasks can be active at once; ended tasks stay for history
+            task_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(tasks)")]
+            if 'active' not in task_columns:
+                self.conn.execute("ALTER TABLE tasks ADD COLUMN active INTEGER DEFAULT 1")
+                self.conn.execute("ALTER TABLE tasks ADD COLUMN created_at TIMESTAMP")
             
-            self.conn.execute("""  
+            self._create_user_tables(self._main)
+
+            # Notifications are written in the same transaction as the state change
+            # that triggers them and delivered later by outbox.OutboxSender
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                text TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+            # A notification for every user is a single row here; OutboxSender
+            # expands it into outbox rows a batch at a time, in user id order
+            # after last_user_id, so queueing it never writes a row per user
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                last_user_id INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""")
+
+            # Perceptual hashes of task proofs, filled in by proofhash.ProofHasher.
+            # Rows outlive clear_task_proofs, so a screenshot that was already
+            # approved is still recognised when it comes back.
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS proof_hashes (
+                proof_id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                hash INTEGER,
+                duplicate_of INTEGER,
+                distance INTEGER
+            )""")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS proof_hash_bands (
+                band INTEGER,
+                value INTEGER,
+                proof_id INTEGER,
+                PRIMARY KEY (band, value, proof_id)
+            ) WITHOUT ROWID""")
+
+            # Withdrawal requests wait here as 'pending' until the payout team
+            # marks them 'completed'
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS withdrawals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                amount INTEGER,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                completed_at TIMESTAMP
+            )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals (status, id)")
+
+            # PTB user/chat/bot data and conversation states, written in batches
+            # by persistence.SQLitePersistence.  kind is 'user', 'chat', 'bot'
+            # or 'conversation:<handler name>'; data is pickled.
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS persistence (
+                kind TEXT,
+                key TEXT,
+                data BLOB,
+                PRIMARY KEY (kind, key)
+            ) WITHOUT ROWID""")
+
+            # Which storage layout the file is in: 'shards' is recorded once the
+            # user tables have been split out (see _split_into_shards)
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value
+            ) WITHOUT ROWID""")
+            if self.conn.execute("SELECT 1 FROM stat_totals LIMIT 1").fetchone() is None:
+                # First run with rollups: seed the totals from what is already there
+                self.conn.execute("""
+                INSERT INTO stat_totals (metric, value)
+                SELECT 'new_users', COUNT(*) FROM users
+                UNION ALL SELECT 'verifications', COUNT(*) FROM users WHERE verified = 1
+                UNION ALL SELECT 'referrals', COUNT(*) FROM referrals
+                UNION ALL SELECT 'task_proofs', COUNT(*) FROM task_proofs
+                """)
+        for shard in self.shards:
+            if shard is not self._main:
+                self._create_user_tables(shard)
+
+    def _split_into_shards(self):
+        # First start with shards: copies every user's rows from the main
+        # file into their shard, ids unchanged, then empties the main file's
+        # copies in the transaction that records the shard count.  A split
+        # that is cut short is simply done again on the next start.
+        count = len(self.shards)
+        tables = [(table, table, key) for table, key in SHARDED_TABLES.items()]
+        tables += [(f'{table}_archive_{month}', table, 'user_id')
+                   for table in ARCHIVE_SCHEMAS for month in self._main.archive_months[table]]
+        for shard in self.shards:
+            with shard.conn:
+                for name, table, key in tables:
+                    if name != table:
+                        self._archive_table(shard, table, name.rsplit('_', 1)[1])
+                    columns = ', '.join(row[1] for row in shard.conn.execute(f"PRAGMA shared.table_info({name})"))
+                    # Same placement as _shard: SQLite's % keeps the sign and
+                    # text ids count as 0
+                    shard.conn.execute(f"""
+                    INSERT OR REPLACE INTO main.{name} ({columns}) SELECT {columns} FROM shared.{name}
+                    WHERE coalesce(({key} % ? + ?) % ?, 0) = ?""", (count, count, count, shard.index))
+                shard.conn.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+                for table in ('task_proofs', 'task_completions'):
+                    shared = shard.conn.execute("SELECT seq FROM shared.sqlite_sequence WHERE name = ?", (table,)).fetchone()
+                    seq = max(shared[0] if shared else 0, shard.index * SHARD_ID_SPACE)
+                    if not shard.conn.execute(
+                            "UPDATE main.sqlite_sequence SET seq = max(seq, ?) WHERE name = ?", (seq, table)).rowcount:
+                        shard.conn.execute("INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)", (table, seq))
+        with self.conn:
+            for name, table, key in tables:
+                if name == table:
+                    self.conn.execute(f"DELETE FROM {name}")
+                else:
+                    self.conn.execute(f"DROP TABLE {name}")
+            self.conn.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+            self.conn.execute("INSERT INTO settings (key, value) VALUES ('shards', ?)", (count,))
+        self._main.archive_months = {table: [] for table in ARCHIVE_SCHEMAS}
+        log.info("database_split", shards=count, tables=len(tables))
+
+    def _create_user_tables(self, shard):
+        # Tables holding one user's rows, created in every shard.  In the main
+        # file they hold everything when the database is not sharded, and
+        # are kept empty once it is.
+        conn = shard.conn
+        with conn:
+            conn.execute("""  
+            CREATE TABLE IF NOT EXISTS users (  
+                id INTEGER PRIMARY KEY,  
+                username TEXT,  
+                first_name TEXT,  
+                last_name TEXT,  
+                referral_link TEXT,  
+                referrer_id INTEGER,  
+                verified INTEGER DEFAULT 0,  
+                matic_balance INTEGER DEFAULT 0,  
+                matic_wallet TEXT,  
+                last_claim TIMESTAMP,  
+                double_mine_active INTEGER DEFAULT 0,  
+                double_mine_enabled INTEGER DEFAULT 0,  
+                time_speed_enabled INTEGER DEFAULT 0          
+            )""")  
+            
+            # Wallets are compared by value, so bring addresses saved before
+            # normalization into the stored form once, before indexing them.
+            # Not unique: accounts already sharing a wallet stay reportable.
+            wallet_index = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_users_matic_wallet'").fetchone()
+            if not wallet_index:
+                conn.execute("""
+                UPDATE users SET matic_wallet = '0x' || lower(substr(trim(matic_wallet), -40))
+                WHERE length(trim(matic_wallet)) = 40 AND trim(matic_wallet) NOT GLOB '*[^0-9a-fA-F]*'
+                   OR length(trim(matic_wallet)) = 42 AND lower(substr(trim(matic_wallet), 1, 2)) = '0x'
+                      AND substr(trim(matic_wallet), 3) NOT GLOB '*[^0-9a-fA-F]*'""")
+                conn.execute("CREATE INDEX idx_users_matic_wallet ON users (matic_wallet)")
+
+            # Admin user search over names.  External content: the index holds
+            # only the tokens and is kept in step by add_user and
+            # update_user_info; built from the users table on first run.
+            # Prefix indexes up to six characters keep short, common prefixes
+            # from merging thousands of terms per query.
+            search_index = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'").fetchone()
+            if not search_index:
+                conn.execute("""
+                CREATE VIRTUAL TABLE users_search USING fts5(
+                    username, first_name, last_name,
+                    content = 'users', content_rowid = 'id',
+                    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4 5 6'
+                )""")
+                conn.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+
+            conn.execute("""  
             CREATE TABLE IF NOT EXISTS task_proofs (  
                 id INTEGER PRIMARY KEY AUTOINCREMENT,  
                 user_id INTEGER,  
                 photo_file_id TEXT,  
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP  
             )""")  
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_task_proofs_timestamp ON task_proofs (timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_task_proofs_user_id ON task_proofs (user_id)")
+            # Proofs marked reviewed are moved to the archive by Archiver
+            proof_columns = [row[1] for row in conn.execute("PRAGMA table_info(task_proofs)")]
+            if 'reviewed_at' not in proof_columns:
+                conn.execute("ALTER TABLE task_proofs ADD COLUMN reviewed_at TIMESTAMP")
+            if 'task_id' not in proof_columns:
+                conn.execute("ALTER TABLE task_proofs ADD COLUMN task_id INTEGER")
             
-            self.conn.execute("""  
+            conn.execute("""  
             CREATE TABLE IF NOT EXISTS task_completions (  
                 id INTEGER PRIMARY KEY AUTOINCREMENT,  
                 user_id INTEGER  
             )""")
+            # Completions record their task, so posting a new task no longer has
+            # to delete them; rows from before this belong to the current task
+            completion_columns = [row[1] for row in conn.execute("PRAGMA table_info(task_completions)")]
+            if 'task_id' not in completion_columns:
+                conn.execute("ALTER TABLE task_completions ADD COLUMN task_id INTEGER")
+                conn.execute("ALTER TABLE task_completions ADD COLUMN completed_at TIMESTAMP")
+                conn.execute("UPDATE task_completions SET task_id = (SELECT MAX(id) FROM tasks)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_task_completions_task_user ON task_completions (task_id, user_id)")
+
+            shard.archive_months = {table: [] for table in ARCHIVE_SCHEMAS}
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"):
+                match = ARCHIVE_NAME_RE.fullmatch(name)
+                if match:
+                    shard.archive_months[match.group(1)].append(match.group(2))
+            # Archive tables mirror their hot table column for column
+            for month in shard.archive_months['task_proofs']:
+                name = f'task_proofs_archive_{month}'
+                if 'task_id' not in [row[1] for row in conn.execute(f"PRAGMA table_info({name})")]:
+                    conn.execute(f"ALTER TABLE {name} ADD COLUMN task_id INTEGER")
+
+            # Boosters bought from the Boosters menu, one row per active effect.
+            # Expired rows are ignored by claims and deleted by the periodic
+            # sweep in boosters.BoosterSweeper.
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS boosters (
+                user_id INTEGER,
+                effect TEXT,
+                value REAL,
+                expires_at REAL,
+                PRIMARY KEY (user_id, effect)
+            ) WITHOUT ROWID""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_boosters_expires_at ON boosters (expires_at)")
+
+            # Admin stats are rolled up as events happen, so reading them never
+            # scans the event tables
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT,
+                metric TEXT,
+                value INTEGER DEFAULT 0,
+                PRIMARY KEY (day, metric)
+            ) WITHOUT ROWID""")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS stat_totals (
+                metric TEXT PRIMARY KEY,
+                value INTEGER DEFAULT 0
+            ) WITHOUT ROWID""")
+
+    def _build_referral_tree(self):
+        # Walks up from every referred user once.  Loops left in old data
+        # (a referred b, b referred a) are cut where the walk meets itself.
+        parents = dict(self.conn.execute(
+            "SELECT referred_id, referrer_id FROM referrals WHERE typeof(referrer_id) = 'integer'"))
+
+        def closure_rows():
+            for user_id, ancestor_id in parents.items():
+                seen = {user_id}
+                depth = 1
+                while ancestor_id is not None and ancestor_id not in seen:
+                    yield ancestor_id, user_id, depth
+                    seen.add(ancestor_id)
+                    ancestor_id = parents.get(ancestor_id)
+                    depth += 1
+
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth) VALUES (?, ?, ?)",
+            closure_rows())
+        self.conn.execute("""
+        INSERT INTO referral_levels (ancestor_id, depth, users)
+        SELECT ancestor_id, depth, COUNT(*) FROM referral_closure GROUP BY ancestor_id, depth""")
+        self.conn.execute("""
+        INSERT INTO referral_subtrees (user_id, downstream)
+        SELECT ancestor_id, SUM(users) FROM referral_levels GROUP BY ancestor_id""")
+
+    def _link_referral(self, conn, referrer_id, referred_id):
+        # Hangs referred_id, with anything already below it, under referrer_id
+        # and every ancestor of referrer_id.  Runs inside the transaction that
+        # records the referral.  A new user has nothing below it, so this
+        # writes one closure row per ancestor.
+        try:
+            # /start payloads arrive as text
+            referrer_id, referred_id = int(referrer_id), int(referred_id)
+        except ValueError:
+            return
+        if referrer_id == referred_id or conn.execute(
+                "SELECT 1 FROM referral_closure WHERE descendant_id = ? AND ancestor_id = ?",
+                (referrer_id, referred_id)).fetchone():
+            log.warning("referral_loop_ignored", referrer_id=referrer_id, referred_id=referred_id)
+            return
+        ancestors = """
+        (SELECT ? AS ancestor_id, 0 AS depth
+         UNION ALL SELECT ancestor_id, depth FROM referral_closure WHERE descendant_id = ?)"""
+        params = (referrer_id, referrer_id, referred_id)
+        # Levels and totals first: they read referred_id's own counts, which
+        # the new closure rows do not change
+        conn.execute(f"""
+        INSERT INTO referral_levels (ancestor_id, depth, users)
+        SELECT a.ancestor_id, a.depth + d.depth + 1, d.users
+        FROM {ancestors} a,
+        (SELECT 0 AS depth, 1 AS users UNION ALL SELECT depth, users FROM referral_levels WHERE ancestor_id = ?) d
+        WHERE true
+        ON CONFLICT (ancestor_id, depth) DO UPDATE SET users = users + excluded.users""", params)
+        conn.execute(f"""
+        INSERT INTO referral_subtrees (user_id, downstream)
+        SELECT ancestor_id, 1 + coalesce((SELECT downstream FROM referral_subtrees WHERE user_id = ?), 0)
+        FROM {ancestors}
+        WHERE true
+        ON CONFLICT (user_id) DO UPDATE SET downstream = downstream + excluded.downstream""",
+            (referred_id, referrer_id, referrer_id))
+        conn.execute(f"""
+        INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+        FROM {ancestors} a,
+        (SELECT ? AS descendant_id, 0 AS depth
+         UNION ALL SELECT descendant_id, depth FROM referral_closure WHERE ancestor_id = ?) d""",
+            params + (referred_id,))
 
     def deduct_matic_balance(self, user_id, amount):
-        with self.conn:
-            cursor = self.conn.cursor()
+        conn = self._conn(user_id)
+        with conn:
+            cursor = conn.cursor()
             cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
             current_balance = cursor.fetchone()[0]
 
             if current_balance >= amount:
-                self.conn.execute("UPDATE users SET matic_balance = matic_balance - ? WHERE id = ?", (amount, user_id))
-                print(f"Deducted {amount} MATIC coins from user {user_id}")
+                conn.execute("UPDATE users SET matic_balance = matic_balance - ? WHERE id = ?", (amount, user_id))
+                log.info("matic_deducted", user_id=user_id, amount=amount)
             else:
-                print("Insufficient MATIC balance to perform deduction.")
+                log.info("matic_deduction_refused", user_id=user_id, amount=amount, balance=current_balance)
 
     def add_user(self, user_id, username, first_name, last_name, referral_link, referrer_id):
-        with self.conn:
-            self.conn.execute("""
+        if user_id in self.known_users:
+            return
+        conn = self._conn(user_id)
+        with conn:
+            cursor = conn.execute("""
             INSERT OR IGNORE INTO users (id, username, first_name, last_name, referral_link, referrer_id)
             VALUES (?, ?, ?, ?, ?, ?)""",
             (user_id, username, first_name, last_name, referral_link, referrer_id))
-            if referrer_id:
-                self.conn.execute("""
-                INSERT INTO referrals (referrer_id, referred_id)
+            if cursor.rowcount:
+                self._bump_stat(conn, 'new_users')
+                conn.execute(
+                    "INSERT INTO users_search (rowid, username, first_name, last_name) VALUES (?, ?, ?, ?)",
+                    (user_id, username, first_name, last_name))
+            # Only a brand new user can be referred
+            if referrer_id and cursor.rowcount:
+                cursor = conn.execute("""
+                INSERT OR IGNORE INTO referrals (referrer_id, referred_id)
                 VALUES (?, ?)""",
                 (referrer_id, user_id))
+                if cursor.rowcount:
+                    self._bump_stat(conn, 'referrals')
+                    self._link_referral(conn, referrer_id, user_id)
+        self.known_users.add(user_id)
 
     def is_user_verified(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self._conn(user_id).cursor()
         cursor.execute("SELECT verified FROM users WHERE id = ?", (user_id,))
         result = cursor.fetchone()
         return result and result[0] == 1
 
     def verify_user(self, user_id):
-        with self.conn:
+        conn = self._conn(user_id)
+        with conn:
             
-            cursor = self.conn.cursor()
+            cursor = conn.cursor()
             cursor.execute("SELECT verified FROM users WHERE id = ?", (user_id,))
             result = cursor.fetchone()
             
@@ -123,29 +673,114 @@ class Database:
                 return  # User is already verified, do nothing
             
             # Otherwise, update user verification status
-            self.conn.execute("UPDATE users SET verified = 1 WHERE id = ?", (user_id,))
+            if not conn.execute("UPDATE users SET verified = 1 WHERE id = ?", (user_id,)).rowcount:
+                return
+            self._bump_stat(conn, 'verifications')
 
             # Check if this is the first verification
             cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
             current_balance = cursor.fetchone()[0]
             if current_balance == 0:
                 # If user has 0 MATIC balance, reward them with 3 MATIC
-                self.conn.execute("UPDATE users SET matic_balance = matic_balance + 3 WHERE id = ?", (user_id,))
+                conn.execute("UPDATE users SET matic_balance = matic_balance + 3 WHERE id = ?", (user_id,))
 
 
 
     def update_wallet_address(self, user_id, address):
-        with self.conn:
-            self.conn.execute("UPDATE users SET matic_wallet = ? WHERE id = ?", (address, user_id))
-    
+        # The duplicate check and the write are one statement, so two accounts
+        # submitting the same wallet at once cannot both succeed.  Returns
+        # False when another account already uses the address.  With shards,
+        # the other shards are checked first; writes all come from one
+        # thread, so no other account can take the address in between.
+        taken = len(self.shards) > 1 and any(self._fan_out(lambda shard: shard.conn.execute(
+            "SELECT 1 FROM users WHERE matic_wallet = ? AND id != ?", (address, user_id)).fetchone(), parallel=False))
+        if not taken:
+            conn = self._conn(user_id)
+            with conn:
+                taken = not conn.execute("""
+                UPDATE users SET matic_wallet = ?
+                WHERE id = ? AND NOT EXISTS (SELECT 1 FROM users WHERE matic_wallet = ? AND id != ?)""",
+                    (address, user_id, address, user_id)).rowcount
+        if taken:
+            log.warning("duplicate_wallet_refused", user_id=user_id, wallet=address)
+        return not taken
+
+    def get_wallet_clusters(self, limit=20):
+        # Wallets shared by several accounts, largest first: (wallet, accounts,
+        # comma separated user ids).  Grouped over idx_users_matic_wallet.
+        if len(self.shards) == 1:
+            return self.conn.execute("""
+            SELECT matic_wallet, COUNT(*) AS accounts, group_concat(id)
+            FROM users INDEXED BY idx_users_matic_wallet
+            WHERE matic_wallet IS NOT NULL
+            GROUP BY matic_wallet
+            HAVING accounts > 1
+            ORDER BY accounts DESC
+            LIMIT ?""", (limit,)).fetchall()
+        # A wallet can be shared across shards: every shard's wallets are
+        # merged in address order, holding one wallet at a time
+        streams = [shard.conn.execute("""
+            SELECT matic_wallet, COUNT(*), group_concat(id)
+            FROM users INDEXED BY idx_users_matic_wallet
+            WHERE matic_wallet IS NOT NULL
+            GROUP BY matic_wallet
+            ORDER BY matic_wallet""") for shard in self.shards]
+        clusters = []
+        for wallet, rows in groupby(heapq.merge(*streams), key=itemgetter(0)):
+            rows = list(rows)
+            accounts = sum(row[1] for row in rows)
+            if accounts > 1:
+                clusters.append((wallet, accounts, ','.join(row[2] for row in rows)))
+        return sorted(clusters, key=itemgetter(1), reverse=True)[:limit]
+
+    def get_referrer_clusters(self, limit=20):
+        # Referrers whose referred accounts collapse onto few wallets: (referrer
+        # id, referred accounts with a wallet, distinct wallets among them,
+        # referred accounts using the referrer's own wallet).  Grouped over
+        # idx_referrals_referrer_id.
+        if len(self.shards) == 1:
+            return self.conn.execute("""
+            SELECT r.referrer_id, COUNT(*) AS referred, COUNT(DISTINCT u.matic_wallet) AS wallets,
+                   SUM(u.matic_wallet = ref.matic_wallet) AS own_wallet
+            FROM referrals r INDEXED BY idx_referrals_referrer_id
+            JOIN users u ON u.id = r.referred_id
+            LEFT JOIN users ref ON ref.id = r.referrer_id
+            WHERE u.matic_wallet IS NOT NULL
+            GROUP BY r.referrer_id
+            HAVING wallets < referred OR own_wallet > 0
+            ORDER BY referred - wallets + own_wallet DESC
+            LIMIT ?""", (limit,)).fetchall()
+        # Referred users sit in every shard and the referrer in one: each
+        # shard lists its referred wallets in referrer order, and the merged
+        # stream is walked next to all wallets in id order
+        referred = heapq.merge(*(shard.conn.execute("""
+            SELECT r.referrer_id, u.matic_wallet
+            FROM referrals r INDEXED BY idx_referrals_referrer_id
+            JOIN users u ON u.id = r.referred_id
+            WHERE u.matic_wallet IS NOT NULL AND typeof(r.referrer_id) = 'integer'
+            ORDER BY r.referrer_id""") for shard in self.shards))
+        wallets = heapq.merge(*(shard.conn.execute(
+            "SELECT id, matic_wallet FROM users WHERE matic_wallet IS NOT NULL ORDER BY id") for shard in self.shards))
+        own = next(wallets, None)
+        clusters = []
+        for referrer_id, rows in groupby(referred, key=itemgetter(0)):
+            referred_wallets = [wallet for _, wallet in rows]
+            while own is not None and own[0] < referrer_id:
+                own = next(wallets, None)
+            own_wallet = referred_wallets.count(own[1]) if own is not None and own[0] == referrer_id else 0
+            distinct = len(set(referred_wallets))
+            if distinct < len(referred_wallets) or own_wallet:
+                clusters.append((referrer_id, len(referred_wallets), distinct, own_wallet))
+        return sorted(clusters, key=lambda row: row[1] - row[2] + row[3], reverse=True)[:limit]
+
+
     def get_all_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id FROM users")
-        return [row[0] for row in cursor.fetchall()]
+        return [user_id for ids in self._fan_out(
+            lambda shard: [row[0] for row in shard.conn.execute("SELECT id FROM users")]) for user_id in ids]
 
 
     def get_user_data(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self._conn(user_id).cursor()
         cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
         result = cursor.fetchone()
 
@@ -169,18 +804,94 @@ class Database:
             return None
 
     def get_user_matic_balance(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self._conn(user_id).cursor()
         cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
         result = cursor.fetchone()
         return result[0] if result else 0
 
-    def update_matic_balance(self, user_id, amount):
+    def withdraw_matic_balance(self, user_id, amount):
+        # Deducts and queues the request in one transaction; returns the
+        # withdrawal id, or None when the balance no longer covers the amount
+        conn = self._conn(user_id)
+        with conn:
+            cursor = conn.execute(
+                "UPDATE users SET matic_balance = matic_balance - ? WHERE id = ? AND matic_balance >= ?",
+                (amount, user_id, amount))
+            if not cursor.rowcount:
+                return None
+            cursor = conn.execute("INSERT INTO withdrawals (user_id, amount) VALUES (?, ?)", (user_id, amount))
+            self._bump_stat(conn, 'withdrawals')
+            self._bump_stat(conn, 'withdrawn_matic', amount)
+            return cursor.lastrowid
+
+    def iter_pending_withdrawals(self, batch_size=1000):
+        # Yields (id, user_id, username, amount, matic_wallet, created_at) in
+        # id order, batch_size rows at a time, so an export of any size holds
+        # one batch in memory.  Uses its own connections, so it can run in a
+        # worker thread while the bot keeps writing.
+        conn = sqlite3.connect(self.path)
+        shard_conns = [conn] if len(self.shards) == 1 else [sqlite3.connect(shard.path) for shard in self.shards]
+        try:
+            last_id = 0
+            while True:
+                rows = conn.execute("""
+                SELECT id, user_id, amount, created_at FROM withdrawals
+                WHERE status = 'pending' AND id > ?
+                ORDER BY id LIMIT ?""", (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                users = self._lookup_users(shard_conns, {row[1] for row in rows}, 'username, matic_wallet')
+                for withdrawal_id, user_id, amount, created_at in rows:
+                    username, wallet = users.get(user_id, (None, None))
+                    yield withdrawal_id, user_id, username, amount, wallet, created_at
+                last_id = rows[-1][0]
+        finally:
+            for shard_conn in {conn, *shard_conns}:
+                shard_conn.close()
+
+    def _lookup_users(self, conns, user_ids, columns):
+        # {user id: (columns...)} for the given ids, one IN query per shard;
+        # conns are connections to the shards, in shard order
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(self._shard(user_id).index, []).append(user_id)
+        found = {}
+        for index, ids in by_shard.items():
+            placeholders = ', '.join('?' * len(ids))
+            for row in conns[index].execute(f"SELECT id, {columns} FROM users WHERE id IN ({placeholders})", ids):
+                found[row[0]] = row[1:]
+        return found
+
+    def complete_withdrawals(self, through_id, notify=None):
+        # Marks every pending withdrawal up to through_id (the last id of an
+        # export) completed in a single transaction; returns how many
         with self.conn:
-            self.conn.execute("UPDATE users SET matic_balance = matic_balance + ? WHERE id = ?", (amount, user_id))
+            if notify:
+                self.conn.execute("""
+                INSERT INTO outbox (chat_id, text)
+                SELECT user_id, ? FROM withdrawals WHERE status = 'pending' AND id <= ?""", (notify, through_id))
+            cursor = self.conn.execute("""
+            UPDATE withdrawals SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+            WHERE status = 'pending' AND id <= ?""", (through_id,))
+        log.info("withdrawals_completed", through_id=through_id, count=cursor.rowcount)
+        return cursor.rowcount
+
+    def get_pending_withdrawal_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM withdrawals WHERE status = 'pending'").fetchone()[0]
+
+    def update_matic_balance(self, user_id, amount, notify=None):
+        conn = self._conn(user_id)
+        with conn:
+            cursor = conn.execute("UPDATE users SET matic_balance = matic_balance + ? WHERE id = ?", (amount, user_id))
+            if notify and cursor.rowcount:
+                self._enqueue_notification(conn, user_id, notify)
 
     def add_referral(self, referrer_id, referred_id):
         with self.conn:
-            self.conn.execute("INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referrer_id, referred_id))
+            cursor = self.conn.execute("INSERT OR IGNORE INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referrer_id, referred_id))
+            if cursor.rowcount:
+                self._bump_stat(self.conn, 'referrals')
+                self._link_referral(self.conn, referrer_id, referred_id)
 
     def get_referral_count(self, user_id):
         cursor = self.conn.cursor()
@@ -189,35 +900,111 @@ class Database:
         return result[0] if result else 0
     
     def get_referrer_id(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self._conn(user_id).cursor()
         cursor.execute("SELECT referrer_id FROM users WHERE id = ?", (user_id,))
         result = cursor.fetchone()
         return result[0] if result else None
 
-    def reward_referrer(self, referrer_id, amount):
-        with self.conn:
-            self.conn.execute("UPDATE users SET matic_balance = matic_balance + ? WHERE id = ?", (amount, referrer_id))
+    def reward_referrer(self, referrer_id, amount, notify=None):
+        conn = self._conn(referrer_id)
+        with conn:
+            cursor = conn.execute("UPDATE users SET matic_balance = matic_balance + ? WHERE id = ?", (amount, referrer_id))
+            if notify and cursor.rowcount:
+                self._enqueue_notification(conn, referrer_id, notify)
 
 
     def get_last_claim_time(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self._conn(user_id).cursor()
         cursor.execute("SELECT last_claim FROM users WHERE id = ?", (user_id,))
         result = cursor.fetchone()
         if result and result[0]:
-            try:
-                return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S.%f')
-            except ValueError:
-                return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S')
+            return parse_timestamp(result[0])
         return None
     def get_total_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        result = cursor.fetchone()
-        return result[0] if result else 0
+        return sum(self._fan_out(lambda shard: shard.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]))
 
     def update_last_claim_time(self, user_id):
-        with self.conn:
-            self.conn.execute("UPDATE users SET last_claim = ? WHERE id = ?", (datetime.now(), user_id))
+        conn = self._conn(user_id)
+        with conn:
+            conn.execute("UPDATE users SET last_claim = ? WHERE id = ?", (datetime.now(), user_id))
+            self._bump_stat(conn, 'claims')
+
+    def claim_matic(self, user_id):
+        # Returns (reward, wait): the MATIC credited and the cooldown until the
+        # next claim, or reward 0 and the time still left.  The user's active
+        # boosters are read in the same statement as the last claim.
+        now = datetime.now()
+        expires_after = time.time()
+        conn = self._conn(user_id)
+        row = conn.execute("""
+        SELECT last_claim,
+            (SELECT value FROM boosters WHERE user_id = users.id AND effect = 'double_mine' AND expires_at > ?),
+            (SELECT value FROM boosters WHERE user_id = users.id AND effect = 'time_speed' AND expires_at > ?)
+        FROM users WHERE id = ?""", (expires_after, expires_after, user_id)).fetchone()
+        if row is None:
+            return 0, None
+        last_claim, multiplier, cooldown_hours = row
+        reward = int(CLAIM_REWARD * (multiplier or 1))
+        cooldown = timedelta(hours=cooldown_hours) if cooldown_hours else CLAIM_COOLDOWN
+        if last_claim and now - parse_timestamp(last_claim) < cooldown:
+            return 0, cooldown - (now - parse_timestamp(last_claim))
+        with conn:
+            # Only the first of two simultaneous claims finds last_claim unchanged
+            cursor = conn.execute(
+                "UPDATE users SET matic_balance = matic_balance + ?, last_claim = ? WHERE id = ? AND last_claim IS ?",
+                (reward, now, user_id, last_claim))
+            if not cursor.rowcount:
+                return 0, cooldown
+            self._bump_stat(conn, 'claims')
+        return reward, cooldown
+
+    def activate_booster(self, user_id, effect, cost, duration):
+        # Charges cost and starts (or restarts) the effect for duration seconds
+        # in one transaction; returns the expiry time, or None when the
+        # balance does not cover the cost
+        expires_at = time.time() + duration
+        conn = self._conn(user_id)
+        with conn:
+            cursor = conn.execute(
+                "UPDATE users SET matic_balance = matic_balance - ? WHERE id = ? AND matic_balance >= ?",
+                (cost, user_id, cost))
+            if not cursor.rowcount:
+                log.info("booster_refused", user_id=user_id, effect=effect, cost=cost)
+                return None
+            conn.execute("""
+            INSERT INTO boosters (user_id, effect, value, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, effect) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            """, (user_id, effect, BOOSTERS[effect], expires_at))
+            flags = ', '.join(f"{column} = 1" for column in BOOSTER_FLAGS[effect])
+            conn.execute(f"UPDATE users SET {flags} WHERE id = ?", (user_id,))
+            self._bump_stat(conn, 'boosters')
+        log.info("booster_activated", user_id=user_id, effect=effect, expires_at=expires_at)
+        return expires_at
+
+    def get_active_boosters(self, user_id):
+        # {effect: expires_at} for the user's boosters that have not expired
+        cursor = self._conn(user_id).execute(
+            "SELECT effect, expires_at FROM boosters WHERE user_id = ? AND expires_at > ?", (user_id, time.time()))
+        return dict(cursor.fetchall())
+
+    def expire_boosters(self, notify=None):
+        # Ends every booster past its expiry in one transaction, whoever owns
+        # it.  notify maps an effect to the message queued for its owners.
+        # One transaction per shard.
+        now = time.time()
+        expired = 0
+        for shard in self.shards:
+            with shard.conn:
+                for effect, text in (notify or {}).items():
+                    shard.conn.execute(
+                        "INSERT INTO outbox (chat_id, text) SELECT user_id, ? FROM boosters WHERE effect = ? AND expires_at <= ?",
+                        (text, effect, now))
+                for effect, columns in BOOSTER_FLAGS.items():
+                    flags = ', '.join(f"{column} = 0" for column in columns)
+                    shard.conn.execute(f"UPDATE users SET {flags} WHERE id IN "
+                                       "(SELECT user_id FROM boosters WHERE effect = ? AND expires_at <= ?)", (effect, now))
+                expired += shard.conn.execute("DELETE FROM boosters WHERE expires_at <= ?", (now,)).rowcount
+        return expired
 
     def add_task_proof(self, user_id, task_proof):
         with self.conn:
@@ -226,33 +1013,101 @@ class Database:
     
 
     def user_has_joined_channels(self, user_id):
-        cursor = self.conn.cursor()
+        cursor = self._conn(user_id).cursor()
         cursor.execute("SELECT verified FROM users WHERE id = ?", (user_id,))
         result = cursor.fetchone()
         return result and result[0] == 1
 
     def update_user_info(self, user_id, first_name, last_name, username):
-        with self.conn:
-            self.conn.execute("""
+        # Called for every update, so it only writes when a name changed;
+        # True when it did
+        conn = self._conn(user_id)
+        row = conn.execute("SELECT first_name, last_name, username FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is None or row == (first_name, last_name, username):
+            return False
+        with conn:
+            # The search index forgets the old names before they are overwritten
+            conn.execute("""
+            INSERT INTO users_search (users_search, rowid, username, first_name, last_name)
+            SELECT 'delete', id, username, first_name, last_name FROM users WHERE id = ?
+            """, (user_id,))
+            cursor = conn.execute("""
             UPDATE users
             SET first_name = ?, last_name = ?, username = ?
             WHERE id = ?
             """, (first_name, last_name, username, user_id))
+            if cursor.rowcount:
+                conn.execute(
+                    "INSERT INTO users_search (rowid, username, first_name, last_name) VALUES (?, ?, ?, ?)",
+                    (user_id, username, first_name, last_name))
+        return True
+
+    def search_users(self, text, after_id=0, limit=10):
+        # Users whose username, first or last name start with every word of
+        # text, in id order from after_id: (id, username, first_name,
+        # last_name, matic_balance, referrals, verified).  On the first page
+        # a numeric text also matches the user with that id, listed first.
+        # Each shard returns its first `limit` matches; merged by id.
+        select = """
+        SELECT u.id, u.username, u.first_name, u.last_name, u.matic_balance,
+            (SELECT COUNT(*) FROM referrals WHERE referrer_id = u.id), u.verified
+        FROM users u"""
+        terms = search_terms(text)
+        if not terms:
+            return []
+        rows = list(heapq.merge(*self._fan_out(lambda shard: shard.conn.execute(select + """
+        JOIN users_search s ON s.rowid = u.id
+        WHERE users_search MATCH ? AND s.rowid > ?
+        ORDER BY s.rowid LIMIT ?""", (terms, after_id, limit)).fetchall(), parallel=False)))[:limit]
+        if not after_id and text.strip().isdigit():
+            user_id = int(text)
+            exact = self._conn(user_id).execute(select + " WHERE u.id = ?", (user_id,)).fetchall()
+            rows = exact + [row for row in rows if row[0] != user_id]
+        return rows
+
+    def _load_tasks(self):
+        # The active catalogue and, per active task, the users who completed
+        # it are kept in memory, so listing tasks and checking completion on
+        # every tap never reads the database.  task_version changes whenever
+        # the catalogue does.
+        self.tasks = self.conn.execute(
+            "SELECT id, photo_file_id, description FROM tasks WHERE active = 1 AND photo_file_id IS NOT NULL ORDER BY id").fetchall()
+        self.task_completions = {
+            task_id: KnownUsers(heapq.merge(*self._fan_out(lambda shard: [row[0] for row in shard.conn.execute(
+                "SELECT user_id FROM task_completions WHERE task_id = ? ORDER BY user_id", (task_id,))])))
+            for task_id, _, _ in self.tasks
+        }
+        self.task_version = getattr(self, 'task_version', 0) + 1
 
     def get_tasks(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT photo_file_id, description FROM tasks")
-        return cursor.fetchall()
+        # Active tasks as (id, photo_file_id, description), oldest first
+        return self.tasks
 
     def clear_task_proofs(self):
-        cursor = self.conn.cursor()
-        cursor.execute("DELETE FROM task_proofs WHERE id IN (SELECT id FROM task_proofs ORDER BY id LIMIT 15)")
-        self.conn.commit()
+        # The 15 proofs get_task_proofs showed are marked reviewed and left for
+        # the archiver, instead of being deleted
+        by_shard = {}
+        for _, proof_id, index, _ in self._unreviewed_proofs(15):
+            by_shard.setdefault(index, []).append(proof_id)
+        reviewed_at = datetime.now()
+        for index, ids in by_shard.items():
+            conn = self.shards[index].conn
+            with conn:
+                conn.execute(
+                    f"UPDATE task_proofs SET reviewed_at = ? WHERE id IN ({', '.join('?' * len(ids))})",
+                    [reviewed_at] + ids)
+
+    def mark_proofs_reviewed(self, user_id):
+        conn = self._conn(user_id)
+        with conn:
+            conn.execute(
+                "UPDATE task_proofs SET reviewed_at = ? WHERE user_id = ? AND reviewed_at IS NULL", (datetime.now(), user_id))
 
     
     def update_claim_time(self, user_id, time_delta):
-        with self.conn:
-            cursor = self.conn.cursor()
+        conn = self._conn(user_id)
+        with conn:
+            cursor = conn.cursor()
             cursor.execute("SELECT last_claim FROM users WHERE id = ?", (user_id,))
             last_claim_time = cursor.fetchone()[0]
 
@@ -266,47 +1121,208 @@ class Database:
             # Convert the new_claim_time back to a string before storing it in the database
             new_claim_time_str = new_claim_time.strftime('%Y-%m-%d %H:%M:%S.%f')
 
-            self.conn.execute("UPDATE users SET last_claim = ? WHERE id = ?", (new_claim_time_str, user_id))
-            print(f"Updated claim time for user {user_id} to {new_claim_time_str}")
+            conn.execute("UPDATE users SET last_claim = ? WHERE id = ?", (new_claim_time_str, user_id))
+            log.info("claim_time_updated", user_id=user_id, last_claim=new_claim_time_str)
 
-    def activate_double_mine(self, user_id):
+    def save_task(self, photo_file_id, description, notify=None):
+        # Adds an active task next to the existing ones; returns its id.  The
+        # notification for every user is queued as one broadcast row.
         with self.conn:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
-            current_balance = cursor.fetchone()[0]
-    def enable_time_speed(self, user_id):
-        with self.conn:
-            self.conn.execute("UPDATE users SET time_speed_enabled = 1 WHERE id = ?", (user_id,))
+            cursor = self.conn.execute(
+                "INSERT INTO tasks (photo_file_id, description, active, created_at) VALUES (?, ?, 1, ?)",
+                (photo_file_id, description, datetime.now()))
+            if notify:
+                self.conn.execute("INSERT INTO outbox_broadcasts (text) VALUES (?)", (notify,))
+        self._load_tasks()
+        return cursor.lastrowid
 
-    def enable_double_mine(self, user_id):
-        with self.conn:
-            self.conn.execute("UPDATE users SET double_mine_enabled = 1 WHERE id = ?", (user_id,))
-    def save_task(self, photo_file_id, description):
-        with self.conn:
-            self.conn.execute("DELETE FROM tasks")
-            self.conn.execute("DELETE FROM task_completions")
-            self.conn.execute("INSERT INTO tasks (photo_file_id, description) VALUES (?, ?)", (photo_file_id, description))
-    def save_task_proof(self, user_id, photo_file_id):
+    def end_task(self, task_id):
+        # Completions of an ended task are left for Archiver to move
         with self.conn:
-            self.conn.execute("INSERT INTO task_proofs (user_id, photo_file_id, timestamp) VALUES (?, ?, ?)", (user_id, photo_file_id, datetime.now()))
-    def save_task_completion(self, user_id):
-        with self.conn:
-            self.conn.execute("INSERT INTO task_completions (user_id) VALUES (?)", (user_id,))
-    def has_user_completed_task(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM task_completions WHERE user_id = ?", (user_id,))
+            cursor = self.conn.execute("UPDATE tasks SET active = 0 WHERE id = ? AND active = 1", (task_id,))
+        if cursor.rowcount:
+            self._load_tasks()
+        return bool(cursor.rowcount)
+
+    def save_task_proof(self, user_id, photo_file_id, task_id=None):
+        conn = self._conn(user_id)
+        with conn:
+            conn.execute("INSERT INTO task_proofs (user_id, photo_file_id, timestamp, task_id) VALUES (?, ?, ?, ?)", (user_id, photo_file_id, datetime.now(), task_id))
+            self._bump_stat(conn, 'task_proofs')
+    def save_task_completion(self, user_id, task_id):
+        conn = self._conn(user_id)
+        with conn:
+            conn.execute(
+                "INSERT INTO task_completions (user_id, task_id, completed_at) VALUES (?, ?, ?)",
+                (user_id, task_id, datetime.now()))
+        if task_id in self.task_completions:
+            self.task_completions[task_id].add(user_id)
+    def has_user_completed_task(self, user_id, task_id):
+        completed = self.task_completions.get(task_id)
+        if completed is not None:
+            return user_id in completed
+        # Not an active task
+        cursor = self._conn(user_id).cursor()
+        cursor.execute("SELECT 1 FROM task_completions WHERE task_id = ? AND user_id = ?", (task_id, user_id))
         return cursor.fetchone() is not None
     def get_task_proofs(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT user_id, photo_file_id FROM task_proofs LIMIT 15")
-        return cursor.fetchall()
+        # (user_id, photo_file_id, duplicate_of, duplicate_user_id, distance,
+        # task_id); duplicate_of, duplicate_user_id and distance are None
+        # unless the proof matches an earlier one
+        return [row for _, _, _, row in self._unreviewed_proofs(15)]
+
+    def _unreviewed_proofs(self, limit):
+        # The oldest unreviewed proofs as (timestamp, id, shard index,
+        # get_task_proofs row), in id order within a shard and merged across
+        # shards by timestamp
+        def read(shard):
+            return [(timestamp or '', proof_id, shard.index, tuple(row)) for proof_id, timestamp, *row in shard.conn.execute("""
+            SELECT p.id, p.timestamp, p.user_id, p.photo_file_id, h.duplicate_of, d.user_id, h.distance, p.task_id
+            FROM task_proofs p
+            LEFT JOIN proof_hashes h ON h.proof_id = p.id
+            LEFT JOIN proof_hashes d ON d.proof_id = h.duplicate_of
+            WHERE p.reviewed_at IS NULL
+            ORDER BY p.id
+            LIMIT ?""", (limit,))]
+
+        return list(heapq.merge(*self._fan_out(read, parallel=False), key=itemgetter(0, 1)))[:limit]
+
+    def get_unhashed_proofs(self, limit=50):
+        return list(heapq.merge(*self._fan_out(lambda shard: shard.conn.execute("""
+        SELECT p.id, p.user_id, p.photo_file_id FROM task_proofs p
+        WHERE NOT EXISTS (SELECT 1 FROM proof_hashes h WHERE h.proof_id = p.id)
+        ORDER BY p.id LIMIT ?""", (limit,)).fetchall(), parallel=False)))[:limit]
+
+    def save_proof_hash(self, proof_id, user_id, value):
+        # Stores the hash (None if the proof could not be hashed) and returns
+        # the id of the earliest stored proof within DUPLICATE_DISTANCE, if any
+        duplicate_of = distance = None
+        bands = hash_bands(value) if value is not None else []
+        if bands:
+            candidates = self.conn.execute("""
+            SELECT proof_id, hash FROM proof_hashes
+            WHERE proof_id IN (SELECT proof_id FROM proof_hash_bands WHERE %s)
+            ORDER BY proof_id""" % ' OR '.join(['band = ? AND value = ?'] * len(bands)), [part for pair in bands for part in pair])
+            for other_id, other_hash in candidates:
+                other_distance = bin((other_hash & 0xFFFFFFFFFFFFFFFF) ^ value).count('1')
+                if other_id != proof_id and other_distance <= DUPLICATE_DISTANCE:
+                    duplicate_of, distance = other_id, other_distance
+                    break
+            # SQLite integers are signed 64-bit
+            value -= (value >> 63) << 64
+        with self.conn:
+            self.conn.execute("""
+            INSERT OR REPLACE INTO proof_hashes (proof_id, user_id, hash, duplicate_of, distance)
+            VALUES (?, ?, ?, ?, ?)""", (proof_id, user_id, value, duplicate_of, distance))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO proof_hash_bands (band, value, proof_id) VALUES (?, ?, ?)",
+                [(band, band_value, proof_id) for band, band_value in bands])
+        if duplicate_of:
+            log.info("duplicate_proof", proof_id=proof_id, user_id=user_id, duplicate_of=duplicate_of, distance=distance)
+        return duplicate_of
     # Add this method to your Database class
 
+    def iter_task_proofs(self, since, until, batch_size=500):
+        # Yields (id, user_id, photo_file_id, timestamp) for proofs submitted
+        # in [since, until), archived ones included: month by month through
+        # the archive tables the range covers, then the hot table, each oldest
+        # first and read batch_size rows at a time.  With shards, each
+        # shard's proofs are merged in timestamp order.
+        return heapq.merge(*(self._iter_shard_proofs(shard, since, until, batch_size) for shard in self.shards),
+                           key=itemgetter(3, 0))
+
+    def _iter_shard_proofs(self, shard, since, until, batch_size):
+        for table in self._proof_tables(shard, since, until):
+            # Each batch starts the index range at the last timestamp seen
+            lower, last_id = since, 0
+            while True:
+                rows = shard.conn.execute("""
+                SELECT id, user_id, photo_file_id, timestamp FROM %s
+                WHERE timestamp >= ? AND timestamp < ? AND (timestamp > ? OR id > ?)
+                ORDER BY timestamp, id LIMIT ?""" % table, (lower, until, lower, last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                yield from rows
+                lower, last_id = rows[-1][3], rows[-1][0]
+
+    def _proof_tables(self, shard, since, until):
+        first, last = since[:7].replace('-', ''), until[:7].replace('-', '')
+        months = [month for month in shard.archive_months['task_proofs'] if first <= month <= last]
+        return [f'task_proofs_archive_{month}' for month in months] + ['task_proofs']
+
+    def get_user_proofs(self, user_id):
+        # (id, photo_file_id, timestamp, reviewed_at) across hot and archive tables
+        return self._union_all(
+            self._shard(user_id), 'task_proofs',
+            "SELECT id, photo_file_id, timestamp, reviewed_at FROM {table} WHERE user_id = ?", (user_id,))
+
+    def get_user_completions(self, user_id):
+        # (task_id, completed_at) across hot and archive tables
+        return self._union_all(
+            self._shard(user_id), 'task_completions',
+            "SELECT task_id, completed_at FROM {table} WHERE user_id = ?", (user_id,))
+
+    def _union_all(self, shard, table, select, params):
+        # One indexed lookup per table, oldest archive month first
+        tables = [f'{table}_archive_{month}' for month in shard.archive_months[table]] + [table]
+        query = ' UNION ALL '.join(select.format(table=name) for name in tables)
+        return shard.conn.execute(query, params * len(tables)).fetchall()
+
+    def archive_batch(self, batch_size=500):
+        # Moves up to batch_size reviewed proofs and up to batch_size
+        # completions of tasks that are no longer active into their monthly
+        # archive tables, per shard.  Each shard is one short transaction;
+        # returns the number of rows moved.
+        return sum(self._archive_shard(shard, batch_size) for shard in self.shards)
+
+    def _archive_shard(self, shard, batch_size):
+        moved = 0
+        with shard.conn:
+            for table, condition, month in (
+                ('task_proofs', "reviewed_at IS NOT NULL", "timestamp"),
+                ('task_completions', "task_id IS NULL OR task_id NOT IN (SELECT id FROM tasks WHERE active = 1)", "completed_at"),
+            ):
+                rows = shard.conn.execute("""
+                SELECT id, COALESCE(strftime('%%Y%%m', %s), strftime('%%Y%%m', 'now')) FROM %s
+                WHERE %s ORDER BY id LIMIT ?""" % (month, table, condition), (batch_size,)).fetchall()
+                by_month = {}
+                for row_id, row_month in rows:
+                    by_month.setdefault(row_month, []).append(row_id)
+                for row_month, ids in by_month.items():
+                    archive = self._archive_table(shard, table, row_month)
+                    placeholders = ', '.join('?' * len(ids))
+                    shard.conn.execute(f"INSERT OR REPLACE INTO {archive} SELECT * FROM {table} WHERE id IN ({placeholders})", ids)
+                    shard.conn.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+                moved += len(rows)
+        return moved
+
+    def _archive_table(self, shard, table, month):
+        name = f'{table}_archive_{month}'
+        if month not in shard.archive_months[table]:
+            shard.conn.execute(f"CREATE TABLE IF NOT EXISTS {name} ({ARCHIVE_SCHEMAS[table]})")
+            for column in ARCHIVE_INDEXES[table]:
+                shard.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{column} ON {name} ({column})")
+            shard.archive_months[table] = sorted(shard.archive_months[table] + [month])
+        return name
+
+    def incremental_vacuum(self, pages=1000):
+        # Returns the number of free pages left in the files
+        free_pages = 0
+        for shard in self._stores():
+            shard.conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            free_pages += shard.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return free_pages
+
     def get_task_proof_date(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT timestamp FROM task_proofs WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+        # Newest proof first: the hot table, then archive months newest first
+        shard = self._shard(user_id)
+        tables = ['task_proofs'] + [f'task_proofs_archive_{month}' for month in reversed(shard.archive_months['task_proofs'])]
+        for table in tables:
+            result = shard.conn.execute(
+                f"SELECT timestamp FROM {table} WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)).fetchone()
+            if result:
+                return result[0]
+        return None
     
     def get_latest_instruction(self):
         cursor = self.conn.cursor()
@@ -332,5 +1348,169 @@ class Database:
             return result[0], result[1]  # Return the user_id and the referral count
         return None, 0
 
+    def get_downstream_count(self, user_id, max_depth=None):
+        # Users referred by user_id directly or down the chain, up to
+        # max_depth levels below it (all levels when None)
+        if max_depth is None:
+            row = self.conn.execute("SELECT downstream FROM referral_subtrees WHERE user_id = ?", (user_id,)).fetchone()
+            return row[0] if row else 0
+        return self.conn.execute(
+            "SELECT coalesce(SUM(users), 0) FROM referral_levels WHERE ancestor_id = ? AND depth <= ?",
+            (user_id, max_depth)).fetchone()[0]
+
+    def get_downstream_levels(self, user_id, max_depth=10):
+        # [(depth, users)] below user_id, nearest level first
+        return self.conn.execute(
+            "SELECT depth, users FROM referral_levels WHERE ancestor_id = ? AND depth <= ? ORDER BY depth",
+            (user_id, max_depth)).fetchall()
+
+    def get_referral_chain(self, user_id):
+        # Who referred user_id, who referred them and so on: [(depth,
+        # ancestor id, username, first_name)], the direct referrer first
+        chain = self.conn.execute(
+            "SELECT depth, ancestor_id FROM referral_closure WHERE descendant_id = ? ORDER BY depth", (user_id,)).fetchall()
+        names = self._lookup_users(
+            [shard.conn for shard in self.shards], {ancestor_id for _, ancestor_id in chain}, 'username, first_name')
+        return [(depth, ancestor_id) + names.get(ancestor_id, (None, None)) for depth, ancestor_id in chain]
+
+    def get_largest_subtrees(self, limit=10):
+        # [(user id, username, first_name, direct referrals, downstream
+        # users)], largest tree first.  Read off idx_referral_subtrees_downstream.
+        trees = self.conn.execute("""
+        SELECT s.user_id,
+               coalesce((SELECT users FROM referral_levels WHERE ancestor_id = s.user_id AND depth = 1), 0),
+               s.downstream
+        FROM referral_subtrees s
+        ORDER BY s.downstream DESC
+        LIMIT ?""", (limit,)).fetchall()
+        names = self._lookup_users(
+            [shard.conn for shard in self.shards], {user_id for user_id, _, _ in trees}, 'username, first_name')
+        return [(user_id,) + names.get(user_id, (None, None)) + (direct, downstream)
+                for user_id, direct, downstream in trees]
+
+    def load_persistence(self, kind):
+        return self.conn.execute("SELECT key, data FROM persistence WHERE kind = ?", (kind,)).fetchall()
+
+    def load_persistence_entry(self, kind, key):
+        row = self.conn.execute("SELECT data FROM persistence WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else None
+
+    def save_persistence(self, rows):
+        # rows are (kind, key, data); data None deletes the entry.  One
+        # transaction for the whole batch.
+        with self.conn:
+            self.conn.executemany("""
+            INSERT INTO persistence (kind, key, data) VALUES (?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data
+            """, [row for row in rows if row[2] is not None])
+            self.conn.executemany(
+                "DELETE FROM persistence WHERE kind = ? AND key = ?",
+                [(kind, key) for kind, key, data in rows if data is None])
+
+    def _enqueue_notification(self, conn, chat_id, text):
+        # Caller owns the transaction on conn
+        conn.execute("INSERT INTO outbox (chat_id, text) VALUES (?, ?)", (chat_id, text))
+
+    def enqueue_notification(self, chat_id, text):
+        with self.conn:
+            self._enqueue_notification(self.conn, chat_id, text)
+
+    def get_due_notifications(self, limit):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        SELECT id, chat_id, text, attempts FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY id
+        LIMIT ?
+        """, (time.time(), limit))
+        return cursor.fetchall()
+
+    def expand_broadcast(self, limit=1000):
+        # Queues the next `limit` recipients of the oldest broadcast as outbox
+        # rows and returns how many; the broadcast is dropped once it has
+        # reached every user (users who join meanwhile are included)
+        row = self.conn.execute("SELECT id, text, last_user_id FROM outbox_broadcasts ORDER BY id LIMIT 1").fetchone()
+        if row is None:
+            return 0
+        broadcast_id, text, last_user_id = row
+        user_ids = list(islice(heapq.merge(*self._fan_out(lambda shard: [user_id for user_id, in shard.conn.execute(
+            "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_user_id, limit))], parallel=False)), limit))
+        with self.conn:
+            if user_ids:
+                self.conn.executemany("INSERT INTO outbox (chat_id, text) VALUES (?, ?)",
+                                      ((user_id, text) for user_id in user_ids))
+                self.conn.execute("UPDATE outbox_broadcasts SET last_user_id = ? WHERE id = ?",
+                                  (user_ids[-1], broadcast_id))
+            if len(user_ids) < limit:
+                self.conn.execute("DELETE FROM outbox_broadcasts WHERE id = ?", (broadcast_id,))
+        return len(user_ids)
+
+    def mark_notification_sent(self, notification_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (notification_id,))
+
+    def retry_notification(self, notification_id, delay, error):
+        with self.conn:
+            self.conn.execute("""
+            UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+            """, (time.time() + delay, error, notification_id))
+
+    def defer_notification(self, notification_id, delay, error):
+        # Rescheduled without spending a retry: the delay was not the message's fault
+        with self.conn:
+            self.conn.execute("UPDATE outbox SET next_attempt_at = ?, last_error = ? WHERE id = ?",
+                              (time.time() + delay, error, notification_id))
+
+    def fail_notification(self, notification_id, error):
+        with self.conn:
+            self.conn.execute("UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?", (error, notification_id))
+
+    def get_pending_notification_count(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+        result = cursor.fetchone()
+        return result[0] if result else 0
+
+    def _bump_stat(self, conn, metric, amount=1):
+        # Caller owns the transaction on conn.  Every file has its own
+        # rollups, so a shard's writes never lock the main file for them;
+        # the readers below add them up.
+        day = datetime.now().strftime('%Y-%m-%d')
+        conn.execute("""
+        INSERT INTO daily_stats (day, metric, value) VALUES (?, ?, ?)
+        ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value
+        """, (day, metric, amount))
+        conn.execute("""
+        INSERT INTO stat_totals (metric, value) VALUES (?, ?)
+        ON CONFLICT (metric) DO UPDATE SET value = value + excluded.value
+        """, (metric, amount))
+
+    def add_stat(self, metric, amount=1):
+        with self.conn:
+            self._bump_stat(self.conn, metric, amount)
+
+    def get_stat_total(self, metric):
+        return sum(self._fan_out(lambda shard: shard.conn.execute(
+            "SELECT coalesce(SUM(value), 0) FROM main.stat_totals WHERE metric = ?", (metric,)).fetchone()[0],
+            self._stores(), parallel=False))
+
+    def get_stats(self, day=None):
+        # Totals plus the given day and the day before, all primary-key lookups
+        day = day or datetime.now().date()
+        today = day.strftime('%Y-%m-%d')
+        yesterday = (day - timedelta(days=1)).strftime('%Y-%m-%d')
 
+        def read(shard):
+            return (shard.conn.execute("SELECT metric, value FROM main.stat_totals").fetchall(),
+                    shard.conn.execute("SELECT day, metric, value FROM main.daily_stats WHERE day IN (?, ?)",
+                                       (today, yesterday)).fetchall())
 
+        stats = {'totals': {}, 'today': {}, 'yesterday': {}}
+        for totals, days in self._fan_out(read, self._stores(), parallel=False):
+            for metric, value in totals:
+                stats['totals'][metric] = stats['totals'].get(metric, 0) + value
+            for row_day, metric, value in days:
+                period = stats['today' if row_day == today else 'yesterday']
+                period[metric] = period.get(metric, 0) + value
+        return stats
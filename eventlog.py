@@ -0,0 +1,95 @@
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+
+class EventLogger:
+    # Structured JSON lines, one event per line.  On the calling side an event
+    # costs a level check, an optional sampling draw and a queue put; encoding
+    # and the stdout write happen on a background thread.
+    def __init__(self, stream=None, level='INFO', sample_rates=None):
+        self.stream = stream or sys.stdout
+        self.level = LEVELS[level.upper()]
+        # event name -> fraction of occurrences to keep, for high-volume events
+        self.sample_rates = dict(sample_rates or {})
+        self.dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, name='eventlog-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def log(self, level, event, **fields):
+        if level < self.level:
+            return
+        rate = self.sample_rates.get(event)
+        if rate is not None:
+            if random.random() >= rate:
+                self.dropped += 1
+                return
+            fields['sample_rate'] = rate
+        self._queue.put((time.time(), level, event, fields))
+
+    def debug(self, event, **fields):
+        self.log(10, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(20, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(30, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(40, event, **fields)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+    def _write_loop(self):
+        names = {value: name for name, value in LEVELS.items()}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            lines = []
+            # Drain whatever else is queued so one flush covers a burst
+            while item is not None:
+                timestamp, level, event, fields = item
+                record = {'ts': round(timestamp, 3), 'level': names[level], 'event': event}
+                record.update(fields)
+                lines.append(json.dumps(record, default=str, ensure_ascii=False))
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = False
+                    break
+            try:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            except Exception:
+                pass
+            if item is None:
+                break
+
+
+def parse_sample_rates(spec):
+    # "membership_status=0.01,broadcast_failed=0.1"
+    rates = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        event, _, rate = part.partition('=')
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+log = EventLogger(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    sample_rates=parse_sample_rates(os.getenv('LOG_SAMPLE', 'membership_status=0.01,broadcast_failed=0.1')),
+)
@@ -0,0 +1,102 @@
+import time
+from array import array
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+
+class TokenBucketTable:
+    # Token buckets kept in two flat arrays of doubles (tokens, last refill) with
+    # a dict mapping user id -> slot.  Freed slots are reused, so memory follows
+    # the number of recently active users instead of every user ever seen.
+    def __init__(self, rate, burst, idle_ttl=600, sweep_interval=60, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._slots = {}
+        self._free = []
+        self._tokens = array('d')
+        self._stamps = array('d')
+        self._next_sweep = clock() + sweep_interval
+
+    def __len__(self):
+        return len(self._slots)
+
+    def consume(self, key, cost=1):
+        now = self.clock()
+        if now >= self._next_sweep:
+            self.evict_idle(now)
+
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._allocate(key, now)
+        tokens = min(self.burst, self._tokens[slot] + (now - self._stamps[slot]) * self.rate)
+        self._stamps[slot] = now
+        if tokens < cost:
+            self._tokens[slot] = tokens
+            return False
+        self._tokens[slot] = tokens - cost
+        return True
+
+    def _allocate(self, key, now):
+        if self._free:
+            slot = self._free.pop()
+            self._tokens[slot] = self.burst
+            self._stamps[slot] = now
+        else:
+            slot = len(self._tokens)
+            self._tokens.append(self.burst)
+            self._stamps.append(now)
+        self._slots[key] = slot
+        return slot
+
+    def evict_idle(self, now=None):
+        now = self.clock() if now is None else now
+        self._next_sweep = now + self.sweep_interval
+        # An idle bucket has refilled to burst anyway, dropping it changes nothing
+        cutoff = now - self.idle_ttl
+        idle = [key for key, slot in self._slots.items() if self._stamps[slot] < cutoff]
+        for key in idle:
+            self._free.append(self._slots.pop(key))
+        return len(idle)
+
+
+def update_action(update):
+    if update.callback_query:
+        return update.callback_query.data
+    message = update.effective_message
+    if message is None:
+        return None
+    if message.text and message.text.startswith('/'):
+        return message.text.split()[0].split('@')[0]
+    if message.text:
+        return message.text
+    if message.photo:
+        return 'photo'
+    return None
+
+
+class FloodControl:
+    # Registered in group -2, after only the state evictor's bookkeeping and
+    # before refresh_user_info and every command handler.  Over-limit updates
+    # are dropped silently with ApplicationHandlerStop: answering an abuser
+    # would spend the same API budget the limiter is protecting.
+    def __init__(self, rate, burst, costs=None, exempt=(), idle_ttl=600):
+        self.buckets = TokenBucketTable(rate, burst, idle_ttl=idle_ttl)
+        self.costs = costs or {}
+        self.exempt = set(exempt)
+        self.dropped = 0
+
+    async def check(self, update: Update, context):
+        user = update.effective_user
+        if user is None or user.id in self.exempt:
+            return
+        cost = self.costs.get(update_action(update), 1)
+        if not self.buckets.consume(user.id, cost):
+            self.dropped += 1
+            raise ApplicationHandlerStop
+
+    def handler(self):
+        return TypeHandler(Update, self.check)
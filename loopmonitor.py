@@ -0,0 +1,119 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import counter, histogram
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LOOP_LAG = histogram(
+    'bot_event_loop_lag_seconds', 'Delay of the event loop heartbeat beyond its interval.',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_STALLS = counter('bot_event_loop_stalls_total', 'Event loop stalls above the threshold by blocking site.', ('site',))
+
+
+def blocking_site(frame):
+    # "<our function>:<line> -> <innermost call>", e.g. the handler that called
+    # requests.get and the socket read it is stuck in
+    stack = traceback.extract_stack(frame)
+    innermost = stack[-1]
+    ours = next((entry for entry in reversed(stack)
+                 if entry.filename.startswith(REPO_DIR) and not entry.filename.endswith('loopmonitor.py')), None)
+    inner = f'{os.path.basename(innermost.filename)}:{innermost.name}'
+    if ours is None:
+        return inner
+    return f'{os.path.basename(ours.filename)}:{ours.name}:{ours.lineno} -> {inner}'
+
+
+class LoopLagMonitor:
+    # A heartbeat task on the loop measures lag continuously.  A watchdog thread
+    # notices when the heartbeat is late and samples the loop thread's stack
+    # while it is still blocked, so the report names the code that blocked and
+    # not whatever happened to run afterwards.
+    def __init__(self, interval=0.1, threshold=0.25, report_interval=3600, on_report=None, top=5):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.on_report = on_report
+        self.top = top
+        self.offenders = {}  # site -> [stalls, total seconds, worst seconds]
+        self._reported_stalls = 0
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._sampled_site = None
+        self._loop_thread_id = None
+        self._running = False
+        self._tasks = []
+        self._watchdog = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._running = True
+        self._tasks = [asyncio.create_task(self._heartbeat())]
+        if self.on_report:
+            self._tasks.append(asyncio.create_task(self._reporter()))
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            with self._lock:
+                self._beat = now
+                site, self._sampled_site = self._sampled_site, None
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                self._record(site or 'unknown', lag)
+
+    def _watch(self):
+        while self._running:
+            time.sleep(self.threshold / 2)
+            with self._lock:
+                blocked_for = time.monotonic() - self._beat - self.interval
+                if blocked_for < self.threshold or self._sampled_site is not None:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            site = blocking_site(frame)
+            with self._lock:
+                self._sampled_site = site
+
+    def _record(self, site, lag):
+        LOOP_STALLS.labels(site).inc()
+        entry = self.offenders.setdefault(site, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += lag
+        entry[2] = max(entry[2], lag)
+
+    def worst_offenders(self):
+        return sorted(self.offenders.items(), key=lambda item: item[1][1], reverse=True)[:self.top]
+
+    def report(self):
+        lines = ["Event loop stalls (total time, count, worst):"]
+        for site, (stalls, total, worst) in self.worst_offenders():
+            lines.append(f"{total:.2f}s  x{stalls}  max {worst:.2f}s  {site}")
+        return "\n".join(lines)
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            stalls = sum(entry[0] for entry in self.offenders.values())
+            if stalls > self._reported_stalls:
+                self._reported_stalls = stalls
+                self.on_report(self.report())
@@ -2,7 +2,7 @@ import os
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, CallbackContext, ConversationHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, CallbackContext, ConversationHandler, TypeHandler
 from telegram.error import BadRequest, TelegramError, RetryAfter
 import sqlite3
 import asyncio
@@ -11,6 +11,27 @@ import http.server
 import socketserver
 import re
 import threading
+import io
+import csv
+import json
+import tempfile
+import html
+from sequencer import SequencedApplication
+from floodcontrol import FloodControl
+from database import Database, normalize_wallet
+from outbox import OutboxSender
+from proofhash import ProofHasher
+from proofexport import ArchiveWriter, export_proofs
+from archiver import Archiver
+from boosters import BoosterSweeper
+from persistence import SQLitePersistence
+from userstate import StateEvictor
+from transport import request_from_env
+from membership import MembershipChecker
+from loopmonitor import LoopLagMonitor
+from profiler import SamplingProfiler, folded, summary
+from eventlog import log
+from metrics import track_handler, instrument_database, MetricsRequestHandler, BROADCAST_MESSAGES, OUTBOX_PENDING, UPDATE_QUEUE_DEPTH
 ADD_TASK, ADD_TASK_PROOF = range(2)
 
 load_dotenv()
@@ -18,339 +39,100 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = {5991907369, 1234567890, 987654321}
 CHANNEL_USERNAMES = ["@gamesgero"]
 CHANNEL_JOIN_LINKS = ["https://t.me/gamesgero"]
-
-
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('bot_database.db')
-        self.create_tables()
-
-    def create_tables(self):  
-        with self.conn:  
-            self.conn.execute("""  
-            CREATE TABLE IF NOT EXISTS users (  
-                id INTEGER PRIMARY KEY,  
-                username TEXT,  
-                first_name TEXT,  
-                last_name TEXT,  
-                referral_link TEXT,  
-                referrer_id INTEGER,  
-                verified INTEGER DEFAULT 0,  
-                matic_balance INTEGER DEFAULT 0,  
-                matic_wallet TEXT,  
-                last_claim TIMESTAMP,  
-                double_mine_active INTEGER DEFAULT 0,  
-                double_mine_enabled INTEGER DEFAULT 0,  
-                time_speed_enabled INTEGER DEFAULT 0          
-            )""")  
-            
-            self.conn.execute("""  
-            CREATE TABLE IF NOT EXISTS referrals (  
-                id INTEGER PRIMARY KEY AUTOINCREMENT,  
-                referrer_id INTEGER,  
-                referred_id INTEGER  
-            )""")  
-
-            # Add 'timestamp' column to make sure it's included correctly  
-            self.conn.execute('''  
-            CREATE TABLE IF NOT EXISTS new_referrals (  
-                referral_id INTEGER PRIMARY KEY AUTOINCREMENT,  
-                referrer_id INTEGER,  
-                referred_id INTEGER,  
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,  
-                FOREIGN KEY (referrer_id) REFERENCES users(id),  
-                FOREIGN KEY (referred_id) REFERENCES users(id)  
-            )''')  
-
-            # We need to check if the old referrals table has a 'timestamp' column   
-            # before copying data from it.  
-
-            try:  
-                # Copy data from old referrals table to new referrals table  
-                self.conn.execute('''  
-                INSERT INTO new_referrals (referrer_id, referred_id, timestamp)  
-                SELECT referrer_id, referred_id, CURRENT_TIMESTAMP FROM referrals  
-                ''')  
-            except sqlite3.OperationalError:  
-                print("The column 'timestamp' does not exist in the 'referrals' table.")  
-            
-            # Drop the old referrals table  
-            self.conn.execute('DROP TABLE IF EXISTS referrals')  
-
-            # Rename the new referrals table to the old table name  
-            self.conn.execute('ALTER TABLE new_referrals RENAME TO referrals')  
-
-            self.conn.execute("""  
-            CREATE TABLE IF NOT EXISTS tasks (  
-                id INTEGER PRIMARY KEY AUTOINCREMENT,  
-                photo_file_id TEXT,  
-                description TEXT  
-            )""")  
-            
-            self.conn.execute("""  
-            CREATE TABLE IF NOT EXISTS task_proofs (  
-                id INTEGER PRIMARY KEY AUTOINCREMENT,  
-                user_id INTEGER,  
-                photo_file_id TEXT,  
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP  
-            )""")  
-            
-            self.conn.execute("""  
-            CREATE TABLE IF NOT EXISTS task_completions (  
-                id INTEGER PRIMARY KEY AUTOINCREMENT,  
-                user_id INTEGER  
-            )""")
-
-    def deduct_matic_balance(self, user_id, amount):
-        with self.conn:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
-            current_balance = cursor.fetchone()[0]
-
-            if current_balance >= amount:
-                self.conn.execute("UPDATE users SET matic_balance = matic_balance - ? WHERE id = ?", (amount, user_id))
-                print(f"Deducted {amount} MATIC coins from user {user_id}")
-            else:
-                print("Insufficient MATIC balance to perform deduction.")
-
-    def add_user(self, user_id, username, first_name, last_name, referral_link, referrer_id):
-        with self.conn:
-            self.conn.execute("""
-            INSERT OR IGNORE INTO users (id, username, first_name, last_name, referral_link, referrer_id)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (user_id, username, first_name, last_name, referral_link, referrer_id))
-            if referrer_id:
-                self.conn.execute("""
-                INSERT INTO referrals (referrer_id, referred_id)
-                VALUES (?, ?)""",
-                (referrer_id, user_id))
-
-    def is_user_verified(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT verified FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result and result[0] == 1
-
-    def verify_user(self, user_id):
-        with self.conn:
-            
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT verified FROM users WHERE id = ?", (user_id,))
-            result = cursor.fetchone()
-            
-            if result and result[0] == 1:
-                return  # User is already verified, do nothing
-            
-            # Otherwise, update user verification status
-            self.conn.execute("UPDATE users SET verified = 1 WHERE id = ?", (user_id,))
-
-            # Check if this is the first verification
-            cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
-            current_balance = cursor.fetchone()[0]
-            if current_balance == 0:
-                # If user has 0 MATIC balance, reward them with 3 MATIC
-                self.conn.execute("UPDATE users SET matic_balance = matic_balance + 3 WHERE id = ?", (user_id,))
-
-    def update_wallet_address(self, user_id, address):
-        with self.conn:
-            self.conn.execute("UPDATE users SET matic_wallet = ? WHERE id = ?", (address, user_id))
-    
-    def get_all_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id FROM users")
-        return [row[0] for row in cursor.fetchall()]
-
-
-    def get_user_data(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-
-        if result:
-            return {
-                'id': result[0],
-                'username': result[1],
-                'first_name': result[2],
-                'last_name': result[3],
-                'referral_link': result[4],
-                'referrer_id': result[5],
-                'verified': result[6],
-                'matic_balance': result[7],
-                'matic_wallet': result[8],
-                'last_claim': result[9],
-                'double_mine_active': result[10],
-                'time_speed_enabled': result[11],  # Adjust based on your schema
-                'double_mine_enabled': result[12]   # Adjust based on your schema
-            }
-        else:
-            return None
-
-    def get_user_matic_balance(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else 0
-
-    def update_matic_balance(self, user_id, amount):
-        with self.conn:
-            self.conn.execute("UPDATE users SET matic_balance = matic_balance + ? WHERE id = ?", (amount, user_id))
-
-    def add_referral(self, referrer_id, referred_id):
-        with self.conn:
-            self.conn.execute("INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referrer_id, referred_id))
-
-    def get_referral_count(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else 0
-    
-    def get_referrer_id(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT referrer_id FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-
-    def reward_referrer(self, referrer_id, amount):
-        with self.conn:
-            self.conn.execute("UPDATE users SET matic_balance = matic_balance + ? WHERE id = ?", (amount, referrer_id))
-
-
-    def get_last_claim_time(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT last_claim FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result and result[0]:
-            try:
-                return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S.%f')
-            except ValueError:
-                return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S')
-        return None
-    def get_total_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        result = cursor.fetchone()
-        return result[0] if result else 0
-
-    def update_last_claim_time(self, user_id):
-        with self.conn:
-            self.conn.execute("UPDATE users SET last_claim = ? WHERE id = ?", (datetime.now(), user_id))
-
-    def add_task_proof(self, user_id, task_proof):
-        with self.conn:
-            self.conn.execute("INSERT INTO tasks (user_id, task_proof) VALUES (?, ?)", (user_id, task_proof))
-        
-    
-
-    def user_has_joined_channels(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT verified FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result and result[0] == 1
-
-    def update_user_info(self, user_id, first_name, last_name, username):
-        with self.conn:
-            self.conn.execute("""
-            UPDATE users
-            SET first_name = ?, last_name = ?, username = ?
-            WHERE id = ?
-            """, (first_name, last_name, username, user_id))
-
-    def get_tasks(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT photo_file_id, description FROM tasks")
-        return cursor.fetchall()
-
-    def clear_task_proofs(self):
-        cursor = self.conn.cursor()
-        cursor.execute("DELETE FROM task_proofs WHERE id IN (SELECT id FROM task_proofs ORDER BY id LIMIT 15)")
-        self.conn.commit()
-
-    
-    def update_claim_time(self, user_id, time_delta):
-        with self.conn:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT last_claim FROM users WHERE id = ?", (user_id,))
-            last_claim_time = cursor.fetchone()[0]
-
-            if last_claim_time:
-                # Convert the string to a datetime object
-                last_claim_time = datetime.strptime(last_claim_time, '%Y-%m-%d %H:%M:%S.%f')
-                new_claim_time = last_claim_time + time_delta
-            else:
-                new_claim_time = datetime.now() + time_delta
-
-            # Convert the new_claim_time back to a string before storing it in the database
-            new_claim_time_str = new_claim_time.strftime('%Y-%m-%d %H:%M:%S.%f')
-
-            self.conn.execute("UPDATE users SET last_claim = ? WHERE id = ?", (new_claim_time_str, user_id))
-            print(f"Updated claim time for user {user_id} to {new_claim_time_str}")
-
-    def activate_double_mine(self, user_id):
-        with self.conn:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT matic_balance FROM users WHERE id = ?", (user_id,))
-            current_balance = cursor.fetchone()[0]
-    def enable_time_speed(self, user_id):
-        with self.conn:
-            self.conn.execute("UPDATE users SET time_speed_enabled = 1 WHERE id = ?", (user_id,))
-
-    def enable_double_mine(self, user_id):
-        with self.conn:
-            self.conn.execute("UPDATE users SET double_mine_enabled = 1 WHERE id = ?", (user_id,))
-    def save_task(self, photo_file_id, description):
-        with self.conn:
-            self.conn.execute("DELETE FROM tasks")
-            self.conn.execute("DELETE FROM task_completions")
-            self.conn.execute("INSERT INTO tasks (photo_file_id, description) VALUES (?, ?)", (photo_file_id, description))
-    def save_task_proof(self, user_id, photo_file_id):
-        with self.conn:
-            self.conn.execute("INSERT INTO task_proofs (user_id, photo_file_id, timestamp) VALUES (?, ?, ?)", (user_id, photo_file_id, datetime.now()))
-    def save_task_completion(self, user_id):
-        with self.conn:
-            self.conn.execute("INSERT INTO task_completions (user_id) VALUES (?)", (user_id,))
-    def has_user_completed_task(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM task_completions WHERE user_id = ?", (user_id,))
-        return cursor.fetchone() is not None
-    def get_task_proofs(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT user_id, photo_file_id FROM task_proofs LIMIT 15")
-        return cursor.fetchall()
-    # Add this method to your Database class
-
-    def get_task_proof_date(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT timestamp FROM task_proofs WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-    
-    def get_latest_instruction(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT description FROM tasks ORDER BY id DESC LIMIT 1")
-        result = cursor.fetchone()
-        return result[0] if result else "No instructions available."
-
-    def update_instruction(self, new_instruction):
-        self.conn.execute("INSERT INTO tasks (description) VALUES (?)", (new_instruction,))
-        self.conn.commit()
-
-    def get_user_with_most_referrals(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-        SELECT referrer_id, COUNT(referred_id) as referral_count
-        FROM referrals
-        GROUP BY referrer_id
-        ORDER BY referral_count DESC
-        LIMIT 1
-        """)
-        result = cursor.fetchone()
-        if result:
-            return result[0], result[1]  # Return the user_id and the referral count
-        return None, 0
-
-db = Database()
-
+# Updates from different users are handled in parallel, updates from the same user stay in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+# get_chat_member gets MEMBERSHIP_BUDGET seconds per call.  After
+# MEMBERSHIP_BREAKER_FAILURES failures in a row the breaker opens and checks
+# use each user's last known status; after MEMBERSHIP_BREAKER_RESET seconds
+# a probe call decides whether it closes again.
+MEMBERSHIP_BUDGET = float(os.getenv("MEMBERSHIP_BUDGET", 2.0))
+MEMBERSHIP_BREAKER_FAILURES = int(os.getenv("MEMBERSHIP_BREAKER_FAILURES", 5))
+MEMBERSHIP_BREAKER_RESET = float(os.getenv("MEMBERSHIP_BREAKER_RESET", 30))
+# Whether a user with no known status is let through while checks cannot be
+# made (breaker open, timeout, our own flood limit).  The reward paths (mine,
+# tasks, boosters) use MEMBERSHIP_REWARD_FAIL_OPEN, closed by default, so new
+# accounts cannot skip the channel requirement while the bot is being flooded.
+MEMBERSHIP_FAIL_OPEN = os.getenv("MEMBERSHIP_FAIL_OPEN", "1").lower() in ("1", "true", "yes")
+MEMBERSHIP_REWARD_FAIL_OPEN = os.getenv("MEMBERSHIP_REWARD_FAIL_OPEN", "0").lower() in ("1", "true", "yes")
+# Outgoing Bot API calls and getUpdates long polling use separate connection
+# pools, so a broadcast can never starve polling (or the other way round).
+# Each is tuned with BOT_API_* and UPDATES_* variables: POOL_SIZE, KEEPALIVE,
+# KEEPALIVE_EXPIRY, CONNECT_TIMEOUT, READ_TIMEOUT, WRITE_TIMEOUT, POOL_TIMEOUT
+# and HTTP2 (needs httpx[http2]); see transport.request_from_env
+BOT_API_POOL_SIZE = 256
+UPDATES_POOL_SIZE = 1
+# Per-user token buckets: FLOOD_RATE tokens refill per second up to FLOOD_BURST
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", 0.5))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", 10))
+# Actions that hit get_chat_member or fan out DB reads cost more than plain menu taps
+FLOOD_ACTION_COSTS = {
+    "Mine Matic 🔨": 3,
+    "Invite 👥": 3,
+    "Boosters 🚀": 3,
+    "Tasks 🪙": 3,
+    "subscribed": 3,
+    "/start": 2,
+}
+# Pinged on every message to keep the hosted instance awake, empty disables it
+KEEPALIVE_URL = os.getenv("KEEPALIVE_URL", "https://matic-bot-vhqj.onrender.com")
+# Background delivery of user notifications, messages per second
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", 25))
+# Event loop stalls longer than this are attributed to the blocking code and reported to the admin
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", 0.25))
+LOOP_LAG_REPORT_INTERVAL = int(os.getenv("LOOP_LAG_REPORT_INTERVAL", 3600))
+ADMIN_REPORT_CHAT_ID = int(os.getenv("ADMIN_REPORT_CHAT_ID", 5991907369))
+PROFILE_MAX_SECONDS = 300
+# Task-proof screenshots downloaded at once and processes hashing them
+PROOF_DOWNLOAD_CONCURRENCY = int(os.getenv("PROOF_DOWNLOAD_CONCURRENCY", 8))
+PROOF_HASH_WORKERS = int(os.getenv("PROOF_HASH_WORKERS", 2))
+PROOF_EXPORT_CONCURRENCY = int(os.getenv("PROOF_EXPORT_CONCURRENCY", 8))
+# Proof archives are split into volumes of at most this size; each is read
+# into memory once when it is uploaded
+PROOF_ARCHIVE_MB = int(os.getenv("PROOF_ARCHIVE_MB", 45))
+# Number of SQLite files users are spread over (bot_database.shard0.db, ...);
+# 1 keeps everything in bot_database.db.  Fixed once the database is split.
+DB_SHARDS = int(os.getenv("DB_SHARDS", 1))
+# Seconds between passes moving reviewed proofs and old completions to the monthly archive tables
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 3600))
+BOOSTER_COST = int(os.getenv("BOOSTER_COST", 20))
+# How long a purchased booster lasts, and seconds between sweeps ending expired ones
+BOOSTER_DAYS = float(os.getenv("BOOSTER_DAYS", 7))
+BOOSTER_SWEEP_INTERVAL = int(os.getenv("BOOSTER_SWEEP_INTERVAL", 60))
+# Seconds between handing changed user_data and conversation states to the
+# persistence, and between the batched writes of what it was handed
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 10))
+# user_data of users idle this many seconds is dropped from memory (it stays
+# in the persistence table), checked every USER_STATE_EVICT_INTERVAL seconds
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", 1800))
+USER_STATE_EVICT_INTERVAL = int(os.getenv("USER_STATE_EVICT_INTERVAL", 300))
+# Broadcast drafts are kept in the admin's user_data; Telegram's own limits
+BROADCAST_MAX_TEXT = 4096
+BROADCAST_MAX_CAPTION = 1024
+BOOSTER_NAMES = {'time_speed': "Time Speed ⏲", 'double_mine': "Double Mine (x2)"}
+
+
+db = instrument_database(Database(shards=DB_SHARDS))
+outbox_sender = OutboxSender(db, rate=OUTBOX_RATE)
+proof_hasher = ProofHasher(db, concurrency=PROOF_DOWNLOAD_CONCURRENCY, workers=PROOF_HASH_WORKERS)
+archiver = Archiver(db, interval=ARCHIVE_INTERVAL)
+booster_sweeper = BoosterSweeper(
+    db, interval=BOOSTER_SWEEP_INTERVAL, on_expired=outbox_sender.wake,
+    notify={effect: f"Your {name} booster has ended. You can activate it again from Boosters 🚀." for effect, name in BOOSTER_NAMES.items()})
+
+def report_loop_stalls(text):
+    db.enqueue_notification(ADMIN_REPORT_CHAT_ID, text)
+    outbox_sender.wake()
+
+sampling_profiler = SamplingProfiler()
+persistence = SQLitePersistence(db, update_interval=PERSISTENCE_INTERVAL, flush_interval=PERSISTENCE_INTERVAL)
+membership = MembershipChecker(
+    CHANNEL_USERNAMES, budget=MEMBERSHIP_BUDGET,
+    failure_threshold=MEMBERSHIP_BREAKER_FAILURES, reset_timeout=MEMBERSHIP_BREAKER_RESET,
+    fail_open=MEMBERSHIP_FAIL_OPEN)
+state_evictor = StateEvictor(ttl=USER_STATE_TTL, interval=USER_STATE_EVICT_INTERVAL)
+loop_monitor = LoopLagMonitor(threshold=LOOP_LAG_THRESHOLD, report_interval=LOOP_LAG_REPORT_INTERVAL, on_report=report_loop_stalls)
+
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     referrer_id = context.args[0] if context.args else None
@@ -379,20 +161,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if referrer:
                 await update.message.reply_text(f"You have been referred by {referrer['first_name']}")
 
+async def refresh_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Keeps stored names, and with them the /finduser index, in step with
+    # renamed Telegram accounts; add_user skips users it already knows
+    user = update.effective_user
+    if user and user.id in db.known_users:
+        db.update_user_info(user.id, user.first_name, user.last_name, user.username)
+
+@track_handler
 async def subscribed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
 
-    not_joined_channels = []
-
-    for channel in CHANNEL_USERNAMES:
-        try:
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                not_joined_channels.append(channel)
-        except Exception as e:
-            print(f"Error checking membership for {channel}: {e}")
-            not_joined_channels.append(channel)
+    not_joined_channels = await membership.not_joined(context.bot, user_id)
 
     if not not_joined_channels:
         keyboard = [[KeyboardButton("Cancel")]]
@@ -411,12 +192,15 @@ async def subscribed(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer(text=f"Sorry, you need to join all the channels first! You have not joined:\n{channels_not_joined}", show_alert=True)
 
 
+@track_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        response = requests.get("https://matic-bot-vhqj.onrender.com")
-        print(f"Pinged the web server. Response: {response.status_code}")
-    except requests.RequestException as e:
-        print(f"Failed to ping the web server: {e}")
+    if KEEPALIVE_URL:
+        try:
+            # Off the event loop so a slow ping does not stall other users
+            response = await asyncio.to_thread(requests.get, KEEPALIVE_URL)
+            log.debug("keepalive_ping", status=response.status_code)
+        except requests.RequestException as e:
+            log.warning("keepalive_ping_failed", error=str(e))
     if update.message is None:
         # Handle case where there's no message (e.g., callback query, edited message, etc.)
         return
@@ -435,7 +219,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Delete the old message using the message ID
                 await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=broadcast_message_id)
             except Exception as e:
-                print(f"Failed to delete old message: {e}")
+                log.warning("delete_message_failed", chat_id=update.effective_chat.id, error=str(e))
 
         if message_text == "Broadcast 🎙":
             delete_button = [[InlineKeyboardButton("❌", callback_data='delete_message')]]
@@ -458,7 +242,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 try:
                     await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=broadcast_message_id)
                 except Exception as e:
-                    print(f"Failed to delete old message: {e}")
+                    log.warning("delete_message_failed", chat_id=update.effective_chat.id, error=str(e))
 
             # Process the new photo and caption
             photo = update.message.photo[-1]  # Get the highest resolution photo
@@ -490,7 +274,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif step == 'awaiting_text_for_image':
         delete_button = [[InlineKeyboardButton("❌", callback_data='delete_message')]]
         delete_markup = InlineKeyboardMarkup(delete_button)
-        if text:
+        if text and len(text) > BROADCAST_MAX_CAPTION:
+            await update.message.reply_text(f"Image captions can be at most {BROADCAST_MAX_CAPTION} characters, yours has {len(text)}. Please send a shorter text.", reply_markup=delete_markup)
+        elif text:
             # Store the text for broadcasting
             context.user_data['broadcast_text'] = text
             await update.message.reply_text("Text received. Please send the button placeholder and link\n\nEG:\n (Join my Group, https://t.me/link).", reply_markup=delete_markup)
@@ -502,13 +288,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
         broadcast_message_id = context.user_data.get('broadcast_message_id')
 
-        if text:  # Check if text is provided
+        if text and len(text) > BROADCAST_MAX_TEXT:
+            await update.message.reply_text(f"Broadcast messages can be at most {BROADCAST_MAX_TEXT} characters, yours has {len(text)}. Please send a shorter text.")
+        elif text:  # Check if text is provided
             if broadcast_message_id:
                 try:
                     # Delete the old message using the message ID
                     await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=broadcast_message_id)
                 except Exception as e:
-                    print(f"Failed to delete old message: {e}")
+                    log.warning("delete_message_failed", chat_id=update.effective_chat.id, error=str(e))
 
             # Store the text for broadcasting
             context.user_data['broadcast_text'] = text
@@ -576,20 +364,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
     if 'awaiting_address' in context.user_data and context.user_data['awaiting_address']:
-        if 40 <= len(text) <= 46:
-            was_verified = db.is_user_verified(user.id)  # Check if user was already verified
-            db.update_wallet_address(user.id, text)
-
-            if not was_verified:
+        wallet = normalize_wallet(text)
+        if wallet and not db.update_wallet_address(user.id, wallet):
+            await update.message.reply_text("This wallet address is already linked to another account. Please send your own MATIC wallet address.")
+        elif wallet:
+            if not db.is_user_verified(user.id):
                 db.verify_user(user.id)
                 db.update_matic_balance(user.id, 3)
                 await update.message.reply_text("Wallet address updated and you have been rewarded with 3 MATIC coins.")
                 referrer_id = db.get_referrer_id(user.id)
                 if referrer_id:
-                    db.reward_referrer(referrer_id, 5)  # Reward the referrer with 5 MATIC
-                    referrer = db.get_user_data(referrer_id)
-                    if referrer:
-                        await context.bot.send_message(chat_id=referrer_id, text=f"You have successfully referred {user.first_name} to mine on MATIC MINER BOT 🚀, you have received 5 MATIC coins")
+                    # Reward the referrer with 5 MATIC, the notification is queued with the reward
+                    db.reward_referrer(referrer_id, 5, notify=f"You have successfully referred {user.first_name} to mine on MATIC MINER BOT 🚀, you have received 5 MATIC coins")
+                    outbox_sender.wake()
             else:
                 await update.message.reply_text("Wallet address updated.")
 
@@ -607,31 +394,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text("Invalid MATIC wallet address. Please try again.")
 
-    if 'awaiting_time_speed' in context.user_data and context.user_data['awaiting_time_speed']:
-        db.deduct_matic_balance(user.id, 20)
-        db.update_claim_time(user.id, timedelta(hours=-6))  # Speed up claim time by 6 hours (24 - 18)
-        db.enable_time_speed(user.id)  # Mark Time Speed as enabled in the database
-        await update.message.reply_text("Your daily claim time has been speeded up by 5hrs")
-    elif 'awaiting_double_mine' in context.user_data and context.user_data['awaiting_double_mine']:
-        db.deduct_matic_balance(user.id, 20)
-        db.activate_double_mine(user.id)
-        db.enable_double_mine(user.id)  # Mark Double Mine as enabled in the database
-        await update.message.reply_text("Double Mine activated. You will now receive double rewards.")
-
-        context.user_data.pop('awaiting_time_speed', None)
-        return
-
-    elif 'awaiting_double_mine' in context.user_data and context.user_data['awaiting_double_mine']:
+    if context.user_data.get('awaiting_booster'):
+        effect = context.user_data.pop('awaiting_booster')
         if text == "Yes, deduct and proceed":
-            db.deduct_matic_balance(user.id, 20)  # Deduct 20 MATIC coins
-            db.activate_double_mine(user.id)
-            await update.message.reply_text("Double Mine activated. You will now receive double rewards.")
+            expires_at = db.activate_booster(user.id, effect, BOOSTER_COST, BOOSTER_DAYS * 86400)
+            if expires_at is None:
+                await update.message.reply_text(f"You need at least {BOOSTER_COST} MATIC coins to use boosters.")
+            else:
+                until = datetime.fromtimestamp(expires_at).strftime('%Y-%m-%d %H:%M')
+                if effect == 'time_speed':
+                    await update.message.reply_text(f"Time Speed activated. You can mine every 18 hours until {until}.")
+                else:
+                    await update.message.reply_text(f"Double Mine activated. You will receive double rewards until {until}.")
         elif text == "Cancel":
             await update.message.reply_text("Operation cancelled.")
         else:
             await update.message.reply_text("Invalid response. Please choose 'Yes, deduct and proceed' or 'Cancel'.")
-
-        context.user_data.pop('awaiting_double_mine', None)
         return
     elif text == "Swap 🔄":
         await update.message.reply_text("This feature would be available to Top earners 🏆.")
@@ -646,8 +424,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             amount = int(text)
             matic_balance = db.get_user_matic_balance(user_id)
-            if amount >= 60 and amount <= matic_balance:
-                db.update_matic_balance(user_id, -amount)
+            if amount >= 60 and amount <= matic_balance and db.withdraw_matic_balance(user_id, amount):
                 del context.user_data['awaiting_withdrawal_amount']
                 await update.message.reply_text(f"Withdrawal of {amount} MATIC would be processed shortly. Keep earning on MATIC!")
             else:
@@ -685,14 +462,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_double_mine(update, context)
     elif text == "Back":
         await handle_back(update, context)
-    elif text == "Done Task ✔":
-            await done_task(update, context)
-            return ADD_TASK_PROOF
+    elif text.startswith("Done Task ✔"):
+            return await done_task(update, context)
     elif user_id in ADMIN_IDS:
             if text == "Total users":
-                total_users = db.get_total_users()
+                total_users = db.get_stat_total('new_users')
                 await update.message.reply_text(f"Total users: {total_users}")
 
+            elif text == "Stats 📊":
+                await handle_stats(update, context)
+
             elif text == "Add Task":
                 await add_task(update, context)
                 return ADD_TASK
@@ -717,6 +496,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("❕")
     
+@track_handler
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     broadcast_message_id = context.user_data.get('broadcast_message_id')
     previous_message_id = context.user_data.get('previous_message_id')
@@ -726,14 +506,14 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=broadcast_message_id)
         except Exception as e:
-            print(f"Failed to delete old broadcast keyboard message: {e}")
+            log.warning("delete_message_failed", chat_id=update.effective_chat.id, error=str(e))
 
     # Delete the user's previous message if it exists
     if previous_message_id:
         try:
             await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=previous_message_id)
         except Exception as e:
-            print(f"Failed to delete user's previous message: {e}")
+            log.warning("delete_message_failed", chat_id=update.effective_chat.id, error=str(e))
 
     # Send the broadcast keyboard and store its message ID
     sent_message = await update.message.reply_text("Broadcast Menu:", reply_markup=broadcast_keyboard())
@@ -742,6 +522,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Store the ID of the user's current message to delete it later
     context.user_data['previous_message_id'] = update.message.message_id
 
+@track_handler
 async def broadcast_to_all_users(update: Update, context, text):
     # Fetch all user IDs from the database
     all_users = db.get_all_users()
@@ -765,9 +546,13 @@ async def broadcast_to_all_users(update: Update, context, text):
             # Send the personalized text message to each user
             await context.bot.send_message(chat_id=user_id, text=personalized_text)
             sent_count += 1
+            BROADCAST_MESSAGES.labels('sent').inc()
         except Exception as e:
-            print(f"Failed to send message to {user_id}: {str(e).splitlines()[0]}")
+            log.info("broadcast_failed", kind="text", user_id=user_id, error=str(e).splitlines()[0])
             failed_count += 1
+            BROADCAST_MESSAGES.labels('failed').inc()
+
+    db.add_stat('broadcast_deliveries', sent_count)
 
     # Notify admin after broadcasting to all users
     await update.message.reply_text(
@@ -798,9 +583,13 @@ async def broadcast_image_with_caption_to_all_users(context, photo, caption):
             # Send photo to each user with personalized caption
             await context.bot.send_photo(chat_id=user_id, photo=photo.file_id, caption=personalized_caption)
             success_count += 1
+            BROADCAST_MESSAGES.labels('sent').inc()
         except Exception as e:
-            print(f"Failed to send photo to {user_id}: {str(e).splitlines()[0]}")
+            log.info("broadcast_failed", kind="image", user_id=user_id, error=str(e).splitlines()[0])
             failure_count += 1
+            BROADCAST_MESSAGES.labels('failed').inc()
+
+    db.add_stat('broadcast_deliveries', success_count)
 
     # Send confirmation message to admin
     confirmation_message = (
@@ -816,6 +605,7 @@ async def broadcast_img_text_button_to_all_users(context, photo, caption, button
     admin_user_id = 5991907369
     error_messages = set()  # Use a set to collect unique error messages
     error_occurred = False
+    sent_count = 0
 
     for user_id in all_users:
         try:
@@ -839,14 +629,18 @@ async def broadcast_img_text_button_to_all_users(context, photo, caption, button
                     [[InlineKeyboardButton(button['text'], url=button['url'])]]
                 )
             )
+            sent_count += 1
+            BROADCAST_MESSAGES.labels('sent').inc()
         except Exception as e:
             error_occurred = True
-            error_message = f"Failed to send image with caption to {user_id}: {str(e).splitlines()[0]}"
-            print(error_message)
+            BROADCAST_MESSAGES.labels('failed').inc()
+            log.info("broadcast_failed", kind="image_button", user_id=user_id, error=str(e).splitlines()[0])
 
             # Add unique error messages to the set
             error_messages.add(str(e).splitlines()[0])
 
+    db.add_stat('broadcast_deliveries', sent_count)
+
     if error_occurred:
         # Send an aggregated error message to the admin
         aggregated_error_message = "Failed to send text with button to all users:\n" + "\n".join(error_messages)
@@ -860,6 +654,7 @@ async def broadcast_text_button_to_all_users(context, text, button):
     all_users = db.get_all_users()
     admin_user_id = 5991907369
     error_occurred = False  # Initialize the error flag
+    sent_count = 0
 
     for user_id in all_users:
         try:
@@ -882,10 +677,14 @@ async def broadcast_text_button_to_all_users(context, text, button):
                     [[InlineKeyboardButton(button['text'], url=button['url'])]]
                 )
             )
+            sent_count += 1
+            BROADCAST_MESSAGES.labels('sent').inc()
         except Exception as e:
             error_occurred = True  # Set the flag to True if an error occurs
-            error_message = f"Failed to send text with button to {user_id}: {str(e).splitlines()[0]}"
-            print(error_message)
+            BROADCAST_MESSAGES.labels('failed').inc()
+            log.info("broadcast_failed", kind="text_button", user_id=user_id, error=str(e).splitlines()[0])
+
+    db.add_stat('broadcast_deliveries', sent_count)
 
     # Check if any error occurred
     if error_occurred:
@@ -893,44 +692,32 @@ async def broadcast_text_button_to_all_users(context, text, button):
     else:
         confirmation_message = "Broadcast completed successfully to all users."
         await context.bot.send_message(chat_id=admin_user_id, text=confirmation_message)
-async def handle_time_speed(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    user_id = user.id
-
-    # Check if user has already enabled Time Speed
-    user_data = context.user_data.get(user_id, {})
-    if user_data.get('time_speed_enabled'):
-        await update.message.reply_text("You have already enabled Time Speed.")
+async def offer_booster(update: Update, context: ContextTypes.DEFAULT_TYPE, effect, description):
+    expires_at = db.get_active_boosters(update.message.from_user.id).get(effect)
+    if expires_at:
+        until = datetime.fromtimestamp(expires_at).strftime('%Y-%m-%d %H:%M')
+        await update.message.reply_text(f"You have already enabled {BOOSTER_NAMES[effect]} until {until}.")
         return
 
     # Ask the user if they want to proceed
     reply_markup = ReplyKeyboardMarkup([[KeyboardButton("Yes, deduct and proceed"), KeyboardButton("Cancel")]], resize_keyboard=True)
-    await update.message.reply_text("Do you want to proceed? The bot is about to deduct 20 MATIC coins to speed up your daily claim time from 24 hours to 18 hours.", reply_markup=reply_markup)
+    await update.message.reply_text(f"Do you want to proceed? The bot is about to deduct {BOOSTER_COST} MATIC coins to {description} for {BOOSTER_DAYS:g} days.", reply_markup=reply_markup)
+    context.user_data['awaiting_booster'] = effect
 
-    # Set the awaiting_time_speed context
-    context.user_data['awaiting_time_speed'] = True
+@track_handler
+async def handle_time_speed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await offer_booster(update, context, 'time_speed', "speed up your daily claim time from 24 hours to 18 hours")
 
+@track_handler
 async def handle_double_mine(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    user_id = user.id
-
-    # Check if user has already enabled Double Mine
-    user_data = context.user_data.get(user_id, {})
-    if user_data.get('double_mine_enabled'):
-        await update.message.reply_text("You have already enabled Double Mine.")
-        return
-
-    # Ask the user if they want to proceed
-    reply_markup = ReplyKeyboardMarkup([[KeyboardButton("Yes, deduct and proceed"), KeyboardButton("Cancel")]], resize_keyboard=True)
-    await update.message.reply_text("Do you want to proceed? The bot is about to deduct 20 MATIC coins to double your mining rewards for a limited time.", reply_markup=reply_markup)
-
-    # Set the awaiting_double_mine context
-    context.user_data['awaiting_double_mine'] = True
+    await offer_booster(update, context, 'double_mine', "double your mining rewards")
 
+@track_handler
 async def handle_clear_task_proofs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db.clear_task_proofs()
     await update.message.reply_text("Cleared the first 15 task proofs.")
 
+@track_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     main_menu_keyboard = [
@@ -945,6 +732,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return
 
 
+@track_handler
 async def handle_edit_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     keyboard = [[KeyboardButton("Cancel")]]
@@ -953,6 +741,7 @@ async def handle_edit_address(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     context.user_data['awaiting_address'] = True
 
+@track_handler
 async def handle_join_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("🔗 Join Channel", url=CHANNEL_JOIN_LINKS[0])]
@@ -960,6 +749,7 @@ async def handle_join_channels(update: Update, context: ContextTypes.DEFAULT_TYP
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Ensure you are in all the channels:", reply_markup=reply_markup)
 
+@track_handler
 async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     main_menu_keyboard = [
         [KeyboardButton("Mine Matic 🔨"), KeyboardButton("Wallet 💰")],
@@ -971,44 +761,35 @@ async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = ReplyKeyboardMarkup(main_menu_keyboard, resize_keyboard=True)
     await update.message.reply_text("Main Menu:", reply_markup=reply_markup)
 
+@track_handler
 async def handle_mine_matic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    not_joined_channels = []
-
-    for channel in CHANNEL_USERNAMES:
-        try:
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user.id)
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                not_joined_channels.append(channel)
-        except Exception as e:
-            print(f"Error checking membership for {channel}: {e}")
-            not_joined_channels.append(channel)
+    not_joined_channels = await membership.not_joined(context.bot, user.id, fail_open=MEMBERSHIP_REWARD_FAIL_OPEN)
 
     if not_joined_channels:
         channels_not_joined = "\n".join([channel for channel in not_joined_channels])
         await update.message.reply_text(f"Please join all channels from the Settings ⚙️ to use this feature. You have not joined:\n{channels_not_joined}")
         return
 
-    last_claim_time = db.get_last_claim_time(user.id)
-    if last_claim_time:
-        time_since_last_claim = datetime.now() - last_claim_time
-        time_left = timedelta(hours=24) - time_since_last_claim
-        if time_left > timedelta(0):
+    # Boosters are applied inside the claim
+    reward, time_left = db.claim_matic(user.id)
+    if not reward:
+        if time_left:
             hours, remainder = divmod(time_left.seconds, 3600)
             minutes, seconds = divmod(remainder, 60)
             await update.message.reply_text(f"You can mine in the next {hours} hours and {minutes} minutes.")
-            return
+        return
 
-    db.update_matic_balance(user.id, 1)
-    db.update_last_claim_time(user.id)
-    await update.message.reply_text("You have successfully claimed 1 MATIC.")
+    await update.message.reply_text(f"You have successfully claimed {reward} MATIC.")
 
 
+@track_handler
 async def handle_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     balance = db.get_user_matic_balance(user.id)
     await update.message.reply_text(f"Your MATIC wallet balance is {balance} MATIC.\n\n\nKeep mining MATIC on the bot to increase your chances of withdrawal before the airdrop ends 🛠🔨")
 
+@track_handler
 async def handle_exchange(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_id = user.id
@@ -1025,19 +806,12 @@ async def handle_exchange(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = ReplyKeyboardMarkup(exchange_keyboard, resize_keyboard=True)
     await update.message.reply_text("Exchange Menu:", reply_markup=reply_markup)
 
+@track_handler
 async def handle_invite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    not_joined_channels = []
     user_id = update.effective_user.id
 
-    for channel in CHANNEL_USERNAMES:
-        try:
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user.id)
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                not_joined_channels.append(channel)
-        except Exception as e:
-            print(f"Error checking membership for {channel}: {e}")
-            not_joined_channels.append(channel)
+    not_joined_channels = await membership.not_joined(context.bot, user.id)
 
     if not_joined_channels:
         channels_not_joined = "\n".join([channel for channel in not_joined_channels])
@@ -1048,6 +822,7 @@ async def handle_invite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Invite your friends using this link: {referral_link}\n\nKeep referring your friends to stand a chance to participate in the $2000 giveaway \nYou earn 5 MATIC coins for every referral that mines MATIC on the bot through your link. \n\n No of Referrals 👥 : {referral_count}")
 
 
+@track_handler
 async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_data = db.get_user_data(user.id)
@@ -1059,6 +834,7 @@ async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("User data not found.")
 
 
+@track_handler
 async def handle_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings_keyboard = [
         [KeyboardButton("Edit Address"), KeyboardButton("Join Channels")],
@@ -1067,32 +843,25 @@ async def handle_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = ReplyKeyboardMarkup(settings_keyboard, resize_keyboard=True)
     await update.message.reply_text("Settings Menu:", reply_markup=reply_markup)
 
+@track_handler
 async def handle_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("This Bot allows you to mine MATIC tokens by completing tasks, inviting friends, and more!\n\nKeep mining and also stand a chance of participating in the $2000 Giveaway!")
 
+@track_handler
 async def handle_boosters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_id = user.id
-    not_joined_channels = []
-
-    for channel in CHANNEL_USERNAMES:
-        try:
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user.id)
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                not_joined_channels.append(channel)
-        except Exception as e:
-            print(f"Error checking membership for {channel}: {e}")
-            not_joined_channels.append(channel)
+    not_joined_channels = await membership.not_joined(context.bot, user.id, fail_open=MEMBERSHIP_REWARD_FAIL_OPEN)
 
     if not_joined_channels:
         channels_not_joined = "\n".join([channel for channel in not_joined_channels])
         await update.message.reply_text(f"Please join all channels from the Settings ⚙️ to use this feature. You have not joined:\n{channels_not_joined}")
         return
 
-    # Check if user has at least 20 MATIC coins
+    # Check if user can afford a booster
     matic_balance = db.get_user_matic_balance(user_id)
-    if matic_balance < 20:
-        await update.message.reply_text("You need at least 20 MATIC coins to use boosters.")
+    if matic_balance < BOOSTER_COST:
+        await update.message.reply_text(f"You need at least {BOOSTER_COST} MATIC coins to use boosters.")
         return
 
     # Ask the user to choose an option
@@ -1105,62 +874,67 @@ async def handle_boosters(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+def pending_tasks(user_id):
+    # Active tasks the user has not completed, answered from the in-memory catalogue
+    return [task for task in db.get_tasks() if not db.has_user_completed_task(user_id, task[0])]
+
+@track_handler
 async def handle_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    tasks = db.get_tasks()
     user_id = update.effective_user.id
-    not_joined_channels = []
-
-    print(f"User ID: {user_id}")
-    print(f"CHANNEL_USERNAMES: {CHANNEL_USERNAMES}")
-
-    for channel in CHANNEL_USERNAMES:
-        try:
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
-            print(f"Chat member status for {channel}: {chat_member.status}")
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                not_joined_channels.append(channel)
-        except Exception as e:
-            print(f"Error checking membership for {channel}: {e}")
-            not_joined_channels.append(channel)
+    not_joined_channels = await membership.not_joined(context.bot, user_id, fail_open=MEMBERSHIP_REWARD_FAIL_OPEN)
 
     if not_joined_channels:
         channels_not_joined = "\n".join([channel for channel in not_joined_channels])
         await update.message.reply_text(f"Please join all channels from the Settings ⚙️ to use this feature. You have not joined:\n{channels_not_joined}")
         return
 
-    if not tasks:
+    if not db.get_tasks():
         await update.message.reply_text("There are no tasks available, check back later.")
         return
 
-    for task in tasks:
-        photo_file_id = task[0]
-        description = task[1]
-        try:
-            await update.message.reply_photo(photo=photo_file_id, caption=description)
-        except BadRequest as e:
-            print(f"Error sending photo with file_id {photo_file_id}: {e}")
+    tasks = pending_tasks(user_id)
+    if not tasks:
+        await update.message.reply_text("You have completed all the current tasks, kindly wait for a new one")
+        return
 
-    tasks_keyboard = [[KeyboardButton("Done Task ✔"), KeyboardButton("Back")]]
+    # Task pictures are sent again only when the catalogue changed since this user last saw it
+    if context.user_data.get('tasks_seen_version') != db.task_version:
+        for task_id, photo_file_id, description in tasks:
+            try:
+                await update.message.reply_photo(photo=photo_file_id, caption=f"Task #{task_id}\n\n{description}")
+            except BadRequest as e:
+                log.warning("task_photo_failed", photo_file_id=photo_file_id, error=str(e))
+        context.user_data['tasks_seen_version'] = db.task_version
+    else:
+        await update.message.reply_text("\n\n".join(f"<b>Task #{task_id}</b>\n{description}" for task_id, _, description in tasks), parse_mode="HTML")
+
+    tasks_keyboard = [[KeyboardButton(f"Done Task ✔ #{task_id}")] for task_id, _, _ in tasks] + [[KeyboardButton("Back")]]
     reply_markup = ReplyKeyboardMarkup(tasks_keyboard, resize_keyboard=True)
     user = update.message.from_user
     user_id = update.effective_user.id
     referral_link = f"https://t.me/matic_airdbot?start={user.id}"
     await update.message.reply_text(f"<b>Task Instructions</b>:\n\n📝Follow the instructions\n📝Share your invite link to your Whatsapp/Telegram Status/Story\n📝Copy the write up below 👇 by clicking on it\n<code>Looking for a way to mine free MATIC tokens? use my referral link to mine free MATIC tokens and stand a chance in participating in the $2000 giveaway \n\n {referral_link} </code>\n📝Click on done task and send screenshot of Task Done ✔", reply_markup=reply_markup, parse_mode="HTML")
 
+@track_handler
 async def handle_task_proof(update: Update, context: ContextTypes.DEFAULT_TYPE):
     task_proofs = db.get_task_proofs()
     if not task_proofs:
         await update.message.reply_text("No task proofs submitted yet.")
         return
 
-    for user_id, photo_file_id in task_proofs:
-        await update.message.reply_photo(photo=photo_file_id, caption=f"Proof submitted by user <code>{user_id}</code>", parse_mode="HTML")
+    for user_id, photo_file_id, duplicate_of, duplicate_user_id, distance, task_id in task_proofs:
+        caption = f"Proof for task #{task_id} submitted by user <code>{user_id}</code>"
+        if duplicate_of:
+            owner = "their own" if duplicate_user_id == user_id else f"user <code>{duplicate_user_id}</code>'s"
+            caption += f"\n⚠️ Likely duplicate of {owner} proof #{duplicate_of} ({distance} bits apart)"
+        await update.message.reply_photo(photo=photo_file_id, caption=caption, parse_mode="HTML")
     clear_button = [[KeyboardButton("Clear Proofs💨"), KeyboardButton("👨‍💼 Menu")]]
     reply_markup = ReplyKeyboardMarkup(clear_button, resize_keyboard=True)
     await update.message.reply_text("End of task proofs.", reply_markup=reply_markup)
 
 
 
+@track_handler
 async def handle_giveaways(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     referral_count = db.get_referral_count(user.id)
@@ -1169,9 +943,53 @@ async def handle_giveaways(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("Join the giveaway channel here: [https://t.me/maticgiveaways]")
 
+STATS_LABELS = [
+    ('new_users', "New users"),
+    ('verifications', "Verifications"),
+    ('claims', "Claims"),
+    ('referrals', "Referrals"),
+    ('task_proofs', "Task proofs"),
+    ('withdrawals', "Withdrawals"),
+    ('withdrawn_matic', "MATIC withdrawn"),
+    ('broadcast_deliveries', "Broadcast deliveries"),
+]
+
+def format_trend(today, yesterday):
+    if not yesterday:
+        return "new" if today else "–"
+    return f"{(today - yesterday) / yesterday:+.0%}"
+
+def html_messages(lines, limit=BROADCAST_MAX_TEXT):
+    # Packs whole lines into messages of at most `limit` characters, so an
+    # HTML tag is never cut in half (Telegram rejects the whole message then)
+    messages = [""]
+    for line in lines:
+        if messages[-1] and len(messages[-1]) + 1 + len(line) > limit:
+            messages.append("")
+        messages[-1] = f"{messages[-1]}\n{line}" if messages[-1] else line[:limit]
+    return messages
+
+def shorten_list(values, limit=200):
+    # Cuts a comma separated list at a comma so no id is split
+    if len(values) <= limit:
+        return values
+    return values[:values.rfind(',', 0, limit)] + ",…"
+
+@track_handler
+async def handle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Reads only the rollup tables, so this costs the same at any table size
+    stats = db.get_stats()
+    lines = ["<b>📊 Stats</b> (total | today | yesterday | trend)\n"]
+    for metric, label in STATS_LABELS:
+        total = stats['totals'].get(metric, 0)
+        today = stats['today'].get(metric, 0)
+        yesterday = stats['yesterday'].get(metric, 0)
+        lines.append(f"<b>{label}:</b> {total} | {today} | {yesterday} | {format_trend(today, yesterday)}")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
 def admin_keyboard():
     keyboard = [
-        [KeyboardButton("Total users")],
+        [KeyboardButton("Total users"), KeyboardButton("Stats 📊")],
         [KeyboardButton("Add Task")],
         [KeyboardButton("Task Proof")],
         [KeyboardButton("Top Ref 🏆")],
@@ -1180,6 +998,7 @@ def admin_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@track_handler
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     if user_id in ADMIN_IDS:
@@ -1187,6 +1006,7 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("You are not authorized to use this command.")
 
+@track_handler
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     if user_id in ADMIN_IDS:
@@ -1203,6 +1023,7 @@ def broadcast_keyboard():
     ]  
     return InlineKeyboardMarkup(keyboard)  
 
+@track_handler
 async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()  # Acknowledge the callback to prevent timeout
@@ -1246,45 +1067,70 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.effective_chat.send_message("Operation Ended")
  
 
+@track_handler
 async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[KeyboardButton("Cancel"), KeyboardButton("👨‍💼 Menu")]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text("Please send the task picture with a caption.", reply_markup=reply_markup)
     return ADD_TASK
 
+@track_handler
 async def save_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo = update.message.photo[-1]
     caption = update.message.caption
-    db.save_task(photo.file_id, caption)
-    await update.message.reply_text("Task added successfully!", reply_markup=admin_keyboard())
-    all_users = db.get_all_users()
-    for user_id in all_users:
-        try:
-            await context.bot.send_message(chat_id=user_id, text="A new task has been posted, ensure you do it and get paid.")
-        except RetryAfter as e:
-            await asyncio.sleep(e.retry_after)
-            await context.bot.send_message(chat_id=user_id, text="A new task has been posted, ensure you do it and get paid.")
-        except TelegramError:
-            # You can handle specific TelegramError if needed
-            pass
+    # Every user is notified through the outbox instead of looping over them here
+    task_id = db.save_task(photo.file_id, caption, notify="A new task has been posted, ensure you do it and get paid.")
+    outbox_sender.wake()
+    await update.message.reply_text(f"Task #{task_id} added successfully! End it with /endtask {task_id}", reply_markup=admin_keyboard())
+
+@track_handler
+async def endtask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    try:
+        task_id = int(context.args[0])
+    except (IndexError, ValueError):
+        active = ", ".join(f"#{task_id}" for task_id, _, _ in db.get_tasks()) or "none"
+        await update.message.reply_text(f"Usage: /endtask <task id>\nActive tasks: {active}")
+        return
+
+    if db.end_task(task_id):
+        await update.message.reply_text(f"Task #{task_id} ended.")
+    else:
+        await update.message.reply_text(f"Task #{task_id} is not an active task.")
 
 
+@track_handler
 async def done_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    if db.has_user_completed_task(user_id):
-        await update.message.reply_text("You had earlier completed the current task, kindly wait for a new one")
+    tasks = pending_tasks(user_id)
+    # "Done Task ✔ #<id>" names the task; the plain button means the oldest pending one
+    match = re.search(r'#(\d+)', update.message.text)
+    if match:
+        tasks = [task for task in tasks if task[0] == int(match.group(1))]
+    if not tasks:
+        await update.message.reply_text("You had earlier completed this task, kindly wait for a new one")
         return ConversationHandler.END
+    context.user_data['proof_task_id'] = tasks[0][0]
     keyboard = [[KeyboardButton("Cancel")]]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text("Please send a screenshot of the completed task.", reply_markup=markup)
     return ADD_TASK_PROOF
 
+@track_handler
 async def save_task_proof(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo = update.message.photo[-1]
     user_id = update.message.from_user.id
 
-    db.save_task_proof(user_id, photo.file_id)
-    db.save_task_completion(user_id)
+    task_id = context.user_data.pop('proof_task_id', None)
+    if task_id is None:
+        tasks = pending_tasks(user_id)
+        task_id = tasks[0][0] if tasks else None
+    db.save_task_proof(user_id, photo.file_id, task_id)
+    db.save_task_completion(user_id, task_id)
+    proof_hasher.wake()
     main_menu_keyboard = [
                 [KeyboardButton("Mine Matic 🔨"), KeyboardButton("Wallet 💰")],
                 [KeyboardButton("Exchange 🏦"), KeyboardButton("Invite 👥")],
@@ -1301,17 +1147,22 @@ add_task_conv_handler = ConversationHandler(
     states={
         ADD_TASK: [MessageHandler(filters.PHOTO & filters.CAPTION, save_task)]
     },
-    fallbacks=[CommandHandler('cancel', cancel)]
+    fallbacks=[CommandHandler('cancel', cancel)],
+    name='add_task',
+    persistent=True,
 )
 
 add_task_proof_conv_handler = ConversationHandler(
-    entry_points=[MessageHandler(filters.Text('Done Task ✔'), done_task)],
+    entry_points=[MessageHandler(filters.Regex(r'^Done Task ✔'), done_task)],
     states={
         ADD_TASK_PROOF: [MessageHandler(filters.PHOTO, save_task_proof)]
     },
-    fallbacks=[CommandHandler('cancel', cancel)]
+    fallbacks=[CommandHandler('cancel', cancel)],
+    name='add_task_proof',
+    persistent=True,
 )
 
+@track_handler
 async def appv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id not in ADMIN_IDS:
         await update.message.reply_text("You are not authorized to use this command.")
@@ -1330,28 +1181,30 @@ async def appv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for user_id in user_ids:
         user_id = int(user_id)
 
-        # Add 10 MATIC to user's balance
-        db.update_matic_balance(user_id, 10)
-
         # Get the date of the task proof submission
         proof_date = db.get_task_proof_date(user_id)
         if proof_date:
             try:
                 proof_date = datetime.strptime(proof_date, '%Y-%m-%d %H:%M:%S.%f').strftime('%Y-%m-%d')
             except ValueError:
+                db.update_matic_balance(user_id, 10)
                 await update.message.reply_text(f"Error: Invalid date format retrieved from database for user {user_id}.")
                 continue
 
-        # Send confirmation message
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"The task you applied for, posted on {proof_date}, has been approved ✔. You have received 10 MATIC coins."
+        db.mark_proofs_reviewed(user_id)
+
+        # Add 10 MATIC to user's balance and queue the confirmation with it
+        db.update_matic_balance(
+            user_id, 10,
+            notify=f"The task you applied for, posted on {proof_date}, has been approved ✔. You have received 10 MATIC coins."
         )
+        outbox_sender.wake()
 
         await update.message.reply_text(f"Approved task proof for user {user_id}.")
 
     await update.message.reply_text("Task proofs approved for the specified users.")
 
+@track_handler
 async def dispv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id not in ADMIN_IDS:
         await update.message.reply_text("You are not authorized to use this command.")
@@ -1370,16 +1223,269 @@ async def dispv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for user_id in user_ids:
         user_id = int(user_id)
 
-        # Send disapproval message
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="Your task was Disapproved ❌, please perform the task next time."
-        )
+        db.mark_proofs_reviewed(user_id)
+
+        # Queue disapproval message
+        db.enqueue_notification(user_id, "Your task was Disapproved ❌, please perform the task next time.")
+        outbox_sender.wake()
 
         await update.message.reply_text(f"Disapproved task proof for user {user_id}.")
 
     await update.message.reply_text("Task proofs disapproved for the specified users.")
 
+@track_handler
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+    except ValueError:
+        await update.message.reply_text("Usage: /profile <seconds>")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if sampling_profiler.running:
+        await update.message.reply_text("A profile is already running.")
+        return
+
+    await update.message.reply_text(f"Profiling for {seconds} seconds...")
+    # Sampled in the background so the admin's own updates are not held up meanwhile
+    context.application.create_task(send_profile(context.bot, update.effective_chat.id, seconds, threading.get_ident()))
+
+async def send_profile(bot, chat_id, seconds, thread_id):
+    try:
+        stacks = await asyncio.to_thread(sampling_profiler.sample, seconds, thread_id)
+    except RuntimeError as e:
+        await bot.send_message(chat_id=chat_id, text=str(e))
+        return
+
+    # Collapsed stacks, ready for flamegraph.pl or speedscope
+    document = io.BytesIO(folded(stacks).encode())
+    filename = f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded"
+    await bot.send_document(chat_id=chat_id, document=document, filename=filename, caption=summary(stacks)[:1024])
+
+PAYOUT_COLUMNS = ('withdrawal_id', 'user_id', 'username', 'amount', 'matic_wallet', 'requested_at')
+
+def write_payout_export(path, fmt):
+    # Streams pending withdrawals to disk; returns (rows, last withdrawal id)
+    count, last_id = 0, None
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(PAYOUT_COLUMNS)
+        for row in db.iter_pending_withdrawals():
+            if writer:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(dict(zip(PAYOUT_COLUMNS, row)), ensure_ascii=False) + '\n')
+            count += 1
+            last_id = row[0]
+    return count, last_id
+
+@track_handler
+async def payouts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    fmt = context.args[0].lower() if context.args else 'csv'
+    if fmt not in ('csv', 'jsonl'):
+        await update.message.reply_text("Usage: /payouts [csv|jsonl]")
+        return
+
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        # Written in a worker thread, so a large export never stalls the event loop
+        count, last_id = await asyncio.to_thread(write_payout_export, path, fmt)
+        if not count:
+            await update.message.reply_text("No pending withdrawals.")
+            return
+        with open(path, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=f,
+                filename=f"payouts-{datetime.now():%Y%m%d-%H%M%S}.{fmt}",
+                caption=f"{count} pending withdrawals. After paying them send /markpaid {last_id}",
+            )
+    finally:
+        os.remove(path)
+
+@track_handler
+async def markpaid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    try:
+        through_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Usage: /markpaid <last withdrawal id from the export>")
+        return
+
+    completed = db.complete_withdrawals(through_id, notify="Your MATIC withdrawal has been paid to your wallet ✅")
+    outbox_sender.wake()
+    await update.message.reply_text(f"Marked {completed} withdrawals as paid.")
+
+@track_handler
+async def exportproofs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    try:
+        since = datetime.strptime(context.args[0], '%Y-%m-%d')
+        until = datetime.strptime(context.args[1], '%Y-%m-%d') if len(context.args) > 1 else datetime.now()
+    except (IndexError, ValueError):
+        await update.message.reply_text("Usage: /exportproofs <from YYYY-MM-DD> [to YYYY-MM-DD]")
+        return
+
+    await update.message.reply_text(f"Exporting proofs from {since:%Y-%m-%d} to {until:%Y-%m-%d}...")
+    # Runs in the background so the admin's own updates are not held up meanwhile
+    context.application.create_task(send_proof_archive(context.bot, update.effective_chat.id, since, until))
+
+async def send_proof_archive(bot, chat_id, since, until):
+    directory = tempfile.mkdtemp(prefix='proofs-')
+    writer = ArchiveWriter(directory, f"proofs-{since:%Y%m%d}-{until:%Y%m%d}", max_bytes=PROOF_ARCHIVE_MB * 1024 * 1024)
+    try:
+        # The end date is inclusive
+        proofs = db.iter_task_proofs(f"{since:%Y-%m-%d}", f"{until + timedelta(days=1):%Y-%m-%d}")
+        paths = await export_proofs(bot, proofs, writer, concurrency=PROOF_EXPORT_CONCURRENCY)
+        if not paths:
+            await bot.send_message(chat_id=chat_id, text="No proofs in that date range.")
+            return
+        for path in paths:
+            with open(path, 'rb') as f:
+                await bot.send_document(chat_id=chat_id, document=f, filename=os.path.basename(path))
+        await bot.send_message(chat_id=chat_id, text=f"Exported {writer.written} proofs in {len(paths)} archive(s), {writer.missing} could not be downloaded.")
+    except Exception as e:
+        log.error("proof_export_failed", error=str(e))
+        await bot.send_message(chat_id=chat_id, text=f"Proof export failed: {e}")
+    finally:
+        for path in writer.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+@track_handler
+async def clusters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    lines = ["<b>Wallets shared by several accounts</b>"]
+    for wallet, accounts, user_ids in db.get_wallet_clusters(limit=15):
+        lines.append(f"<code>{html.escape(wallet)}</code>: {accounts} accounts ({shorten_list(user_ids)})")
+    lines.append("\n<b>Referrers whose referrals share wallets</b> (referred | distinct wallets | referrer's own wallet)")
+    for referrer_id, referred, wallets, own_wallet in db.get_referrer_clusters(limit=15):
+        lines.append(f"<code>{referrer_id}</code>: {referred} | {wallets} | {html.escape(str(own_wallet))}")
+    for text in html_messages(lines):
+        await update.message.reply_text(text, parse_mode="HTML")
+
+@track_handler
+async def reftree(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    if not context.args:
+        lines = ["<b>Largest referral trees</b> (direct | all levels)"]
+        for user_id, username, first_name, direct, downstream in db.get_largest_subtrees(limit=15):
+            handle = f" @{html.escape(username)}" if username else f" {html.escape(first_name or '')}"
+            lines.append(f"<code>{user_id}</code>{handle}: {direct} | {downstream}")
+        lines.append("\nUse /reftree <user id> [depth] for one user's chain and levels.")
+        await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+        return
+
+    try:
+        user_id = int(context.args[0])
+        max_depth = int(context.args[1]) if len(context.args) > 1 else 10
+    except ValueError:
+        await update.message.reply_text("Usage: /reftree [user id] [depth]")
+        return
+
+    chain = db.get_referral_chain(user_id)
+    lines = [f"<b>Referral chain of</b> <code>{user_id}</code>"]
+    if not chain:
+        lines.append("Not referred by anyone.")
+    for depth, ancestor_id, username, first_name in chain[:30]:
+        handle = f" @{html.escape(username)}" if username else f" {html.escape(first_name or '')}"
+        lines.append(f"{depth}. <code>{ancestor_id}</code>{handle}")
+    if len(chain) > 30:
+        lines.append(f"... {len(chain) - 30} more up to the root")
+    lines.append(f"\n<b>Downstream</b>: {db.get_downstream_count(user_id, max_depth)} users within "
+                 f"{max_depth} levels, {db.get_downstream_count(user_id)} in total")
+    for depth, users in db.get_downstream_levels(user_id, max_depth):
+        lines.append(f"Level {depth}: {users}")
+    for text in html_messages(lines):
+        await update.message.reply_text(text, parse_mode="HTML")
+
+SEARCH_PAGE_SIZE = 10
+
+async def send_search_page(send, text, after_id):
+    # send is reply_text for the first page and edit_message_text for the next ones
+    rows = db.search_users(text, after_id, SEARCH_PAGE_SIZE + 1)
+    more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if not rows:
+        await send("No users found." if not after_id else "No more users found.")
+        return
+    lines = [f"<b>Users matching</b> {html.escape(text)}"]
+    for user_id, username, first_name, last_name, balance, referrals, verified in rows:
+        name = html.escape(" ".join(filter(None, (first_name, last_name))))
+        handle = f" @{html.escape(username)}" if username else ""
+        lines.append(f"\n<code>{user_id}</code>{handle} {name}\n"
+                     f"💰 {balance} MATIC | 👥 {referrals} | {'✅ verified' if verified else '❌ not verified'}")
+    reply_markup = None
+    if more:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Next ▶", callback_data=f"usersearch:{rows[-1][0]}")]])
+    await send("\n".join(lines), parse_mode="HTML", reply_markup=reply_markup)
+
+@track_handler
+async def finduser(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    text = " ".join(context.args)
+    if not text:
+        await update.message.reply_text("Usage: /finduser <@username, name or user id>")
+        return
+    context.user_data['user_search'] = text
+    await send_search_page(update.message.reply_text, text, 0)
+
+@track_handler
+async def user_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        return
+    text = context.user_data.get('user_search')
+    if not text:
+        await query.edit_message_text("This search has expired, please run /finduser again.")
+        return
+    await send_search_page(query.edit_message_text, text, int(query.data.split(':', 1)[1]))
+
+@track_handler
+async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    usage = state_evictor.report()
+    lines = [
+        "<b>user_data in memory</b>",
+        f"Users held: {len(context.application.user_data)} (idle after {USER_STATE_TTL // 60} min)",
+        f"Evicted since start: {state_evictor.evicted}",
+        "\n<b>Key</b>: entries | approx. bytes",
+    ]
+    for key, (entries, size) in list(usage.items())[:25]:
+        lines.append(f"<code>{html.escape(str(key))}</code>: {entries} | {size}")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+@track_handler
 async def most_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id, referral_count = db.get_user_with_most_referrals()
     if user_id:
@@ -1387,17 +1493,69 @@ async def most_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("No referrals found.")
 
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application):
+    outbox_sender.start(application.bot)
+    proof_hasher.start(application.bot)
+    archiver.start()
+    booster_sweeper.start()
+    persistence.start()
+    state_evictor.start(application)
+    loop_monitor.start()
+
+async def post_shutdown(application: Application):
+    await loop_monitor.stop()
+    await state_evictor.stop()
+    await persistence.stop()
+    await booster_sweeper.stop()
+    await archiver.stop()
+    await proof_hasher.stop()
+    await outbox_sender.stop()
+
+def build_application(token=BOT_TOKEN, base_url=None, base_file_url=None, application_class=SequencedApplication):
+    # base_url and base_file_url point the bot at another Bot API server, e.g. the fake one in benchmarks/
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .request(request_from_env('BOT_API', BOT_API_POOL_SIZE))
+        .get_updates_request(request_from_env('UPDATES', UPDATES_POOL_SIZE))
+        .application_class(application_class)
+        .persistence(persistence)
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    application = builder.build()
+    UPDATE_QUEUE_DEPTH.set_function(application.update_queue.qsize)
+    OUTBOX_PENDING.set_function(lambda: outbox_sender.pending)
+
+    application.add_handler(state_evictor.handler(), group=-3)
+    flood_control = FloodControl(FLOOD_RATE, FLOOD_BURST, costs=FLOOD_ACTION_COSTS, exempt=ADMIN_IDS)
+    application.add_handler(flood_control.handler(), group=-2)
+    # After flood control, so dropped updates cost no database read
+    application.add_handler(TypeHandler(Update, refresh_user_info), group=-1)
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin))
     application.add_handler(CommandHandler("appv", appv))
     application.add_handler(CommandHandler("dispv", dispv))
+    application.add_handler(CommandHandler("profile", profile))
+    application.add_handler(CommandHandler("payouts", payouts))
+    application.add_handler(CommandHandler("markpaid", markpaid))
+    application.add_handler(CommandHandler("clusters", clusters))
+    application.add_handler(CommandHandler("reftree", reftree))
+    application.add_handler(CommandHandler("exportproofs", exportproofs))
+    application.add_handler(CommandHandler("endtask", endtask))
+    application.add_handler(CommandHandler("memory", memory))
+    application.add_handler(CommandHandler("finduser", finduser))
     application.add_handler(add_task_conv_handler)
     application.add_handler(add_task_proof_conv_handler)
 
     application.add_handler(CallbackQueryHandler(subscribed, pattern="subscribed"))
+    application.add_handler(CallbackQueryHandler(user_search_page, pattern=r"^usersearch:\d+$"))
     application.add_handler(CallbackQueryHandler(handle_button_click))
     message_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
     photo_handler = MessageHandler(filters.PHOTO, handle_message) 
@@ -1407,13 +1565,19 @@ def main():
     application.add_handler(message_handler)
     application.add_handler(photo_handler)
 
+    return application
+
+def main():
+    application = build_application()
     application.run_polling()
 
 def run_web_server():
     port = int(os.environ.get('PORT', 5000))
-    handler = http.server.SimpleHTTPRequestHandler
+    # Serves /metrics and a plain 200 for keep-alive pings. Never serve files from the working directory,
+    # it contains the database and .env.
+    handler = MetricsRequestHandler
     with socketserver.TCPServer(("", port), handler) as httpd:
-        print(f"Serving at port {port}")
+        log.info("web_server_started", port=port)
         httpd.serve_forever()
 
 if __name__ == '__main__':
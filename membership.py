@@ -0,0 +1,143 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from eventlog import log
+from metrics import BREAKER_STATE, MEMBERSHIP_FALLBACKS
+
+JOINED_STATUSES = ('member', 'administrator', 'creator')
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures (errors or calls over
+    # the latency budget) and turns calls away for reset_timeout seconds.
+    # After that it lets `probes` calls through at a time: one success closes
+    # it again, a failure re-opens it for another reset_timeout.
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, probes=1, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = 0
+        BREAKER_STATE.labels(name).set(0)
+
+    def allow(self):
+        if self.state == OPEN:
+            if self.clock() - self._opened_at < self.reset_timeout:
+                return False
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing >= self.probes:
+                return False
+            self._probing += 1
+        return True
+
+    def record_success(self):
+        if self.state == HALF_OPEN:
+            self._probing -= 1
+        self.failures = 0
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def record_neutral(self):
+        # A call that says nothing about the endpoint's health (our own flood
+        # limit) hands its probe back without changing the state
+        if self.state == HALF_OPEN:
+            self._probing -= 1
+
+    def record_failure(self):
+        if self.state == HALF_OPEN:
+            self._probing -= 1
+            self._open()
+            return
+        self.failures += 1
+        if self.state == CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self._opened_at = self.clock()
+        self._set_state(OPEN)
+
+    def _set_state(self, state):
+        log.warning("circuit_breaker_state", endpoint=self.name, state=state, failures=self.failures)
+        self.state = state
+        if state == CLOSED:
+            self._probing = 0
+        BREAKER_STATE.labels(self.name).set(STATE_VALUES[state])
+
+
+class MembershipChecker:
+    # Channel membership checks for the gated handlers.  Each get_chat_member
+    # call gets at most `budget` seconds and goes through the endpoint's
+    # circuit breaker.  When the call times out, errors or is turned away by
+    # an open breaker, the user's last known status is used instead, and a
+    # user never seen before is let through when fail_open is set (callers
+    # can override it per check): during a Telegram-side incident users keep
+    # their access and handlers never wait out full timeouts.
+    # RetryAfter is our own bot hitting the flood limit, not an outage: it
+    # leaves the breaker alone and only answers from the last known status
+    # until the retry_after window has passed.
+    def __init__(self, channels, budget=2.0, failure_threshold=5, reset_timeout=30.0, probes=1,
+                 cache_size=200000, fail_open=True, clock=time.monotonic):
+        self.channels = channels
+        self.budget = budget
+        self.cache_size = cache_size
+        self.fail_open = fail_open
+        self.clock = clock
+        self.breaker = CircuitBreaker('getChatMember', failure_threshold, reset_timeout, probes, clock=clock)
+        self._flood_until = 0.0
+        # (channel, user id) -> joined, least recently checked first
+        self._known = OrderedDict()
+
+    async def not_joined(self, bot, user_id, fail_open=None):
+        fail_open = self.fail_open if fail_open is None else fail_open
+        joined = await asyncio.gather(*(self.is_member(bot, channel, user_id, fail_open) for channel in self.channels))
+        return [channel for channel, member in zip(self.channels, joined) if not member]
+
+    async def is_member(self, bot, channel, user_id, fail_open=None):
+        fail_open = self.fail_open if fail_open is None else fail_open
+        if self.clock() < self._flood_until:
+            return self._fallback(channel, user_id, 'flood', fail_open)
+        if not self.breaker.allow():
+            return self._fallback(channel, user_id, 'open', fail_open)
+        try:
+            chat_member = await asyncio.wait_for(
+                bot.get_chat_member(chat_id=channel, user_id=user_id, read_timeout=self.budget), self.budget)
+        except RetryAfter as e:
+            self.breaker.record_neutral()
+            self._flood_until = max(self._flood_until, self.clock() + float(e.retry_after))
+            log.warning("membership_check_flood_limited", channel=channel, user_id=user_id, retry_after=e.retry_after)
+            return self._fallback(channel, user_id, 'flood', fail_open)
+        except (BadRequest, Forbidden) as e:
+            # A definite answer about this user or chat, not an outage
+            self.breaker.record_success()
+            log.warning("membership_check_failed", channel=channel, user_id=user_id, error=str(e))
+            return self._remember(channel, user_id, False)
+        except Exception as e:
+            self.breaker.record_failure()
+            log.warning("membership_check_failed", channel=channel, user_id=user_id, error=str(e) or type(e).__name__)
+            return self._fallback(channel, user_id, 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error', fail_open)
+        self.breaker.record_success()
+        log.debug("membership_status", channel=channel, user_id=user_id, status=chat_member.status)
+        return self._remember(channel, user_id, chat_member.status in JOINED_STATUSES)
+
+    def _remember(self, channel, user_id, joined):
+        key = (channel, user_id)
+        self._known[key] = joined
+        self._known.move_to_end(key)
+        if len(self._known) > self.cache_size:
+            self._known.popitem(last=False)
+        return joined
+
+    def _fallback(self, channel, user_id, reason, fail_open):
+        MEMBERSHIP_FALLBACKS.labels(reason).inc()
+        return self._known.get((channel, user_id), fail_open)
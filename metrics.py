@@ -0,0 +1,300 @@
+import functools
+import http.server
+import threading
+import time
+from bisect import bisect_left
+
+from telegram.request import HTTPXRequest
+
+# Metrics are updated on the event loop and rendered from the web-server thread.
+# Updates are plain attribute arithmetic on pre-created children; the lock only
+# guards creating a new label combination and taking a snapshot for rendering.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        # Evaluated at scrape time, must be safe to call from another thread
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self._children.items())
+
+    def _samples(self, values, child):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in self._snapshot():
+            for suffix, extra, value in self._samples(values, child):
+                lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self, values, child):
+        return [('', (), child.value)]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def _samples(self, values, child):
+        try:
+            return [('', (), child.get())]
+        except Exception:
+            return []
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self, values, child):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), list(child.counts)):
+            cumulative += count
+            samples.append(('_bucket', (('le', _format_value(bound)),), cumulative))
+        samples.append(('_sum', (), child.sum))
+        samples.append(('_count', (), child.count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+HANDLER_LATENCY = histogram('bot_handler_duration_seconds', 'Time spent in update handlers.', ('handler',))
+HANDLER_ERRORS = counter('bot_handler_errors_total', 'Exceptions raised by update handlers.', ('handler',))
+DB_QUERY_LATENCY = histogram(
+    'bot_db_query_duration_seconds', 'Time spent in Database methods.', ('method',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
+)
+TELEGRAM_REQUESTS = counter('bot_telegram_requests_total', 'Bot API calls by method.', ('method',))
+TELEGRAM_ERRORS = counter('bot_telegram_errors_total', 'Failed Bot API calls by method and reason.', ('method', 'reason'))
+BROADCAST_MESSAGES = counter('bot_broadcast_messages_total', 'Broadcast deliveries by result.', ('result',))
+OUTBOX_PENDING = gauge('bot_outbox_pending', 'Notifications waiting in the outbox.')
+UPDATE_QUEUE_DEPTH = gauge('bot_update_queue_depth', 'Updates fetched but not yet processed.')
+BREAKER_STATE = gauge('bot_circuit_breaker_state', 'Circuit breaker state by endpoint: 0 closed, 1 half-open, 2 open.', ('endpoint',))
+MEMBERSHIP_FALLBACKS = counter(
+    'bot_membership_fallbacks_total', 'Membership checks answered from the last known status, by reason.', ('reason',))
+USER_STATE_ENTRIES = gauge('bot_user_state_entries', 'user_data dicts held in memory.')
+USER_STATE_BYTES = gauge('bot_user_state_bytes', 'Approximate memory held by user_data values, by key.', ('key',))
+USER_STATE_EVICTIONS = counter('bot_user_state_evictions_total', 'Idle user_data dicts dropped from memory.')
+
+
+def track_handler(func):
+    observe = HANDLER_LATENCY.labels(func.__name__).observe
+    errors = HANDLER_ERRORS.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def instrument_database(db):
+    # Wraps the public methods on this instance only, database.py stays untouched
+    for name in dir(type(db)):
+        if name.startswith('_') or not callable(getattr(type(db), name)):
+            continue
+        setattr(db, name, _timed_method(getattr(db, name), DB_QUERY_LATENCY.labels(name).observe))
+    return db
+
+
+def _timed_method(method, observe):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    # Counts every Bot API call at the transport, so calls made through PTB
+    # shortcuts (reply_text, answer, ...) are included too
+    async def do_request(self, url, method, *args, **kwargs):
+        # File downloads end in a file path, not a method name
+        api_method = 'download' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        TELEGRAM_REQUESTS.labels(api_method).inc()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            TELEGRAM_ERRORS.labels(api_method, type(e).__name__).inc()
+            raise
+        if code != 200:
+            TELEGRAM_ERRORS.labels(api_method, str(code)).inc()
+        return code, payload
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] == '/metrics':
+            body = REGISTRY.render().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            # Keep-alive pings only need a 200
+            body = b'OK'
+            content_type = 'text/plain'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,81 @@
+import asyncio
+
+from eventlog import log
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+
+class OutboxSender:
+    # Drains the outbox table in the background.  Handlers only write a row in
+    # the same transaction as the state change, so replies never wait on
+    # another user's delivery and pending notifications survive a restart.
+    # Broadcasts to every user are expanded into outbox rows expand_size at a
+    # time, only while fewer than batch_size notifications are pending.
+    def __init__(self, db, rate=25, batch_size=100, max_attempts=5,
+                 base_delay=5, max_delay=3600, poll_interval=1.0, expand_size=1000):
+        self.db = db
+        self.rate = rate
+        self.batch_size = batch_size
+        self.expand_size = expand_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        # Refreshed by the sender loop, read by the metrics endpoint
+        self.pending = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self, bot):
+        while True:
+            try:
+                expanded = self.db.expand_broadcast(self.expand_size) if self.pending < self.batch_size else 0
+                sent = await self.drain(bot)
+                self.pending = self.db.get_pending_notification_count()
+            except Exception as e:
+                log.error("outbox_sender_error", error=str(e))
+                expanded = sent = 0
+            if not sent and not expanded:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain(self, bot):
+        processed = 0
+        for notification_id, chat_id, text, attempts in self.db.get_due_notifications(self.batch_size):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                self.db.mark_notification_sent(notification_id)
+            except RetryAfter as e:
+                # Flood limit is per bot, so pause the whole sender; the
+                # message keeps its retry budget and backoff
+                self.db.defer_notification(notification_id, e.retry_after, str(e))
+                await asyncio.sleep(e.retry_after)
+            except (Forbidden, BadRequest) as e:
+                # Blocked the bot, deleted account, unknown chat: retrying will not help
+                self.db.fail_notification(notification_id, str(e))
+            except TelegramError as e:
+                if attempts + 1 >= self.max_attempts:
+                    self.db.fail_notification(notification_id, str(e))
+                else:
+                    delay = min(self.base_delay * 2 ** attempts, self.max_delay)
+                    self.db.retry_notification(notification_id, delay, str(e))
+            processed += 1
+            await asyncio.sleep(1 / self.rate)
+        return processed
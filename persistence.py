@@ -0,0 +1,137 @@
+import asyncio
+import json
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from eventlog import log
+
+
+class SQLitePersistence(BasePersistence):
+    # Keeps user_data, chat_data, bot_data and ConversationHandler states in
+    # the bot's own SQLite file, so users are not stranded mid-flow by a
+    # restart.  The Application hands over changed entries every
+    # update_interval; they are only staged here and written together in one
+    # transaction every flush_interval (and on shutdown), so a busy bot does
+    # not pay a write per message.
+    #
+    # user_data and chat_data are loaded lazily: nothing at startup, and one
+    # row when a user (or chat) first sends an update.  Together with
+    # userstate.StateEvictor, memory holds recently active users only.
+    def __init__(self, db, update_interval=10, flush_interval=10):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.db = db
+        self.flush_interval = flush_interval
+        # (kind, key) -> pickled data, or None to delete the row
+        self._pending = {}
+        self._loaded = {'user': set(), 'chat': set()}
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error("persistence_flush_error", error=str(e))
+
+    async def flush(self):
+        if not self._pending:
+            return
+        # Swapped out first: anything staged while writing goes to the next batch
+        pending, self._pending = self._pending, {}
+        try:
+            self.db.save_persistence([(kind, key, data) for (kind, key), data in pending.items()])
+        except Exception:
+            # Keep the batch, but never let it overwrite newer staged data
+            pending.update(self._pending)
+            self._pending = pending
+            raise
+        log.debug("persistence_flushed", rows=len(pending))
+
+    def _stage(self, kind, key, data):
+        # Empty dicts are the common case and are simply not stored
+        self._pending[(kind, key)] = None if data is None or data == {} else pickle.dumps(data)
+
+    def _load(self, kind):
+        return [(key, pickle.loads(data)) for key, data in self.db.load_persistence(kind)]
+
+    def _refresh(self, kind, entry_id, data):
+        if entry_id in self._loaded[kind]:
+            return
+        self._loaded[kind].add(entry_id)
+        key = str(entry_id)
+        # Staged but not yet flushed data is newer than the row
+        if (kind, key) in self._pending:
+            stored = self._pending[(kind, key)]
+        else:
+            stored = self.db.load_persistence_entry(kind, key)
+        if stored is not None and not data:
+            data.update(pickle.loads(stored))
+
+    def forget(self, user_ids=(), chat_ids=()):
+        # Called when the Application drops these entries from memory; they
+        # are read back from the database on their next update
+        self._loaded['user'].difference_update(user_ids)
+        self._loaded['chat'].difference_update(chat_ids)
+
+    @property
+    def loaded_users(self):
+        return len(self._loaded['user'])
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return dict(self._load('bot')).get('', {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in self._load(f'conversation:{name}')}
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage(f'conversation:{name}', json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._stage('user', str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage('chat', str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        self._stage('bot', '', data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._stage('user', str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        self._stage('chat', str(chat_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        self._refresh('chat', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    # Samples the stack of one thread (the event loop) from a background thread.
+    # Nothing is installed in the profiled thread, so the overhead is one
+    # sys._current_frames() call per interval.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._busy = threading.Lock()
+
+    @property
+    def running(self):
+        return self._busy.locked()
+
+    def sample(self, duration, thread_id):
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            stacks = Counter()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    stacks[collapse(frame)] += 1
+                    del frame
+                time.sleep(self.interval)
+            return stacks
+        finally:
+            self._busy.release()
+
+
+def frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse(frame):
+    # Root first, ';' separated: the "folded" format flamegraph.pl and speedscope read
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def folded(stacks):
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_functions(stacks, limit=10):
+    # (function, self samples, total samples), sorted by self time
+    own = Counter()
+    total = Counter()
+    for stack, count in stacks.items():
+        labels = stack.split(';')
+        own[labels[-1]] += count
+        for label in set(labels):
+            total[label] += count
+    return [(label, samples, total[label]) for label, samples in own.most_common(limit)]
+
+
+def summary(stacks, limit=10):
+    samples = sum(stacks.values()) or 1
+    lines = [f"{sum(stacks.values())} samples, top functions by self time:"]
+    for label, own, total in top_functions(stacks, limit):
+        lines.append(f"{own / samples:6.1%} self {total / samples:6.1%} total  {label}")
+    return "\n".join(lines)
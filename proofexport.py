@@ -0,0 +1,116 @@
+import asyncio
+import csv
+import io
+import os
+import zipfile
+
+from telegram.error import RetryAfter, TelegramError
+
+from eventlog import log
+
+# Bots can upload documents up to 50 MB
+MAX_ARCHIVE_BYTES = 45 * 1024 * 1024
+MANIFEST_COLUMNS = ('proof_id', 'user_id', 'timestamp', 'file', 'status')
+
+
+class ArchiveWriter:
+    # Writes proofs into zip volumes on disk as they arrive, starting a new
+    # volume before one outgrows what can be sent back as a document.  Each
+    # volume carries a manifest.csv for its own entries.
+    def __init__(self, directory, prefix, max_bytes=MAX_ARCHIVE_BYTES):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.paths = []
+        self.written = 0
+        self.missing = 0
+        self._zip = None
+        self._manifest_buffer = None
+        self._manifest = None
+        self._size = 0
+
+    def add(self, proof_id, user_id, timestamp, data):
+        if self._zip is None or (self._size and self._size + len(data or b'') > self.max_bytes):
+            self._roll_over()
+        name = f"{user_id}/{proof_id}.jpg"
+        if data is None:
+            self._manifest.writerow((proof_id, user_id, timestamp, '', 'missing'))
+            self.missing += 1
+            return
+        # Screenshots are already JPEG compressed
+        self._zip.writestr(name, bytes(data), compress_type=zipfile.ZIP_STORED)
+        self._manifest.writerow((proof_id, user_id, timestamp, name, 'ok'))
+        self._size += len(data)
+        self.written += 1
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.writestr('manifest.csv', self._manifest_buffer.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+            self._zip.close()
+            self._zip = None
+
+    def _roll_over(self):
+        self.close()
+        path = os.path.join(self.directory, f"{self.prefix}-part{len(self.paths) + 1}.zip")
+        self.paths.append(path)
+        self._zip = zipfile.ZipFile(path, 'w')
+        self._manifest_buffer = io.StringIO()
+        self._manifest = csv.writer(self._manifest_buffer)
+        self._manifest.writerow(MANIFEST_COLUMNS)
+        self._size = 0
+
+
+async def download_proof(bot, file_id, attempts=3):
+    for _ in range(attempts):
+        try:
+            telegram_file = await bot.get_file(file_id)
+            return await telegram_file.download_as_bytearray()
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramError as e:
+            log.warning("proof_export_download_failed", file_id=file_id, error=str(e))
+            return None
+    return None
+
+
+async def export_proofs(bot, proofs, writer, concurrency=8):
+    # proofs yields (proof_id, user_id, photo_file_id, timestamp).  At most
+    # `concurrency` downloads are in flight and each finished download is
+    # written out before its worker takes the next proof, so memory holds a
+    # handful of images regardless of how many proofs are exported.
+    # A proof that fails to download for any reason is recorded as missing;
+    # an error writing the archive ends the export, and since the producer
+    # runs alongside the workers it is cancelled instead of waiting forever
+    # on a full queue.
+    jobs = asyncio.Queue(maxsize=concurrency)
+    write_lock = asyncio.Lock()
+
+    async def produce():
+        for proof in proofs:
+            await jobs.put(proof)
+        for _ in range(concurrency):
+            await jobs.put(None)
+
+    async def worker():
+        while True:
+            proof = await jobs.get()
+            if proof is None:
+                return
+            proof_id, user_id, file_id, timestamp = proof
+            try:
+                data = await download_proof(bot, file_id)
+            except Exception as e:
+                log.warning("proof_export_download_failed", file_id=file_id, error=str(e) or type(e).__name__)
+                data = None
+            async with write_lock:
+                await asyncio.to_thread(writer.add, proof_id, user_id, timestamp, data)
+
+    tasks = [asyncio.create_task(produce())] + [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(writer.close)
+    return writer.paths
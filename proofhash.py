@@ -0,0 +1,113 @@
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from telegram.error import BadRequest, TelegramError
+
+from eventlog import log
+from metrics import counter
+
+# Returned for proofs to try again on the next pass
+RETRY = object()
+
+PROOF_HASHES = counter('bot_proof_hashes_total', 'Task proofs hashed by outcome.', ('outcome',))
+
+
+def dhash(data, size=8):
+    # Difference hash: shrink to (size + 1) x size greyscale and record whether
+    # each pixel is brighter than its right neighbour.  Re-encoding, resizing
+    # and small crops of the same screenshot land within a few bits.
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(image.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = value << 1 | (left > right)
+    return value
+
+
+class ProofHasher:
+    # Hashes task proofs in the background.  Downloads run on the event loop
+    # behind a semaphore, decoding and hashing run in a process pool, and each
+    # result is stored with the earliest near-identical proof it matches, so
+    # the admin review queue can flag resubmitted screenshots.
+    def __init__(self, db, concurrency=8, workers=2, batch_size=50, poll_interval=30.0):
+        self.db = db
+        self.concurrency = concurrency
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._downloads = None
+        self._pool = None
+        self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._downloads = asyncio.Semaphore(self.concurrency)
+        self._pool = ProcessPoolExecutor(self.workers)
+        self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    async def run(self, bot):
+        while True:
+            try:
+                hashed = await self.drain(bot)
+            except Exception as e:
+                log.error("proof_hasher_error", error=str(e))
+                hashed = 0
+            if not hashed:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain(self, bot):
+        proofs = self.db.get_unhashed_proofs(self.batch_size)
+        # Hashes are computed concurrently but stored in proof id order, so the
+        # earlier of two matching proofs is always the one kept as original
+        results = await asyncio.gather(*(self.hash_proof(bot, file_id) for _, _, file_id in proofs))
+        stored = 0
+        for (proof_id, user_id, _), value in zip(proofs, results):
+            if value is RETRY:
+                continue
+            duplicate_of = self.db.save_proof_hash(proof_id, user_id, value)
+            PROOF_HASHES.labels('failed' if value is None else 'duplicate' if duplicate_of else 'unique').inc()
+            stored += 1
+        return stored
+
+    async def hash_proof(self, bot, file_id):
+        # The hash, None when the proof can never be hashed (unknown file id,
+        # not an image), or RETRY after a network error
+        try:
+            async with self._downloads:
+                telegram_file = await bot.get_file(file_id)
+                data = await telegram_file.download_as_bytearray()
+        except BadRequest as e:
+            log.warning("proof_download_failed", file_id=file_id, error=str(e))
+            return None
+        except TelegramError as e:
+            log.warning("proof_download_retry", file_id=file_id, error=str(e))
+            return RETRY
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, dhash, bytes(data))
+        except Exception as e:
+            log.warning("proof_hash_failed", file_id=file_id, error=str(e))
+            return None
@@ -0,0 +1,113 @@
+import asyncio
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.ext._application import _STOP_SIGNAL
+
+from eventlog import log
+
+
+class UserSequencer:
+    # One FIFO queue per key: updates sharing a key run one after another in
+    # arrival order, different keys run in parallel.  The update at the head
+    # of a queue is the one being processed; a queue only lives while its key
+    # has updates in flight, so the table stays as small as the number of
+    # users with pending updates.
+    def __init__(self):
+        self._queues = {}
+
+    def __len__(self):
+        return len(self._queues)
+
+    def busy(self, key):
+        return key in self._queues
+
+    def push(self, key, item):
+        # True when the key was idle and the caller has to start draining it
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(item)
+            return False
+        self._queues[key] = deque([item])
+        return True
+
+    def head(self, key):
+        return self._queues[key][0]
+
+    def pop(self, key):
+        # Drops the finished head and returns the next item, None once the
+        # queue is empty
+        queue = self._queues[key]
+        queue.popleft()
+        if queue:
+            return queue[0]
+        del self._queues[key]
+        return None
+
+
+def update_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class SequencedApplication(Application):
+    # Used together with ApplicationBuilder.concurrent_updates().  PTB's own
+    # fetcher starts one task per update that takes a slot of the concurrency
+    # semaphore before process_update(), so a user with a backlog of updates
+    # waiting on each other would hold every slot.  Here updates are queued
+    # per user before they reach the semaphore and one task per user takes a
+    # slot only for the update it is running: a busy user occupies at most
+    # one slot and everyone else keeps being served.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sequencer = UserSequencer()
+
+    async def _update_fetcher(self):
+        if not self.concurrent_updates:
+            await super()._update_fetcher()
+            return
+        while True:
+            update = await self.update_queue.get()
+            if update is _STOP_SIGNAL:
+                while not self.update_queue.empty():
+                    self.update_queue.task_done()
+                self.update_queue.task_done()
+                return
+            self.schedule_update(update)
+
+    def schedule_update(self, update):
+        key = update_key(update)
+        if key is None:
+            self.create_task(self._process_in_slot(update), update=update)
+        elif self.sequencer.push(key, update):
+            self.create_task(self._drain(key), update=update)
+
+    async def _drain(self, key):
+        update = self.sequencer.head(key)
+        while update is not None:
+            await self._process_in_slot(update)
+            update = self.sequencer.pop(key)
+
+    async def _process_in_slot(self, update):
+        async with self._concurrent_updates_sem:
+            try:
+                await self.process_update(update)
+            except Exception as e:
+                # Keeps the rest of this user's queue going
+                log.error("update_processing_error", error=str(e))
+            finally:
+                self.update_queue.task_done()
+
+    def evict_state(self, user_ids=(), chat_ids=()):
+        # Unlike drop_user_data / drop_chat_data this only frees the memory,
+        # the entries are not deleted from persistence
+        for user_id in user_ids:
+            self._user_data.pop(user_id, None)
+        for chat_id in chat_ids:
+            self._chat_data.pop(chat_id, None)
@@ -0,0 +1,50 @@
+import os
+
+import httpx
+
+from eventlog import log
+from metrics import InstrumentedRequest
+
+
+class TunedRequest(InstrumentedRequest):
+    # HTTPXRequest in PTB 20.0 takes a pool size and timeouts only.  This adds
+    # the keep-alive limits and HTTP/2 by adjusting the client arguments and
+    # rebuilding the (not yet opened) client.
+    def __init__(self, connection_pool_size=1, keepalive_connections=None, keepalive_expiry=5.0,
+                 http2=False, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self._client_kwargs['limits'] = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=connection_pool_size if keepalive_connections is None else keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2:
+            self._client_kwargs['http2'] = True
+        try:
+            self._client = self._build_client()
+        except ImportError as e:
+            # HTTP/2 needs the optional h2 package (pip install httpx[http2])
+            log.warning("http2_unavailable", error=str(e))
+            self._client_kwargs.pop('http2', None)
+            self._client = self._build_client()
+
+
+def request_from_env(prefix, pool_size, read_timeout=5.0, write_timeout=5.0, connect_timeout=5.0, pool_timeout=1.0):
+    # Reads <prefix>_POOL_SIZE, _KEEPALIVE, _KEEPALIVE_EXPIRY, _CONNECT_TIMEOUT,
+    # _READ_TIMEOUT, _WRITE_TIMEOUT, _POOL_TIMEOUT and _HTTP2, falling back to
+    # the given defaults
+    def env(name, default):
+        return os.getenv(f"{prefix}_{name}", default)
+
+    pool_size = int(env('POOL_SIZE', pool_size))
+    keepalive = env('KEEPALIVE', None)
+    return TunedRequest(
+        connection_pool_size=pool_size,
+        keepalive_connections=None if keepalive is None else int(keepalive),
+        keepalive_expiry=float(env('KEEPALIVE_EXPIRY', 5.0)),
+        http2=env('HTTP2', '0').lower() in ('1', 'true', 'yes'),
+        connect_timeout=float(env('CONNECT_TIMEOUT', connect_timeout)),
+        read_timeout=float(env('READ_TIMEOUT', read_timeout)),
+        write_timeout=float(env('WRITE_TIMEOUT', write_timeout)),
+        pool_timeout=float(env('POOL_TIMEOUT', pool_timeout)),
+    )
@@ -0,0 +1,124 @@
+import asyncio
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from eventlog import log
+from metrics import USER_STATE_BYTES, USER_STATE_ENTRIES, USER_STATE_EVICTIONS
+
+
+def deep_size(value):
+    # sys.getsizeof of the value and everything it contains; shared objects
+    # (interned strings, small ints) are counted every time, so this is an
+    # upper bound
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key) + deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item) for item in value)
+    return size
+
+
+def state_usage(states):
+    # {key: (entries, bytes)} over an iterable of user_data dicts, largest
+    # first.  The dicts themselves are reported under '(dict)'.
+    usage = {}
+    for state in states:
+        entries, size = usage.get('(dict)', (0, 0))
+        usage['(dict)'] = (entries + 1, size + sys.getsizeof(state))
+        for key, value in list(state.items()):
+            entries, size = usage.get(key, (0, 0))
+            usage[key] = (entries + 1, size + deep_size(value))
+    return dict(sorted(usage.items(), key=lambda item: item[1][1], reverse=True))
+
+
+class StateEvictor:
+    # Drops the in-memory user_data and chat_data of users who have not sent
+    # an update for ttl seconds.  Their latest state is handed to the
+    # persistence first, and SQLitePersistence reads it back on the user's
+    # next update, so eviction only costs memory, never state.  Each pass
+    # also refreshes the per-key memory gauges.
+    def __init__(self, ttl=1800, interval=300, clock=time.monotonic):
+        self.ttl = ttl
+        self.interval = interval
+        self.clock = clock
+        self.evicted = 0
+        self._users = {}
+        self._chats = {}
+        self._reported_keys = set()
+        self._application = None
+        self._task = None
+
+    def handler(self):
+        return TypeHandler(Update, self.touch)
+
+    async def touch(self, update, context):
+        now = self.clock()
+        if update.effective_user:
+            self._users[update.effective_user.id] = now
+        if update.effective_chat:
+            self._chats[update.effective_chat.id] = now
+
+    def start(self, application):
+        self._application = application
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                evicted = await self.evict()
+                if evicted:
+                    log.info("user_state_evicted", users=evicted, remaining=len(self._application.user_data))
+                self.report()
+            except Exception as e:
+                log.error("state_evictor_error", error=str(e))
+
+    def _idle(self, last_seen, cutoff):
+        sequencer = getattr(self._application, 'sequencer', None)
+        return [key for key, seen in last_seen.items()
+                if seen < cutoff and not (sequencer and sequencer.busy(key))]
+
+    async def evict(self):
+        cutoff = self.clock() - self.ttl
+        if not self._idle(self._users, cutoff) and not self._idle(self._chats, cutoff):
+            return 0
+        # Hands every changed entry to the persistence before it is dropped
+        await self._application.update_persistence()
+        # Recomputed after the await: anyone who came back meanwhile stays
+        user_ids = self._idle(self._users, cutoff)
+        chat_ids = self._idle(self._chats, cutoff)
+        for user_id in user_ids:
+            del self._users[user_id]
+        for chat_id in chat_ids:
+            del self._chats[chat_id]
+        self._application.evict_state(user_ids, chat_ids)
+        if self._application.persistence:
+            self._application.persistence.forget(user_ids, chat_ids)
+        self.evicted += len(user_ids)
+        USER_STATE_EVICTIONS.inc(len(user_ids))
+        return len(user_ids)
+
+    def usage(self):
+        return state_usage(self._application.user_data.values())
+
+    def report(self):
+        usage = self.usage()
+        USER_STATE_ENTRIES.set(len(self._application.user_data))
+        for key in self._reported_keys - usage.keys():
+            USER_STATE_BYTES.labels(key).set(0)
+        for key, (_, size) in usage.items():
+            USER_STATE_BYTES.labels(str(key)).set(size)
+        self._reported_keys = {str(key) for key in usage}
+        return usage